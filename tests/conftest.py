@@ -0,0 +1,82 @@
+""" The tools import each other as top level modules, so tests import them the same way"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import spotipy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+
+# read at import by the Spotify tools, never used to log in by the tests
+os.environ.setdefault("SPOTIPY_USERNAME", "test")
+
+
+class StubServer(object):
+    """
+    Local stand-in for a web service on a free port. handler(method, path, query, body) returns
+    (status, headers, json body) and every request is recorded as (time, method, path, query).
+    """
+    def __init__(self):
+        self.requests = []
+        self.handler = lambda method, path, query, body: (200, {}, {})
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                with stub._lock:
+                    stub.requests.append((time.monotonic(), self.command, url.path, query))
+                status, headers, content = stub.handler(self.command, url.path, query, body)
+                data = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def spotify(self, requests_session=True):
+        """a spotipy client sending its API calls here"""
+        sp = spotipy.Spotify(auth="token", requests_session=requests_session)
+        sp.prefix = self.url + "v1/"
+        return sp
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture(autouse=True)
+def progress_db(tmp_path, monkeypatch):
+    """the mp3_to_spotify progress journal of each test, rather than the one under ~/.cache"""
+    path = str(tmp_path / "progress" / "spotify_progress.sqlite")
+    monkeypatch.setenv("SPOTIPY_PROGRESS_DB", path)
+    return path
@@ -0,0 +1,86 @@
+import gzip
+import os
+from urllib.parse import parse_qs
+
+import acoustid
+import pytest
+
+from mp3_benchmarks import Mp3Benchmarks
+import mp3_db
+
+
+def fake_fingerprint_file(path):
+    # no chromaprint needed, runs in the pool's (forked) worker processes
+    return 123.4, ("FP" + os.path.basename(path)).encode()
+
+
+@pytest.fixture
+def utils(stub_server, monkeypatch):
+    def handler(method, path, query, body):
+        params = {key: values[0] for key, values in parse_qs(gzip.decompress(body).decode()).items()}
+        count = sum(1 for key in params if key.startswith("fingerprint."))
+        # every other fingerprint has a recording
+        fingerprints = [{"index": i, "results": [{"id": "ac-" + params[f"fingerprint.{i}"], "score": 0.9,
+                                                  "recordings": [{"id": f"rec{i}", "title": "Title",
+                                                                  "artists": [{"name": "Artist"}]}]}]
+                         if i % 2 == 0 else []}
+                        for i in range(count)]
+        return 200, {}, {"status": "ok", "fingerprints": fingerprints}
+
+    stub_server.handler = handler
+    monkeypatch.setenv("ACOUSTID_KEY", "key")
+    monkeypatch.setenv("ACOUSTID_API_URL", stub_server.url + "v2/")
+    monkeypatch.setattr(acoustid, "fingerprint_file", fake_fingerprint_file)
+    monkeypatch.setattr("acoustid_utils.LOOKUP_INTERVAL", 0)
+    from acoustid_utils import AcoustidUtils
+    return AcoustidUtils()
+
+
+def test_fingerprint_dir_caches_and_batches_lookups(utils, stub_server, tmp_path):
+    library = str(tmp_path / "lib")
+    db_path = str(tmp_path / "fp.sqlite")
+    Mp3Benchmarks().make_fixture_tree(library, files=50, files_per_dir=10, frames=5)
+
+    summary = utils.fingerprint_dir(library, db_path, processes=2)
+    assert summary == {"files": 50, "fingerprinted": 50, "cached": 0, "removed": 0, "errors": 0,
+                       "looked_up": 50, "matched": 25, "lookup_requests": 3}
+    assert [(method, path) for _, method, path, _ in stub_server.requests] == [("POST", "/v2/lookup")] * 3
+
+    # only a changed file is fingerprinted and looked up again
+    changed = os.path.join(library, sorted(os.listdir(library))[0])
+    changed = os.path.join(changed, sorted(os.listdir(changed))[0])
+    os.utime(changed, (1, 1))
+    summary = utils.fingerprint_dir(library, db_path, processes=2)
+    assert summary == {"files": 50, "fingerprinted": 1, "cached": 49, "removed": 0, "errors": 0,
+                       "looked_up": 1, "matched": 1, "lookup_requests": 1}
+
+
+def test_fingerprints_of_deleted_files_are_pruned(utils, tmp_path):
+    library = str(tmp_path / "lib")
+    db_path = str(tmp_path / "fp.sqlite")
+    Mp3Benchmarks().make_fixture_tree(library, files=4, files_per_dir=2, frames=5)
+    utils.fingerprint_dir(library, db_path, processes=2, lookup=0)
+
+    albums = sorted(os.listdir(library))
+    deleted = os.path.join(library, albums[0], sorted(os.listdir(os.path.join(library, albums[0])))[0])
+    os.remove(deleted)
+    # scanning only the top folder leaves the albums' fingerprints alone
+    assert utils.fingerprint_dir(library, db_path, recurse=0, processes=2, lookup=0)["removed"] == 0
+    assert utils.fingerprint_dir(library, db_path, processes=2, lookup=0)["removed"] == 1
+
+    conn = mp3_db.optimize_db_connection(db_path)
+    paths = [path for path, _, _ in mp3_db.get_fingerprints(conn, library)]
+    conn.close()
+    assert len(paths) == 3 and deleted not in paths
+
+
+def test_lookup_batch_keeps_results_in_order(utils):
+    results = utils.lookup_batch([(100, "a"), (200, "b"), (300, "c")])
+    assert [[result["id"] for result in item] for item in results] == [["ac-a"], [], ["ac-c"]]
+
+
+def test_lookup_batch_raises_on_an_error_status(utils, stub_server):
+    stub_server.handler = lambda method, path, query, body: (
+        400, {}, {"status": "error", "error": {"code": 4, "message": "invalid API key"}})
+    with pytest.raises(acoustid.WebServiceError):
+        utils.lookup_batch([(100, "a")])
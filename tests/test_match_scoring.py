@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+from match_scoring import score_batch, score_candidates
+
+WORDS = ["love", "night", "dance", "the", "blue", "heart", "fire", "road", "song", "rain", "live", "remix"]
+
+
+def item(track_id, name, artist, duration_ms, popularity):
+    return {"id": track_id, "name": name, "artists": [{"name": artist}], "duration_ms": duration_ms,
+            "popularity": popularity}
+
+
+def synthetic_queries(count=500, candidates=10, seed=1, zero_durations=0.0):
+    rng = random.Random(seed)
+
+    def phrase(n):
+        return " ".join(rng.choice(WORDS) for _ in range(n))
+
+    queries = []
+    for i in range(count):
+        title, artist, duration = phrase(3), phrase(2), rng.randint(90, 420)
+        if rng.random() < zero_durations:
+            # files whose length couldn't be read
+            duration = 0
+        items = [item(f"id{i}_{c}",
+                      title.upper() if rng.random() < 0.3 else phrase(3),
+                      artist if rng.random() < 0.5 else phrase(2),
+                      duration * 1000 + rng.randint(-30000, 30000),
+                      rng.randint(0, 100))
+                 for c in range(rng.randint(1, candidates))]
+        queries.append((title, artist, duration, {"tracks": {"items": items}}))
+    return queries
+
+
+# hand picked cases: exact ties (the first listed wins), case differences, durations far enough off to score 0
+EDGE_QUERIES = [
+    ("Yesterday", "The Beatles", 125, {"tracks": {"items": [
+        item("a", "Yesterday", "The Beatles", 125000, 50),
+        item("b", "Yesterday", "The Beatles", 125000, 50)]}}),
+    ("yesterday", "the beatles", 125, {"tracks": {"items": [
+        item("a", "Yesterday - Remastered 2009", "The Beatles", 126000, 80),
+        item("b", "YESTERDAY", "THE BEATLES", 125000, 10)]}}),
+    ("Song", "Artist", 200, {"tracks": {"items": [
+        item("a", "Other", "Someone", 900000, 100),
+        item("b", "Song", "Artist", 2000, 0)]}}),
+    ("Solo", "Only", 180, {"tracks": {"items": [item("a", "Solo", "Only", 180000, 0)]}}),
+]
+
+
+@pytest.mark.parametrize("queries", [synthetic_queries(), synthetic_queries(seed=2, zero_durations=0.2), EDGE_QUERIES],
+                         ids=["synthetic", "zero durations", "edge"])
+def test_batch_picks_the_same_match_as_score_candidates(queries):
+    expected = [score_candidates(*query) for query in queries]
+    assert score_batch(queries) == expected
+
+
+def test_batch_gives_none_for_queries_without_results():
+    queries = [EDGE_QUERIES[3], ("Nothing", "Nobody", 100, {"tracks": {"items": []}})]
+    assert score_batch(queries) == [score_candidates(*EDGE_QUERIES[3]), None]
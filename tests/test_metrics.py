@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from metrics import Metrics
+
+
+@pytest.fixture
+def metrics():
+    metrics = Metrics(buckets=(0.01, 0.1, 1.0))
+    metrics.observe("search", 0.005)
+    metrics.observe("search", 0.05)
+    metrics.observe("search", 0.5, error=True)
+    metrics.observe("search", 5.0)
+    metrics.count("search_cache", result="hit")
+    metrics.count("search_cache", 2, result="miss")
+    metrics.count("tracks_written", 10)
+    return metrics
+
+
+def test_prometheus_exposition(metrics):
+    lines = metrics.prometheus().splitlines()
+
+    assert "# TYPE py_spotify_stage_seconds histogram" in lines
+    # buckets are cumulative, ending with +Inf
+    assert [line for line in lines if line.startswith("py_spotify_stage_seconds_bucket")] == [
+        'py_spotify_stage_seconds_bucket{stage="search",le="0.01"} 1',
+        'py_spotify_stage_seconds_bucket{stage="search",le="0.1"} 2',
+        'py_spotify_stage_seconds_bucket{stage="search",le="1"} 3',
+        'py_spotify_stage_seconds_bucket{stage="search",le="+Inf"} 4']
+    assert 'py_spotify_stage_seconds_sum{stage="search"} 5.555000' in lines
+    assert 'py_spotify_stage_seconds_count{stage="search"} 4' in lines
+    assert "# TYPE py_spotify_stage_errors_total counter" in lines
+    assert 'py_spotify_stage_errors_total{stage="search"} 1' in lines
+
+    assert "# TYPE py_spotify_search_cache_total counter" in lines
+    assert 'py_spotify_search_cache_total{result="hit"} 1' in lines
+    assert 'py_spotify_search_cache_total{result="miss"} 2' in lines
+    assert "py_spotify_tracks_written_total 10" in lines
+
+
+def test_json_summary(metrics):
+    summary = metrics.summary()
+    assert summary["stages"]["search"] == {
+        "calls": 4, "errors": 1, "total_secs": 5.555, "mean_ms": 1388.75, "max_ms": 5000.0,
+        "histogram": {"le_0.01": 1, "le_0.1": 1, "le_1": 1, "le_inf": 1}}
+    assert summary["counters"] == {'search_cache{result="hit"}': 1, 'search_cache{result="miss"}': 2,
+                                   "tracks_written": 10}
+
+
+def test_timer_counts_errors():
+    metrics = Metrics()
+    with metrics.timer("write"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.timer("write"):
+            raise ValueError
+    assert metrics.summary()["stages"]["write"]["calls"] == 2
+    assert metrics.summary()["stages"]["write"]["errors"] == 1
+
+
+@pytest.mark.parametrize("name", ["metrics.json", "metrics.prom"])
+def test_metrics_are_written_at_exit(tmp_path, name):
+    path = str(tmp_path / name)
+    tools = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools")
+    code = "import metrics; metrics.count('files', 3); metrics.timed('read')(lambda: None)()"
+    subprocess.run([sys.executable, "-c", code], cwd=tools, check=True,
+                   env=dict(os.environ, PY_SPOTIFY_METRICS=path))
+
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    assert not os.path.exists(path + ".tmp")
+    if name.endswith(".prom"):
+        assert "py_spotify_files_total 3" in text.splitlines()
+        assert 'py_spotify_stage_seconds_count{stage="read"} 1' in text.splitlines()
+    else:
+        summary = json.loads(text)
+        assert summary["counters"] == {"files": 3}
+        assert summary["stages"]["read"]["calls"] == 1
@@ -0,0 +1,44 @@
+import pytest
+
+import mp3_db
+from mp3_utils import TrackRecord
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = mp3_db.optimize_db_connection(str(tmp_path / "tracks.sqlite"))
+    mp3_db.create_optimized_schema(conn)
+    yield conn
+    conn.close()
+
+
+def row(conn, path):
+    return conn.execute("SELECT id, title, artist, album, duration_ms, spotify_id, last_checked FROM tracks "
+                        "WHERE file_path = ?", (path,)).fetchone()
+
+
+def test_rescan_updates_tags_and_keeps_the_match(conn):
+    mp3_db.batch_insert_tracks(conn, [("/music/a/1.mp3", "Title", "Artist", "Album", 180000, None, None),
+                                      ("/music/a/2.mp3", "Other", "Artist", "Album", 200000, None, None)])
+    mp3_db.batch_insert_tracks(conn, [("/music/a/1.mp3", "Title", "Artist", "Album", 180000, "id1", "2024-01-01")])
+    first_id = row(conn, "/music/a/1.mp3")[0]
+
+    # a rescan has new tags but no match, as TrackRecord rows, in chunks smaller than the input
+    records = [TrackRecord("New Title", "New Artist", "New Album", "1", "Rock", "1999", 181, "1.mp3", "/music/a"),
+               TrackRecord("Other", "Artist", "Album", "2", "Rock", "1999", 200, "2.mp3", "/music/a")]
+    assert mp3_db.batch_insert_tracks(conn, iter(records), chunk_size=1) == 2
+
+    assert row(conn, "/music/a/1.mp3") == (first_id, "New Title", "New Artist", "New Album", 181000, "id1", "2024-01-01")
+    assert row(conn, "/music/a/2.mp3")[5:] == (None, None)
+
+    # a new match does replace the old one
+    mp3_db.batch_insert_tracks(conn, [("/music/a/1.mp3", "New Title", "New Artist", "New Album", 181000, "id2", None)])
+    assert row(conn, "/music/a/1.mp3")[5:] == ("id2", "2024-01-01")
+
+
+def test_bulk_load_rebuilds_the_indexes(conn):
+    indexes = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    mp3_db.bulk_load_tracks(conn, ((f"/music/{i}.mp3", "T", "A", "B", 1000, None, None) for i in range(10)),
+                            chunk_size=3)
+    assert conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0] == 10
+    assert {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")} == indexes
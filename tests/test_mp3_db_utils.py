@@ -0,0 +1,81 @@
+import datetime
+
+import pytest
+
+import mp3_db
+from mp3_db_utils import Mp3DbUtils
+from sync_state import SyncState
+
+
+def days_ago(days):
+    return (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat(timespec="seconds")
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / "tracks.sqlite")
+    conn = mp3_db.optimize_db_connection(db_path)
+    mp3_db.create_optimized_schema(conn)
+    mp3_db.batch_insert_tracks(conn, [
+        ("/music/gnr/1.mp3", "Paradise City", "Guns N' Roses", "Appetite for Destruction", 406000, "gnr1", days_ago(1)),
+        ("/music/acdc/1.mp3", "T.N.T.", "AC/DC", "High Voltage", 214000, "spotify:track:acdc1", days_ago(60)),
+        ("/music/sigur/1.mp3", "Hoppípolla", "Sigur Rós", "Takk...", 268000, None, None),
+        ("/music/copies/1.mp3", "paradise city", "GUNS N' ROSES", "Live", 406000, None, None),
+        ("/music/acdc/2.mp3", "Thunderstruck", "AC/DC", "The Razors Edge", 292000, "acdc2", days_ago(90)),
+    ])
+    conn.close()
+    return db_path
+
+
+def test_unmatched_stale_and_duplicates(db_path):
+    utils = Mp3DbUtils()
+    assert utils.unmatched(db_path) == ["/music/copies/1.mp3", "/music/sigur/1.mp3"]
+    assert utils.unmatched(db_path, "/music/sigur") == ["/music/sigur/1.mp3"]
+    assert utils.unmatched(db_path, limit=1) == ["/music/copies/1.mp3"]
+
+    # oldest check first
+    assert [line.split("~")[2] for line in utils.stale(db_path, days=30)] == ["/music/acdc/2.mp3", "/music/acdc/1.mp3"]
+
+    # artist and title ignoring case
+    [line] = utils.duplicates(db_path)
+    assert sorted(line.split("~")[2:]) == ["/music/copies/1.mp3", "/music/gnr/1.mp3"]
+
+
+def test_unliked_attaches_the_sync_db(db_path, tmp_path):
+    liked_db_path = str(tmp_path / "liked.sqlite")
+    state = SyncState(liked_db_path)
+    # bare ids and uris in the tracks db both match the snapshot's uris
+    state.add_liked({"spotify:track:gnr1": {"name": "Paradise City", "artists": "Guns N' Roses"},
+                     "spotify:track:acdc1": {"name": "T.N.T.", "artists": "AC/DC"}})
+    state.close()
+
+    assert Mp3DbUtils().unliked(db_path, liked_db_path) == ["acdc2~/music/acdc/2.mp3"]
+    assert Mp3DbUtils().unliked(db_path, str(tmp_path / "missing.sqlite")).startswith("No liked songs snapshot")
+
+
+@pytest.mark.parametrize("query, paths", [
+    ("guns roses", ["/music/copies/1.mp3", "/music/gnr/1.mp3"]),
+    ("Guns N' Roses", ["/music/copies/1.mp3", "/music/gnr/1.mp3"]),
+    ("AC/DC", ["/music/acdc/1.mp3", "/music/acdc/2.mp3"]),
+    ("T.N.T.", ["/music/acdc/1.mp3"]),
+    # accents are ignored both ways
+    ("sigur ros hoppipolla", ["/music/sigur/1.mp3"]),
+    ("album: live", ["/music/copies/1.mp3"]),
+    ("beatles", []),
+])
+def test_search_tokenizes_tags_with_punctuation(db_path, query, paths):
+    assert sorted(line.split("~")[0] for line in Mp3DbUtils().search(db_path, query)) == paths
+
+
+def test_search_index_follows_the_tracks_table(db_path):
+    utils = Mp3DbUtils()
+    assert utils.search(db_path, "thunderstruck") != []
+
+    conn = mp3_db.optimize_db_connection(db_path)
+    mp3_db.batch_insert_tracks(conn, [("/music/acdc/2.mp3", "Back in Black", "AC/DC", "Back in Black", 255000, None, None)])
+    mp3_db.delete_tracks(conn, ["/music/sigur/1.mp3"])
+    conn.close()
+
+    assert utils.search(db_path, "thunderstruck") == []
+    assert [line.split("~")[0] for line in utils.search(db_path, "back black")] == ["/music/acdc/2.mp3"]
+    assert utils.search(db_path, "sigur") == []
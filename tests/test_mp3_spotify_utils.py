@@ -0,0 +1,267 @@
+import csv
+import os
+import threading
+import time
+
+import pytest
+
+from mp3_benchmarks import Mp3Benchmarks
+from mp3_spotify_utils import MP3SpotifyUtils, PROGRESS_DB_NAME
+from mp3_utils import Mp3Utils
+from rate_limiter import LimitedSpotify, RateLimiter
+
+
+class FakeSearch(object):
+    """answers every search with one track, counting the searches"""
+    def __init__(self):
+        self.searches = []
+        self._lock = threading.Lock()
+
+    def search(self, q, limit=10, type="track", market=None):
+        with self._lock:
+            self.searches.append(q)
+            n = len(self.searches)
+        return {"tracks": {"items": [{"id": f"id{n}", "uri": f"spotify:track:id{n}", "name": "Title",
+                                      "artists": [{"name": "Artist"}], "duration_ms": 1000, "popularity": 1,
+                                      "album": {"name": "Album", "artists": [{"name": "Artist"}]}}]}}
+
+
+@pytest.fixture
+def album(tmp_path):
+    Mp3Benchmarks().make_fixture_tree(str(tmp_path / "lib"), files=12, files_per_dir=12, frames=20)
+    return str(tmp_path / "lib" / os.listdir(tmp_path / "lib")[0])
+
+
+def utils(sp):
+    return MP3SpotifyUtils(sp=LimitedSpotify(sp, RateLimiter(rate=10000, burst=10000)))
+
+
+def lines(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read().splitlines()[1:]
+
+
+def test_resume_over_outputs_without_a_journal(album, progress_db):
+    sp = FakeSearch()
+    utils(sp).mp3_to_spotify(album, outputs="txt,csv")
+    # outputs from before progress was journaled
+    os.remove(progress_db)
+    before = lines(os.path.join(album, "spotify.txt"))
+
+    sp.searches = []
+    utils(sp).mp3_to_spotify(album, outputs="txt,csv")
+    assert sp.searches == []
+    assert lines(os.path.join(album, "spotify.txt")) == before
+
+    # and the journal now holds them, so a retry that replaces results rebuilds the outputs with every file
+    utils(sp).mp3_to_spotify(album, outputs="txt,csv", retry=1)
+    with open(os.path.join(album, "spotify.csv"), encoding="utf-8", newline="") as f:
+        assert len(list(csv.DictReader(f))) == 12
+
+
+def test_outputs_only_partly_written_are_rebuilt(album, progress_db):
+    sp = FakeSearch()
+    utils(sp).mp3_to_spotify(album, outputs="txt")
+    os.remove(progress_db)
+
+    # csv is new, so every file is searched again, and the txt rebuilt rather than appended to
+    sp.searches = []
+    utils(sp).mp3_to_spotify(album, outputs="txt,csv")
+    assert len(sp.searches) == 12
+    assert len(lines(os.path.join(album, "spotify.txt"))) == 12
+    assert len(lines(os.path.join(album, "spotify.csv"))) == 12
+
+
+def test_concurrent_searches_against_a_stand_in_server(album, stub_server):
+    in_flight = []
+    most_in_flight = []
+    lock = threading.Lock()
+
+    def handler(method, path, query, body):
+        assert path == "/v1/search"
+        title = query["q"][0].split("track:")[1]
+        with lock:
+            in_flight.append(title)
+            most_in_flight.append(len(in_flight))
+        # later files answer sooner, so finishing order differs from input order
+        time.sleep(0.2 - int(title.split()[-1]) * 0.01)
+        with lock:
+            in_flight.remove(title)
+        track_id = "id" + title.split()[-1]
+        return 200, {}, {"tracks": {"items": [{
+            "id": track_id, "uri": f"spotify:track:{track_id}", "name": title, "popularity": 1,
+            "duration_ms": 1000, "artists": [{"name": "Artist"}],
+            "album": {"name": "Album", "artists": [{"name": "Artist"}]}}]}}
+
+    stub_server.handler = handler
+    utils(stub_server.spotify()).mp3_to_spotify(album, outputs="csv", workers=4)
+
+    assert 1 < max(most_in_flight) <= 4
+    with open(os.path.join(album, "spotify.csv"), encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    # rows in input (directory) order, each with its own file's result
+    assert [row["file"] for row in rows] == [name for name, _ in Mp3Utils().list_mp3_files(album)]
+    assert all(row["sp_id"] == "id" + row["title"].split()[-1] for row in rows)
+
+
+class FailingSearch(FakeSearch):
+    def search(self, q, limit=10, type="track", market=None):
+        super().search(q, limit, type, market)
+        raise RuntimeError("offline")
+
+
+def cluster_album(monkeypatch, album, size):
+    """cluster the first size files of album, the last of them as representative"""
+    paths = [os.path.abspath(os.path.join(album, name)) for name, _ in Mp3Utils().list_mp3_files(album)]
+    cluster = [paths[size - 1]] + paths[:size - 1]
+    monkeypatch.setattr("audio_duplicates.duplicate_clusters", lambda fingerprint_db, directory: [cluster])
+    return Mp3Utils().get_mp3_data(os.path.basename(cluster[0]), album)
+
+
+def test_duplicates_are_searched_with_the_representatives_tags(album, monkeypatch):
+    representative = cluster_album(monkeypatch, album, 6)
+    sp = FakeSearch()
+    utils(sp).mp3_to_spotify(album, outputs="csv", fingerprint_db="fingerprints.sqlite")
+
+    # one search for the cluster, whichever member came first, and one for each of the other 6 files
+    assert len(sp.searches) == 7
+    assert sp.searches[0] == f"artist:{representative['artist']} track:{representative['title']}"
+    with open(os.path.join(album, "spotify.csv"), encoding="utf-8", newline="") as f:
+        assert len({row["sp_id"] for row in csv.DictReader(f)}) == 7
+
+
+def test_a_failing_cluster_counts_as_one_failed_search(album, monkeypatch):
+    cluster_album(monkeypatch, album, 12)
+    sp = FailingSearch()
+    # 12 failed files, but only one failed search, so the run doesn't stop
+    utils(sp).mp3_to_spotify(album, outputs="csv", fingerprint_db="fingerprints.sqlite")
+    assert len(sp.searches) == 1
+
+
+def test_hydrate_tracks_takes_a_comma_separated_string():
+    class FakeTracks(object):
+        def __init__(self):
+            self.requests = []
+
+        def tracks(self, tracks, market=None):
+            self.requests.append(list(tracks))
+            return {"tracks": [{"id": track_id, "name": f"Track {track_id}"} for track_id in tracks]}
+
+    sp = FakeTracks()
+    # as given on the command line
+    tracks = utils(sp).hydrate_tracks("id1,spotify:track:id2, https://open.spotify.com/track/id3?si=x,id1", "0")
+    assert sorted(tracks) == ["id1", "id2", "id3"]
+    assert sorted(sum(sp.requests, [])) == ["id1", "id2", "id3"]
+
+
+class InterruptedSearch(FakeSearch):
+    """stops the run (as ctrl-c would) on search number stop_at"""
+    def __init__(self, stop_at):
+        FakeSearch.__init__(self)
+        self.stop_at = stop_at
+
+    def search(self, q, limit=10, type="track", market=None):
+        if len(self.searches) + 1 == self.stop_at:
+            raise KeyboardInterrupt
+        return FakeSearch.search(self, q, limit, type, market)
+
+
+@pytest.fixture
+def library(tmp_path):
+    """two albums under one artist folder and one album two levels down, 6 files in all"""
+    benchmarks = Mp3Benchmarks()
+    benchmarks.make_fixture_tree(str(tmp_path / "lib" / "a"), files=4, files_per_dir=2, frames=40)
+    benchmarks.make_fixture_tree(str(tmp_path / "lib" / "b" / "c"), files=2, files_per_dir=2, frames=40)
+    return str(tmp_path / "lib")
+
+
+def album_dirs(library):
+    return sorted({mp3_dir for _, mp3_dir in Mp3Utils().list_mp3_files(library, recurse=1)})
+
+
+def test_library_writes_outputs_per_folder(library):
+    sp = FakeSearch()
+    utils(sp).library_to_spotify(library, outputs="txt,csv", workers=2, read_workers=2)
+
+    assert len(sp.searches) == 6
+    assert len(album_dirs(library)) == 3
+    for album_dir in album_dirs(library):
+        files = sorted(name for name in os.listdir(album_dir) if name.endswith(".mp3"))
+        with open(os.path.join(album_dir, "spotify.csv"), encoding="utf-8", newline="") as f:
+            assert sorted(row["file"] for row in csv.DictReader(f)) == files
+        assert len(lines(os.path.join(album_dir, "spotify.txt"))) == 2
+    assert not os.path.exists(os.path.join(library, "spotify.csv"))
+
+    # a re-run has nothing left to search
+    sp.searches = []
+    utils(sp).library_to_spotify(library, outputs="txt,csv", workers=2, read_workers=2)
+    assert sp.searches == []
+    assert all(len(lines(os.path.join(album_dir, "spotify.txt"))) == 2 for album_dir in album_dirs(library))
+
+
+def test_library_writes_one_set_of_outputs(library):
+    utils(FakeSearch()).library_to_spotify(library, outputs="csv", per_folder=0, workers=2, read_workers=0)
+
+    with open(os.path.join(library, "spotify.csv"), encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert sorted(os.path.join(row["dir"], row["file"]) for row in rows) == sorted(
+        os.path.join(mp3_dir, mp3_file) for mp3_file, mp3_dir in Mp3Utils().list_mp3_files(library, recurse=1))
+    assert not any(os.path.exists(os.path.join(album_dir, "spotify.csv")) for album_dir in album_dirs(library))
+
+
+def test_library_resumes_a_partly_finished_folder(library):
+    # stopped on the 4th search, with the first album done and the second half way through
+    with pytest.raises(KeyboardInterrupt):
+        utils(InterruptedSearch(4)).library_to_spotify(library, outputs="csv", workers=1, read_workers=0)
+
+    sp = FakeSearch()
+    utils(sp).library_to_spotify(library, outputs="csv", workers=1, read_workers=0)
+    assert len(sp.searches) == 3
+    for album_dir in album_dirs(library):
+        with open(os.path.join(album_dir, "spotify.csv"), encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+        assert sorted(row["file"] for row in rows) == sorted(
+            name for name in os.listdir(album_dir) if name.endswith(".mp3"))
+
+
+@pytest.mark.parametrize("read_workers", [0, 2])
+def test_an_unreadable_file_is_skipped(library, read_workers):
+    bad = os.path.join(album_dirs(library)[0], "bad.mp3")
+    with open(bad, "wb") as f:
+        f.write(b"not an mp3" * 100)
+
+    sp = FakeSearch()
+    utils(sp).library_to_spotify(library, outputs="csv", workers=2, read_workers=read_workers)
+    assert len(sp.searches) == 6
+
+    sp.searches = []
+    utils(sp).mp3_to_spotify(album_dirs(library)[0], outputs="txt", resume=0)
+    assert len(sp.searches) == 2
+
+
+def test_journal_is_kept_out_of_the_music_folders(library, progress_db):
+    sp = FakeSearch()
+    album_dir = album_dirs(library)[0]
+    utils(sp).mp3_to_spotify(album_dir, outputs="txt")
+    utils(sp).library_to_spotify(library, outputs="txt", workers=2, read_workers=2)
+    assert not any(PROGRESS_DB_NAME in files for _, _, files in os.walk(library))
+    assert os.path.exists(progress_db)
+    # the folder searched on its own is resumed by the library run, the journal is shared
+    assert len(sp.searches) == 6
+
+    # starting a folder over leaves the progress of the others alone
+    sp.searches = []
+    utils(sp).mp3_to_spotify(os.path.dirname(album_dir), outputs="txt", resume=0)
+    utils(sp).library_to_spotify(library, outputs="txt", workers=2, read_workers=2)
+    assert sp.searches == []
+
+
+def test_journal_left_in_a_folder_by_an_earlier_version_is_still_used(album, progress_db):
+    sp = FakeSearch()
+    utils(sp).mp3_to_spotify(album, outputs="txt")
+    os.replace(progress_db, os.path.join(album, PROGRESS_DB_NAME))
+
+    sp.searches = []
+    utils(sp).mp3_to_spotify(album, outputs="txt")
+    assert sp.searches == []
+    assert not os.path.exists(progress_db)
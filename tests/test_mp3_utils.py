@@ -0,0 +1,131 @@
+from io import BytesIO
+import os
+import sys
+
+from mutagen.id3 import ID3, TIT2
+from mutagen.mp3 import MP3
+import pytest
+
+from mp3_benchmarks import Mp3Benchmarks, MP3_FRAME_HEADER, MP3_FRAME_SIZE, _CountingFile
+from mp3_utils import Mp3Utils, TrackRecord, read_mp3_headers
+
+
+def test_scan_does_not_follow_symlinked_directories(tmp_path):
+    library = tmp_path / "lib"
+    Mp3Benchmarks().make_fixture_tree(str(library), files=6, files_per_dir=3, frames=5)
+    album = library / sorted(os.listdir(library))[0]
+    # a loop back to the library root, and a second path to another album
+    os.symlink(library, album / "loop")
+    os.symlink(library / sorted(os.listdir(library))[1], library / "alias")
+
+    files = Mp3Utils().list_mp3_files(str(library), recurse=1)
+    assert len(files) == 6
+    assert len({os.path.join(d, f) for f, d in files}) == 6
+
+
+def test_track_record_is_smaller_than_the_old_dict():
+    fields = dict(title="Title", artist="Artist", album="Album", track="1", genre="Rock", year="1999",
+                  duration=200, file="track.mp3", dir="/music/Artist/Album")
+    record = TrackRecord(**fields)
+    assert sys.getsizeof(record) < sys.getsizeof(dict(fields))
+    assert sys.getsizeof(record) <= sys.getsizeof(tuple(fields.values()))
+    assert record == fields
+
+    # and over a library's worth, where interning the repeated strings counts too
+    benchmarks = Mp3Benchmarks()
+    assert benchmarks._record_memory(TrackRecord, 20000) < benchmarks._record_memory(dict, 20000) * 0.8
+
+
+def headers_and_bytes_read(path):
+    with open(path, "rb") as raw:
+        f = _CountingFile(raw)
+        return read_mp3_headers(f), f.bytes_read
+
+
+def test_fast_read_reads_fewer_bytes_than_mutagen(tmp_path):
+    Mp3Benchmarks().make_fixture_tree(str(tmp_path), files=1, frames=50)
+    mp3_file, mp3_dir = Mp3Utils().list_mp3_files(str(tmp_path), recurse=1)[0]
+    path = os.path.join(mp3_dir, mp3_file)
+
+    (tag_bytes, length), fast_bytes = headers_and_bytes_read(path)
+    with open(path, "rb") as raw:
+        f = _CountingFile(raw)
+        audio = MP3(f)
+    assert length == pytest.approx(audio.info.length)
+    assert fast_bytes < f.bytes_read
+    assert fast_bytes < len(tag_bytes) + 100
+
+
+def test_fast_read_reads_on_for_a_lame_tag_after_padding(tmp_path):
+    # padding after the tag, then a Xing header with every optional field and a LAME tag
+    frames, delay, padding = 50, 576, 1000
+    xing = b"Xing" + (15).to_bytes(4, "big") + frames.to_bytes(4, "big") + bytes(4 + 100 + 4)
+    lame = b"LAME3.100" + bytes(12) + ((delay << 12) | padding).to_bytes(3, "big")
+    first_frame = MP3_FRAME_HEADER + bytes(32) + xing + lame
+    frame = MP3_FRAME_HEADER + bytes(MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+    path = str(tmp_path / "lame.mp3")
+    with open(path, "wb") as f:
+        f.write(bytes(300) + first_frame + bytes(MP3_FRAME_SIZE - len(first_frame)) + frame * (frames - 1))
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text="Title"))
+    tags.save(path)
+
+    (tag_bytes, length), _ = headers_and_bytes_read(path)
+    assert ID3(BytesIO(tag_bytes)).get("TIT2") == "Title"
+    assert length == pytest.approx((frames * 1152 - delay - padding) / 44100)
+
+
+@pytest.mark.parametrize("bad_header", [b"\xff\xfb\xf0\x00", b"\xff\xfb\x9c\x00"], ids=["bitrate", "sample rate"])
+def test_fast_read_skips_a_frame_sync_with_reserved_bits(tmp_path, bad_header):
+    # garbage after the tag with the sync bits, a reserved bitrate or sample rate index and a Xing header of its own
+    frames = 50
+    garbage = bad_header + bytes(32) + b"Xing" + (1).to_bytes(4, "big") + (9999).to_bytes(4, "big")
+    first_frame = MP3_FRAME_HEADER + bytes(32) + b"Xing" + (1).to_bytes(4, "big") + frames.to_bytes(4, "big")
+    frame = MP3_FRAME_HEADER + bytes(MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+    path = str(tmp_path / "garbage.mp3")
+    with open(path, "wb") as f:
+        f.write(garbage + bytes(20) + first_frame + bytes(MP3_FRAME_SIZE - len(first_frame)) + frame * (frames - 1))
+
+    (_, length), _ = headers_and_bytes_read(path)
+    assert length == pytest.approx(frames * 1152 / 44100)
+
+
+def test_fast_read_falls_back_to_mutagen_on_the_open_file(tmp_path, monkeypatch):
+    # no Xing header, as in a CBR file
+    Mp3Benchmarks().make_fixture_tree(str(tmp_path), files=1, frames=50, xing=0)
+    mp3_file, mp3_dir = Mp3Utils().list_mp3_files(str(tmp_path), recurse=1)[0]
+    expected = Mp3Utils().get_mp3_data(mp3_file, mp3_dir)
+
+    opened = []
+    monkeypatch.setattr("mp3_utils.MP3", lambda f: opened.append(f) or MP3(f))
+    assert Mp3Utils(fast_read=True).get_mp3_data(mp3_file, mp3_dir) == expected
+    assert len(opened) == 1 and not isinstance(opened[0], str)
+
+
+def test_tracks_from_the_db_have_every_tag(tmp_path):
+    library = tmp_path / "lib"
+    Mp3Benchmarks().make_fixture_tree(str(library), files=4, files_per_dir=2, frames=5)
+    album = str(library / sorted(os.listdir(library))[0])
+    db_path = str(tmp_path / "tracks.sqlite")
+
+    mp3_utils = Mp3Utils()
+    expected = sorted((mp3_utils.get_mp3_data(mp3_file, mp3_dir) for mp3_file, mp3_dir in mp3_utils.list_mp3_files(album)),
+                      key=lambda data: data["file"])
+    assert mp3_utils.get_mp3_data_from_db(album, db_path) == expected
+    # and again with the tags read back from the db rather than the files
+    assert mp3_utils.get_mp3_data_from_db(album, db_path) == expected
+    assert expected[0]["track"] == "1" and expected[0]["genre"] == "Rock" and expected[0]["year"] == "1999"
+
+
+def test_scan_from_the_db_only_recurses_if_asked(tmp_path):
+    library = tmp_path / "lib"
+    Mp3Benchmarks().make_fixture_tree(str(library), files=4, files_per_dir=2, frames=5)
+    db_path = str(tmp_path / "tracks.sqlite")
+
+    mp3_utils = Mp3Utils()
+    assert mp3_utils.get_mp3_data_from_db(str(library), db_path, recurse=1) != []
+    assert mp3_utils.scan_library(str(library), db_path, recurse=0) == {
+        "files": 0, "updated": 0, "unchanged": 0, "removed": 0, "errors": 0}
+    assert mp3_utils.get_mp3_data_from_db(str(library), db_path, recurse="0") == []
+    # the tracks in the album folders are still there
+    assert len(mp3_utils.get_mp3_data_from_db(str(library), db_path, recurse="1")) == 4
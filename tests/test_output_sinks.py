@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from output_sinks import ParquetSink
+
+
+def row(n):
+    return {"artist": "Artist", "title": f"Title {n}", "album": "Album", "mp3_duration": 200000,
+            "spotify_duration": 201000, "sp_id": f"id{n}", "sp_id2": "UNK", "score": 0.9,
+            "file": f"{n:02d}.mp3", "dir": "/music"}
+
+
+def test_parquet_resume_drops_stale_tmp_part(tmp_path):
+    path = str(tmp_path / "spotify.parquet")
+    sink = ParquetSink(path, batch_size=1)
+    sink.write(row(1))
+    sink.close()
+    # a run that stopped mid write
+    with open(os.path.join(path, "part-00001.parquet.tmp"), "wb") as f:
+        f.write(b"PAR1 partial")
+
+    sink = ParquetSink(path, resume=True, batch_size=1)
+    assert os.listdir(path) == ["part-00000.parquet"]
+    assert [r["sp_id"] for r in sink.written_rows()] == ["id1"]
+    sink.write(row(2))
+    sink.close()
+    assert sorted(os.listdir(path)) == ["part-00000.parquet", "part-00001.parquet"]
+    assert [r["sp_id"] for r in ParquetSink(path, resume=True).written_rows()] == ["id1", "id2"]
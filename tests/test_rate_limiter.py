@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limiter import LimitedSpotify, RateLimiter
+from spotify_client import build_session
+
+SEARCH_RESULT = {"tracks": {"items": [], "total": 0}}
+
+
+def test_every_caller_waits_out_retry_after(stub_server):
+    throttled = []
+
+    def handler(method, path, query, body):
+        # the first request is rate limited, for a second
+        if not throttled:
+            throttled.append(True)
+            return 429, {"Retry-After": "1"}, {"error": {"status": 429, "message": "API rate limit exceeded"}}
+        return 200, {}, SEARCH_RESULT
+
+    stub_server.handler = handler
+    limiter = RateLimiter(rate=100, burst=1)
+    sp = LimitedSpotify(stub_server.spotify(build_session()), limiter)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda i: sp.search(q=f"track:{i}", type="track"), range(8)))
+
+    times = [t for t, _, _, _ in stub_server.requests]
+    # one 429, then every caller (not just the one that got it) held off until Retry-After had passed
+    assert limiter.throttled == 1
+    assert len(times) == 9
+    assert all(t >= times[0] + 1 for t in times[1:])
+
+
+def test_spotipy_default_session_leaves_429s_to_the_limiter(stub_server):
+    responses = [(429, {"Retry-After": "0"}, {"error": {"status": 429, "message": "slow down"}}),
+                 (200, {}, SEARCH_RESULT)]
+    stub_server.handler = lambda method, path, query, body: responses.pop(0)
+    limiter = RateLimiter(rate=100, burst=10)
+    # spotipy's own session would retry the 429 inside urllib3, where the limiter never sees it
+    sp = LimitedSpotify(stub_server.spotify(), limiter)
+
+    assert sp.search(q="track:x", type="track") == SEARCH_RESULT
+    assert limiter.throttled == 1
+    assert len(stub_server.requests) == 2
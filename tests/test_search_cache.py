@@ -0,0 +1,74 @@
+import pytest
+
+from mp3_benchmarks import Mp3Benchmarks
+from mp3_spotify_utils import MP3SpotifyUtils
+from rate_limiter import LimitedSpotify, RateLimiter
+from search_cache import SearchCache
+import mp3_db
+from test_mp3_spotify_utils import FakeSearch
+
+
+@pytest.fixture
+def album(tmp_path):
+    Mp3Benchmarks().make_fixture_tree(str(tmp_path / "lib"), files=12, files_per_dir=12, frames=20)
+    return str(tmp_path / "lib" / "album_00000")
+
+
+def utils(sp, search_cache):
+    return MP3SpotifyUtils(sp=LimitedSpotify(sp, RateLimiter(rate=10000, burst=10000)), search_cache=search_cache)
+
+
+def result(track_id):
+    item = FakeSearch().search("track:Title")["tracks"]["items"][0]
+    return {"tracks": {"items": [dict(item, id=track_id)]}}
+
+
+def test_rerun_makes_no_searches(album, tmp_path):
+    cache_path = str(tmp_path / "cache.sqlite")
+    sp = FakeSearch()
+    cache = SearchCache(cache_path)
+    utils(sp, cache).mp3_to_spotify(album, outputs="csv", resume=0)
+    cache.close()
+    assert len(sp.searches) == 12
+
+    # starting over, every search is answered from the cache
+    sp.searches = []
+    cache = SearchCache(cache_path)
+    utils(sp, cache).mp3_to_spotify(album, outputs="csv", resume=0)
+    assert sp.searches == []
+    assert cache.stats() == {"hits": 12, "misses": 0}
+    cache.close()
+
+    # unless the cached results have expired
+    cache = SearchCache(cache_path, ttl_days=0)
+    utils(sp, cache).mp3_to_spotify(album, outputs="csv", resume=0)
+    assert len(sp.searches) == 12
+    cache.close()
+
+
+def test_cache_keys_ignore_case_and_spacing(tmp_path):
+    cache = SearchCache(str(tmp_path / "cache.sqlite"))
+    cache.put("artist:A  track:B", "GB", result("id1"))
+    assert cache.get("Artist:a track:b", "GB")["tracks"]["items"][0]["id"] == "id1"
+    assert cache.get("artist:a track:b", "US") is None
+    cache.close()
+
+
+def test_eviction_trims_to_max_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr("search_cache.EVICT_EVERY", 5)
+    cache_path = str(tmp_path / "cache.sqlite")
+    cache = SearchCache(cache_path, max_entries=3)
+    for i in range(5):
+        cache.put(f"track:{i}", "GB", result(f"id{i}"))
+
+    # the oldest go first
+    assert cache.conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0] == 3
+    assert cache.get("track:0", "GB") is None
+    assert cache.get("track:4", "GB")["tracks"]["items"][0]["id"] == "id4"
+
+    # and on close, whatever was added since the last pass
+    cache.put("track:5", "GB", result("id5"))
+    cache.close()
+    conn = mp3_db.optimize_db_connection(cache_path)
+    assert conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0] == 3
+    conn.close()
@@ -0,0 +1,37 @@
+import json
+import time
+
+from spotify_client import SharedTokenCache, legacy_token_cache_paths
+
+
+def token(scope):
+    return {"access_token": scope, "scope": scope, "expires_at": int(time.time()) + 3600}
+
+
+def test_token_from_spotipys_old_cache_is_copied_over(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("SPOTIPY_CLIENT_USERNAME", raising=False)
+    (tmp_path / ".cache-test").write_text(json.dumps(token("user-library-read playlist-modify-public")))
+    cache_path = str(tmp_path / "shared")
+
+    cache = SharedTokenCache(cache_path, legacy_token_cache_paths("test"), "playlist-modify-public")
+    assert cache.get_cached_token()["access_token"] == "user-library-read playlist-modify-public"
+    with open(cache_path, encoding="utf-8") as f:
+        assert json.load(f)["access_token"] == "user-library-read playlist-modify-public"
+
+
+def test_old_cache_covering_the_scope_is_used_over_a_narrower_shared_token(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("SPOTIPY_CLIENT_USERNAME", raising=False)
+    wide = "user-library-read playlist-modify-public playlist-modify-private"
+    (tmp_path / ".cache-test").write_text(json.dumps(token(wide)))
+    (tmp_path / "shared").write_text(json.dumps(token("user-library-read")))
+
+    cache = SharedTokenCache(str(tmp_path / "shared"), legacy_token_cache_paths("test"), wide)
+    assert cache.get_cached_token()["access_token"] == wide
+    # the shared token of the other scope is left alone
+    assert json.loads((tmp_path / "shared").read_text())["access_token"] == "user-library-read"
+
+    # with no old cache covering the scope the shared token is returned, for spotipy to ask again
+    cache = SharedTokenCache(str(tmp_path / "shared"), legacy_token_cache_paths("other"), wide)
+    assert cache.get_cached_token()["access_token"] == "user-library-read"
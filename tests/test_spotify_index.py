@@ -0,0 +1,52 @@
+from spotify_index import TrackIndex
+
+
+def track(track_id, artist, title, duration_ms=200000):
+    return {"id": track_id, "uri": f"spotify:track:{track_id}", "name": title, "popularity": 50,
+            "duration_ms": duration_ms, "artists": [{"name": artist}],
+            "album": {"name": "Album", "artists": [{"name": artist}]}}
+
+
+def seeded(tmp_path):
+    index = TrackIndex(str(tmp_path / "index.sqlite"))
+    index.add_items([track("sun", "The Beatles", "Here Comes The Sun"),
+                     track("yesterday", "The Beatles", "Yesterday"),
+                     track("wall", "Pink Floyd", "Another Brick In The Wall"),
+                     # saved tracks wrap the track object
+                     {"added_at": "2024-01-01T00:00:00Z", "track": track("roses", "Guns N' Roses", "Paradise City")},
+                     # local files have no id and aren't indexed
+                     {"id": None, "name": "local", "type": "track"}])
+    return index
+
+
+def test_exact_fuzzy_and_missed_lookups(tmp_path):
+    index = seeded(tmp_path)
+    assert len(index) == 4
+
+    # case and punctuation don't matter to an exact hit
+    assert [item["id"] for item in index.search("the beatles", "Here Comes the Sun!")] == ["sun"]
+    assert [item["id"] for item in index.search("Guns N Roses", "Paradise City")] == ["roses"]
+    # a near miss above the similarity threshold
+    assert [item["id"] for item in index.search("The Beatles", "Here Comes the Sun (Remastered)")] == ["sun"]
+    # too different, and unrelated
+    assert index.search("The Beatles", "Here Comes The Sun - Remastered 2009") == []
+    assert index.search("Metallica", "Enter Sandman") == []
+    assert index.stats() == {"hits": 3, "misses": 2}
+
+    item = index.search("Pink Floyd", "Another Brick In The Wall")[0]
+    assert item["uri"] == "spotify:track:wall" and item["duration_ms"] == 200000
+    index.close()
+
+
+def test_index_is_reloaded_from_the_db(tmp_path):
+    seeded(tmp_path).close()
+
+    index = TrackIndex(str(tmp_path / "index.sqlite"))
+    assert len(index) == 4
+    assert [item["id"] for item in index.search("Beatles", "Yesterday")] == ["yesterday"]
+    # tracks added after the index is built are searchable straight away
+    index.add_items([track("sandman", "Metallica", "Enter Sandman")])
+    assert len(index) == 5
+    assert [item["id"] for item in index.search("Metallica", "Enter Sandman")] == ["sandman"]
+    assert sorted(index.get(["sun", "sandman", "nope"])) == ["sandman", "sun"]
+    index.close()
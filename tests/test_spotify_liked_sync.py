@@ -0,0 +1,239 @@
+import pytest
+import spotipy
+
+from rate_limiter import LimitedSpotify, RateLimiter
+import spotify_liked_sync
+from sync_state import SyncState
+
+
+def track(i):
+    return {"uri": f"spotify:track:t{i}", "name": f"Track {i}", "artists": [{"name": "Artist"}]}
+
+
+class FakeSpotify(object):
+    """playlists held in memory, playlist_items raises for the offsets in fail_offsets"""
+    def __init__(self, tracks=()):
+        self.tracks = list(tracks)
+        self.snapshot = 1
+        self.fail_offsets = set()
+
+    def playlist(self, playlist_id, fields=None):
+        return {"snapshot_id": f"snap{self.snapshot}"}
+
+    def playlist_items(self, playlist_id, limit=100, offset=0, fields=None):
+        if offset in self.fail_offsets:
+            raise RuntimeError("connection reset")
+        return {"items": [{"track": t} for t in self.tracks[offset:offset + limit]], "total": len(self.tracks)}
+
+
+def test_failed_playlist_fetch_raises_and_stores_nothing(tmp_path):
+    sp = FakeSpotify([track(i) for i in range(250)])
+    sp.fail_offsets = {100}
+    state = SyncState(str(tmp_path / "state.sqlite"))
+
+    with pytest.raises(RuntimeError):
+        spotify_liked_sync.get_playlist_track_details(sp, "pl", state)
+    assert state.get_playlist("pl") == (None, {})
+
+    sp.fail_offsets = set()
+    details = spotify_liked_sync.get_playlist_track_details(sp, "pl", state)
+    assert len(details) == 250
+    assert state.get_playlist("pl")[0] == "snap1"
+
+
+class FakePlaylist(FakeSpotify):
+    """FakeSpotify whose add/remove calls fail as set up: bad URIs give 400, status fails every call, and
+    applied_status applies an add and then fails it"""
+    def __init__(self, tracks=()):
+        FakeSpotify.__init__(self, tracks)
+        self.bad_uris = set()
+        self.status = None
+        self.applied_status = None
+        self.calls = []
+
+    def playlist_add_items(self, playlist_id, uris):
+        self.calls.append(("add", list(uris)))
+        self._check(uris)
+        self.tracks += [{"uri": uri, "name": uri, "artists": []} for uri in uris]
+        self.snapshot += 1
+        if self.applied_status:
+            status, self.applied_status = self.applied_status, None
+            raise spotipy.SpotifyException(status, -1, "server error")
+        return {"snapshot_id": f"snap{self.snapshot}"}
+
+    def playlist_remove_all_occurrences_of_items(self, playlist_id, uris):
+        self.calls.append(("remove", list(uris)))
+        self._check(uris)
+        self.tracks = [t for t in self.tracks if t["uri"] not in uris]
+        self.snapshot += 1
+        return {"snapshot_id": f"snap{self.snapshot}"}
+
+    def _check(self, uris):
+        if self.status:
+            raise spotipy.SpotifyException(self.status, -1, "error")
+        if self.bad_uris & set(uris):
+            raise spotipy.SpotifyException(400, -1, "Invalid track uri")
+
+
+URIS = [f"spotify:track:n{i}" for i in range(100)]
+
+
+def test_bad_uri_splits_the_chunk():
+    sp = FakePlaylist()
+    sp.bad_uris = {URIS[37]}
+    results = spotify_liked_sync.write_chunk(sp, sp.playlist_add_items, "pl", URIS)
+
+    failed = [uri for chunk, _, error in results if error for uri in chunk]
+    assert failed == [URIS[37]]
+    assert sorted(t["uri"] for t in sp.tracks) == sorted(set(URIS) - {URIS[37]})
+    # halves down to the bad URI, about 2 * log2(100) calls rather than one per URI
+    assert len(sp.calls) <= 16
+
+
+@pytest.mark.parametrize("status", [401, 403, 404])
+def test_client_errors_raise_without_retrying(status):
+    sp = FakePlaylist()
+    sp.status = status
+    with pytest.raises(spotipy.SpotifyException):
+        spotify_liked_sync.write_chunk(sp, sp.playlist_add_items, "pl", URIS)
+    assert len(sp.calls) == 1
+
+
+def test_server_error_on_remove_fails_the_chunk_once():
+    sp = FakePlaylist()
+    sp.status = 500
+    results = spotify_liked_sync.write_chunk(sp, sp.playlist_remove_all_occurrences_of_items, "pl", URIS)
+    assert [(chunk, error is not None) for chunk, _, error in results] == [(URIS, True)]
+    assert len(sp.calls) == 1
+
+
+def test_add_that_went_through_is_not_sent_again():
+    sp = FakePlaylist()
+    sp.applied_status = 502
+    results = spotify_liked_sync.write_chunk(sp, sp.playlist_add_items, "pl", URIS)
+
+    assert [(chunk, result, error) for chunk, result, error in results] == [(URIS, {"snapshot_id": "snap2"}, None)]
+    assert len(sp.calls) == 1
+    assert len(sp.tracks) == 100
+
+
+def test_add_that_failed_sends_only_the_missing_tracks_once():
+    sp = FakePlaylist([{"uri": URIS[0], "name": "", "artists": []}])
+    sp.status = 500
+
+    results = spotify_liked_sync.write_chunk(sp, sp.playlist_add_items, "pl", URIS)
+    # the re-read found URIS[0], the other 99 were sent once more and failed again
+    assert [(chunk, error is None) for chunk, _, error in results] == [(URIS[:1], True), (URIS[1:], False)]
+    assert [len(uris) for _, uris in sp.calls] == [100, 99]
+
+
+def test_limiter_does_not_retry_server_errors_on_add():
+    sp = FakePlaylist()
+    sp.status = 500
+    limited = LimitedSpotify(sp, RateLimiter(rate=1000, burst=1000, base_backoff=0.001, max_backoff=0.001))
+
+    with pytest.raises(spotipy.SpotifyException):
+        limited.playlist_add_items("pl", URIS)
+    assert len(sp.calls) == 1
+
+    with pytest.raises(spotipy.SpotifyException):
+        limited.playlist_remove_all_occurrences_of_items("pl", URIS)
+    # removes are safe to repeat, 1 + max_retries calls
+    assert len(sp.calls) == 1 + 1 + limited.limiter.max_retries
+
+
+def test_removes_record_the_snapshot_id_of_the_last_remove(tmp_path):
+    sp = FakePlaylist([track(i) for i in range(250)])
+    state = SyncState(str(tmp_path / "state.sqlite"))
+    spotify_liked_sync.get_playlist_track_details(sp, "pl", state)
+    # someone else's edit after ours would show up in a snapshot_id read afterwards
+    sp.playlist = lambda playlist_id, fields=None: {"snapshot_id": "edited elsewhere"}
+
+    uris = [track(i)["uri"] for i in range(250)]
+    report = spotify_liked_sync.remove_tracks_from_playlist(sp, "pl", uris, {}, state, workers=2)
+    assert spotify_liked_sync.failed_uris(report) == []
+    # the last chunk went last, and its snapshot_id is the one stored
+    assert sp.calls[-1] == ("remove", uris[200:])
+    assert state.get_playlist("pl") == ("snap4", {})
+
+
+class FakeLiked(object):
+    """liked songs, newest first as Spotify returns them, counting the pages read"""
+    def __init__(self, count):
+        self.liked = [(f"2024-01-01T{i // 60:02d}:{i % 60:02d}:00Z", track(i)) for i in reversed(range(count))]
+        self.offsets = []
+
+    def like(self, i, added_at):
+        self.liked.insert(0, (added_at, track(i)))
+
+    def unlike(self, i):
+        self.liked = [(added_at, t) for added_at, t in self.liked if t["uri"] != track(i)["uri"]]
+
+    def current_user_saved_tracks(self, limit=20, offset=0):
+        self.offsets.append(offset)
+        page = self.liked[offset:offset + limit]
+        return {"items": [{"added_at": added_at, "track": t} for added_at, t in page], "total": len(self.liked),
+                "next": "more" if offset + limit < len(self.liked) else None}
+
+
+def sync_liked(sp, state, full=False):
+    sp.offsets = []
+    source = spotify_liked_sync.get_liked_source(sp, state, full)
+    spotify_liked_sync.save_liked_source(state, source)
+    return source
+
+
+def test_liked_songs_are_read_from_the_watermark(tmp_path):
+    sp = FakeLiked(120)
+    state = SyncState(str(tmp_path / "state.sqlite"))
+    # nothing stored yet, so everything is read
+    assert sync_liked(sp, state)["full"]
+    assert len(state.liked_added_at()) == 120
+
+    # nothing new is one page
+    source = sync_liked(sp, state)
+    assert not source["full"] and source["new"] == {} and sp.offsets == [0]
+    assert len(source["details"]) == 120
+
+    sp.like(200, "2024-01-03T00:00:00Z")
+    sp.like(201, "2024-01-03T00:00:01Z")
+    source = sync_liked(sp, state)
+    assert not source["full"] and sp.offsets == [0]
+    assert sorted(source["new"]) == [track(200)["uri"], track(201)["uri"]]
+
+    # a like in the same second as the newest known one is still new
+    sp.like(202, "2024-01-03T00:00:01Z")
+    source = sync_liked(sp, state)
+    assert list(source["new"]) == [track(202)["uri"]]
+    assert len(state.liked_added_at()) == 123
+
+    # more new likes than fit in a page
+    for i in range(300, 360):
+        sp.like(i, f"2024-01-04T00:00:{i - 300:02d}Z")
+    source = sync_liked(sp, state)
+    assert not source["full"] and sp.offsets == [0, 50]
+    assert len(source["new"]) == 60 and len(source["details"]) == 183
+
+
+def test_unliked_song_forces_a_full_read(tmp_path):
+    sp = FakeLiked(30)
+    state = SyncState(str(tmp_path / "state.sqlite"))
+    sync_liked(sp, state)
+
+    # one unliked and one liked keep Spotify's count the same, but not the count of the snapshot plus the new one
+    sp.unlike(5)
+    sp.like(100, "2024-01-03T00:00:00Z")
+    source = sync_liked(sp, state)
+    assert source["full"]
+    assert track(5)["uri"] not in source["details"] and track(100)["uri"] in source["details"]
+    assert track(5)["uri"] not in state.liked_added_at()
+
+
+def test_full_sync_reads_everything(tmp_path):
+    sp = FakeLiked(120)
+    state = SyncState(str(tmp_path / "state.sqlite"))
+    sync_liked(sp, state)
+
+    source = sync_liked(sp, state, full=True)
+    assert source["full"] and len(source["details"]) == 120
+    assert sorted(sp.offsets) == [0, 50, 100]
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from spotify_paging import fetch_all_pages, fetch_by_ids
+
+
+class FakePages(object):
+    """paged endpoint over total items, later pages answer sooner so they finish out of order"""
+    def __init__(self, total, report_total=True):
+        self.total = total
+        self.report_total = report_total
+        self.offsets = []
+        self._lock = threading.Lock()
+
+    def __call__(self, limit, offset):
+        with self._lock:
+            self.offsets.append(offset)
+        time.sleep(max(0, 0.05 - offset * 0.0005))
+        page = {"items": [{"n": n} for n in range(offset, min(offset + limit, self.total))]}
+        if self.report_total:
+            page["total"] = self.total
+        return page
+
+
+def test_concurrent_pages_are_returned_in_offset_order():
+    pages = FakePages(230)
+    items = fetch_all_pages(pages, limit=20, workers=4)
+    assert [item["n"] for item in items] == list(range(230))
+    assert sorted(pages.offsets) == list(range(0, 230, 20))
+    # the first page alone, then the rest at once
+    assert pages.offsets[0] == 0
+
+
+def test_pages_are_walked_one_at_a_time_without_a_total():
+    pages = FakePages(45, report_total=False)
+    items = fetch_all_pages(pages, limit=20, workers=4)
+    assert [item["n"] for item in items] == list(range(45))
+    # until an empty page
+    assert pages.offsets == [0, 20, 40, 60]
+
+    # a short first page is all there is
+    pages = FakePages(5, report_total=False)
+    assert len(fetch_all_pages(pages, limit=20)) == 5
+    assert pages.offsets == [0]
+
+
+def test_fetch_by_ids_dedupes_and_batches_at_50():
+    batches = []
+    lock = threading.Lock()
+
+    def tracks(batch):
+        with lock:
+            batches.append(list(batch))
+        # unknown ids come back as None, in place
+        return {"tracks": [None if track_id.startswith("gone") else {"id": track_id} for track_id in batch]}
+
+    ids = [f"id{n}" for n in range(120)] + [f"id{n}" for n in range(60)] + ["gone1"]
+    items = fetch_by_ids(tracks, ids)
+
+    assert sorted(len(batch) for batch in batches) == [21, 50, 50]
+    assert sorted(sum(batches, [])) == sorted(set(ids))
+    assert items["gone1"] is None
+    assert all(items[track_id]["id"] == track_id for track_id in ids if track_id != "gone1")
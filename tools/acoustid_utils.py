@@ -1,9 +1,50 @@
 
+# expects env var ACOUSTID_KEY=<>
+# and optionally ACOUSTID_API_URL=<base url of the AcoustID web service, e.g. a local stand-in server, ending in />
+
+from concurrent.futures import ProcessPoolExecutor
 import acoustid
+import gzip
 import os
 import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
 
 from utils import Utils
+from mp3_utils import Mp3Utils
+import audio_duplicates
+import metrics
+import mp3_db
+
+# the AcoustID web service, unless ACOUSTID_API_URL is set
+API_URL = 'https://api.acoustid.org/v2/'
+
+# fingerprints sent per lookup request
+LOOKUP_BATCH_SIZE = 20
+
+# AcoustID allows 3 requests/sec per client
+LOOKUP_INTERVAL = 1 / 3
+
+# (connect, read) timeouts of a lookup request in seconds
+LOOKUP_TIMEOUT = (5, 60)
+
+# fingerprints written to the db at a time while a directory is being fingerprinted
+FINGERPRINT_COMMIT_EVERY = 100
+
+
+def _fingerprint_file(file_path):
+    """(duration, fingerprint, None) or (None, None, error) for a file, run in a worker process"""
+    try:
+        duration, fingerprint = acoustid.fingerprint_file(file_path)
+    except Exception as e:
+        return None, None, str(e)
+    if isinstance(fingerprint, bytes):
+        fingerprint = fingerprint.decode('ascii')
+    return duration, fingerprint, None
+
 
 class AcoustidUtils(Utils):
     """    Various MP3 utils    """
@@ -11,6 +52,14 @@ class AcoustidUtils(Utils):
         Utils.__init__(self)
 
         self.api_key = os.environ['ACOUSTID_KEY']
+        self.api_url = os.environ.get('ACOUSTID_API_URL') or API_URL
+        if os.environ.get('ACOUSTID_API_URL'):
+            acoustid.set_base_url(os.environ['ACOUSTID_API_URL'])
+
+        # batched lookups go straight to the web service (pyacoustid only looks up one fingerprint per call)
+        self._session = requests.Session()
+        self._lookup_lock = threading.Lock()
+        self._last_lookup = 0.0
 
     def get_acoustid_and_match(self, file_path):
         """get acoustid details for an mp3 file"""
@@ -31,6 +80,141 @@ class AcoustidUtils(Utils):
 
         rec_match = self._get_best_recording_match(results)
 
+    def fingerprint_dir(self, directory, db_path, recurse=1, processes=0, lookup=1):
+        """fingerprint all mp3s in directory (and sub directories if recurse) on a process pool, caching fingerprints
+           in the db by path/size/mtime so re-runs only decode new or changed files, then look up unmatched
+           fingerprints in batches (lookup=0 to skip)"""
+
+        directory = os.path.abspath(directory)
+        processes = int(processes) or os.cpu_count()
+        conn = mp3_db.optimize_db_connection(db_path)
+        mp3_db.create_fingerprint_schema(conn)
+
+        known = mp3_db.get_fingerprint_stats(conn, directory)
+        if not int(recurse):
+            # files in sub directories aren't scanned, so they mustn't be taken as removed
+            known = {path: stat for path, stat in known.items() if os.path.dirname(path) == directory}
+        to_fingerprint = []
+        files = 0
+        for entry in Mp3Utils()._scan_mp3_entries(directory, int(recurse)):
+            files += 1
+            stat = entry.stat()
+            if known.pop(entry.path, None) != (stat.st_size, stat.st_mtime):
+                to_fingerprint.append((entry.path, stat.st_size, stat.st_mtime))
+
+        # anything left in known was not found on disk, so it can't turn up in find_duplicates
+        removed = list(known)
+        if removed:
+            mp3_db.delete_fingerprints(conn, removed)
+
+        metrics.count("fingerprint_cache", files - len(to_fingerprint), result="hit")
+        metrics.count("fingerprint_cache", len(to_fingerprint), result="miss")
+        errors = 0
+        rows = []
+        paths = [path for path, _, _ in to_fingerprint]
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for (path, size, mtime), (duration, fingerprint, error) in zip(
+                    to_fingerprint, pool.map(_fingerprint_file, paths, chunksize=4)):
+                if error:
+                    print(f"Error fingerprinting {path}: {error}")
+                    errors += 1
+                    continue
+                rows.append((path, size, mtime, duration, fingerprint))
+                if len(rows) >= FINGERPRINT_COMMIT_EVERY:
+                    mp3_db.upsert_fingerprints(conn, rows)
+                    rows = []
+        mp3_db.upsert_fingerprints(conn, rows)
+
+        summary = {"files": files, "fingerprinted": len(to_fingerprint) - errors,
+                   "cached": files - len(to_fingerprint), "removed": len(removed), "errors": errors}
+        if int(lookup):
+            summary.update(self.lookup_dir(directory, db_path))
+        conn.close()
+        return summary
+
+    def lookup_dir(self, directory, db_path, refresh=0):
+        """look up the cached fingerprints of files under directory on AcoustID, LOOKUP_BATCH_SIZE per request,
+           storing the best recording of each (refresh=1 to look up already looked up files again)"""
+
+        conn = mp3_db.optimize_db_connection(db_path)
+        mp3_db.create_fingerprint_schema(conn)
+        pending = mp3_db.get_fingerprints(conn, os.path.abspath(directory), unmatched_only=not int(refresh))
+
+        matched = lookups = 0
+        for i in range(0, len(pending), LOOKUP_BATCH_SIZE):
+            batch = pending[i:i + LOOKUP_BATCH_SIZE]
+            with metrics.timer("acoustid_lookup"):
+                responses = self.lookup_batch([(duration, fingerprint) for _, duration, fingerprint in batch])
+            lookups += 1
+
+            looked_up_at = time.time()
+            matches = []
+            for (path, _, _), results in zip(batch, responses):
+                match = self._best_recording(results)
+                matched += match[0] is not None
+                matches.append(match + (looked_up_at, path))
+            mp3_db.set_fingerprint_matches(conn, matches)
+        conn.close()
+        return {"looked_up": len(pending), "matched": matched, "lookup_requests": lookups}
+
+    def lookup_batch(self, fingerprints):
+        """
+        Look up [(duration, fingerprint)] in one request, returns the list of results per fingerprint, in order.
+        """
+        params = {"format": "json", "client": self.api_key, "meta": " ".join(acoustid.DEFAULT_META)}
+        for i, (duration, fingerprint) in enumerate(fingerprints):
+            params[f"duration.{i}"] = int(duration)
+            params[f"fingerprint.{i}"] = fingerprint
+
+        response = self._post("lookup", params)
+        if response.get('status') != 'ok':
+            raise acoustid.WebServiceError(f"status: {response.get('status')} {response.get('error')}")
+
+        results = [[] for _ in fingerprints]
+        for item in response.get('fingerprints', []):
+            results[int(item['index'])] = item.get('results', [])
+        return results
+
+    def _post(self, endpoint, params):
+        """POST gzipped form params to an endpoint of the web service, keeping to LOOKUP_INTERVAL between requests,
+           returns the parsed JSON response"""
+        with self._lookup_lock:
+            wait = self._last_lookup + LOOKUP_INTERVAL - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_lookup = time.monotonic()
+
+        # a batch of fingerprints is tens of KB of base64, which compresses well
+        body = gzip.compress(urlencode(params).encode('ascii'))
+        headers = {"Content-Type": "application/x-www-form-urlencoded", "Content-Encoding": "gzip",
+                   "Accept-Encoding": "gzip"}
+        try:
+            response = self._session.post(self.api_url + endpoint, data=body, headers=headers, timeout=LOOKUP_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            raise acoustid.WebServiceError(f"HTTP request failed: {e}")
+        try:
+            return response.json()
+        except ValueError:
+            raise acoustid.WebServiceError(f"response is not valid JSON (HTTP {response.status_code})")
+
+    def find_duplicates(self, directory, db_path, min_similarity=audio_duplicates.DEFAULT_MIN_SIMILARITY):
+        """list clusters of files with the same audio under directory, from fingerprints cached by fingerprint_dir,
+           the first of each is the one kept for spotify matching"""
+
+        clusters = audio_duplicates.duplicate_clusters(db_path, os.path.abspath(directory), min_similarity)
+        for cluster in clusters:
+            print("~".join(cluster))
+        return {"clusters": len(clusters), "duplicates": sum(len(cluster) - 1 for cluster in clusters)}
+
+    def _best_recording(self, results):
+        """(acoustid, recording_id, title, artist) of the best result with a recording, Nones if there is none"""
+        for result in results:
+            if result.get('recordings'):
+                recording = result['recordings'][0]
+                artists = recording.get('artists') or [{}]
+                return result['id'], recording['id'], recording.get('title'), artists[0].get('name')
+        return None, None, None, None
+
     def _get_best_recording_match(self, results):
         
         # Get the best AcoustID match (usually the first result)
@@ -0,0 +1,168 @@
+""" Duplicate audio detection over chromaprint fingerprints (as cached by AcoustidUtils.fingerprint_dir)
+    Fingerprints are decoded to arrays of 32 bit sub-fingerprints and compared by Hamming distance (popcount of xor).
+    Candidate pairs come from an LSH style index of the upper 16 bits of sub-fingerprints, bucketed by duration,
+    so only files that already look alike are compared rather than every pair.
+"""
+
+import base64
+from collections import Counter
+
+import numpy as np
+
+import mp3_db
+
+# sub-fingerprints compared per file (about 8 per second, so ~30 secs), also bounds memory at 100k+ files
+COMPARE_WORDS = 240
+
+# sub-fingerprints from the start of each file used as index keys
+INDEX_WORDS = 120
+
+# most shift (in sub-fingerprints) between two encodes of the same audio that is tried when comparing
+MAX_OFFSET = 8
+
+# durations (secs) within one bucket width of each other are candidates
+DURATION_BUCKET = 2
+
+# candidates must share this many index keys before being compared
+MIN_SHARED_KEYS = 2
+
+# keys shared by more files than this (silence, etc) say nothing and are skipped
+MAX_KEY_FILES = 200
+
+# 1 - bit error rate over the compared part, re-encodes of one recording usually score above 0.85, unrelated audio ~0.5
+DEFAULT_MIN_SIMILARITY = 0.8
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    _BYTE_BITS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words):
+        return _BYTE_BITS[words.view(np.uint8)].reshape(words.shape + (4,)).sum(axis=-1)
+
+
+def decode_fingerprint(encoded):
+    """
+    Sub-fingerprints (uint32 array) of a compressed chromaprint fingerprint, as returned by fpcalc/fingerprint_file.
+
+    The format is a 4 byte header (algorithm, 24 bit count), then for each sub-fingerprint xor'd with the previous
+    one the gaps between its set bits as 3 bit values ending in 0, with gaps of 7+ continued as 5 bit values
+    after all the 3 bit ones. Decoded here with numpy so libchromaprint isn't needed.
+    """
+    if isinstance(encoded, bytes):
+        encoded = encoded.decode("ascii")
+    data = np.frombuffer(base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)), dtype=np.uint8)
+    count = (int(data[1]) << 16) | (int(data[2]) << 8) | int(data[3])
+    if count == 0:
+        return np.zeros(0, dtype=np.uint32)
+
+    bits = np.unpackbits(data[4:], bitorder="little")
+    normal = bits[:len(bits) - len(bits) % 3].reshape(-1, 3) @ np.array([1, 2, 4])
+    # the 3 bit values end at the count'th 0
+    ends = np.flatnonzero(normal == 0)
+    normal = normal[:ends[count - 1] + 1]
+
+    exceptional_at = np.flatnonzero(normal == 7)
+    if len(exceptional_at):
+        start = (len(normal) * 3 + 7) // 8 * 8
+        exceptional = bits[start:start + len(exceptional_at) * 5].reshape(-1, 5) @ np.array([1, 2, 4, 8, 16])
+        normal[exceptional_at] += exceptional
+
+    # bit positions are running sums of the gaps within each sub-fingerprint
+    word = np.concatenate(([0], np.cumsum(normal == 0)[:-1]))
+    positions = np.cumsum(normal)
+    positions -= np.concatenate(([0], positions[normal == 0]))[word]
+    set_bits = normal != 0
+
+    word = word[set_bits]
+    values = np.left_shift(np.uint32(1), (positions[set_bits] - 1).astype(np.uint32))
+
+    # words are in order, so each one's bits can be or'ed together in one pass
+    xors = np.zeros(count, dtype=np.uint32)
+    if len(word):
+        starts = np.flatnonzero(np.concatenate(([True], word[1:] != word[:-1])))
+        xors[word[starts]] = np.bitwise_or.reduceat(values, starts)
+    return np.bitwise_xor.accumulate(xors)
+
+
+def similarity(a, b, max_offset=MAX_OFFSET):
+    """1 - the lowest bit error rate of sub-fingerprint arrays a and b over shifts of up to max_offset"""
+    best = 0.0
+    for offset in range(-max_offset, max_offset + 1):
+        x = a[max(0, offset):]
+        y = b[max(0, -offset):]
+        n = min(len(x), len(y))
+        # too little overlap to say anything
+        if n < min(len(a), len(b)) // 2 or n == 0:
+            continue
+        errors = int(_popcount(x[:n] ^ y[:n]).sum())
+        best = max(best, 1 - errors / (n * 32))
+    return best
+
+
+def find_duplicates(fingerprints, min_similarity=DEFAULT_MIN_SIMILARITY):
+    """
+    Group [(key, duration, encoded fingerprint)] into clusters of the same audio.
+
+    Returns a list of clusters (lists of keys, in input order) with more than one member.
+    """
+    keys = []
+    durations = []
+    words = []
+    for key, duration, encoded in fingerprints:
+        keys.append(key)
+        durations.append(duration)
+        words.append(decode_fingerprint(encoded)[:COMPARE_WORDS])
+
+    # index (duration bucket, upper 16 bits of a sub-fingerprint) -> files
+    index = {}
+    file_keys = []
+    for i, (duration, subs) in enumerate(zip(durations, words)):
+        bucket = int(duration // DURATION_BUCKET)
+        grams = {(bucket, int(value)) for value in np.unique(subs[:INDEX_WORDS] >> 16)}
+        file_keys.append(grams)
+        for gram in grams:
+            index.setdefault(gram, []).append(i)
+
+    parent = list(range(len(keys)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, grams in enumerate(file_keys):
+        candidates = []
+        for bucket, value in grams:
+            # neighbouring buckets too, so durations either side of a bucket edge still meet
+            for near in (bucket - 1, bucket, bucket + 1):
+                files = index.get((near, value))
+                if files and len(files) <= MAX_KEY_FILES:
+                    candidates.extend(files)
+        shared = Counter(candidates)
+
+        for j, count in shared.items():
+            # each pair once, and only if already apart
+            if j <= i or count < MIN_SHARED_KEYS or abs(durations[i] - durations[j]) > DURATION_BUCKET:
+                continue
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j and similarity(words[i], words[j]) >= min_similarity:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    clusters = {}
+    for i in range(len(keys)):
+        clusters.setdefault(find(i), []).append(keys[i])
+    return [cluster for cluster in clusters.values() if len(cluster) > 1]
+
+
+def duplicate_clusters(db_path, directory, min_similarity=DEFAULT_MIN_SIMILARITY):
+    """clusters of duplicate files under directory from the fingerprints in the db, largest file
+       (usually the highest bitrate) first as the cluster's representative"""
+    conn = mp3_db.optimize_db_connection(db_path)
+    mp3_db.create_fingerprint_schema(conn)
+    stats = mp3_db.get_fingerprint_stats(conn, directory)
+    clusters = find_duplicates(mp3_db.get_fingerprints(conn, directory), float(min_similarity))
+    conn.close()
+    return [sorted(cluster, key=lambda path: (-(stats[path][0] or 0), path)) for cluster in clusters]
+
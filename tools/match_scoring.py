@@ -0,0 +1,126 @@
+""" Scoring of Spotify search candidates against a local track, one at a time or in batches"""
+
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+import numpy as np
+
+try:
+    from rapidfuzz.distance import Indel
+except ImportError:
+    Indel = None
+
+# weights of each term in the score
+TITLE_WEIGHT = 0.4
+ARTIST_WEIGHT = 0.3
+DURATION_WEIGHT = 0.2
+POPULARITY_WEIGHT = 0.1
+
+
+def score_candidates(title, artist, duration, results):
+    """score each search result against title/artist/duration (secs), return {"match_id", "score"} of the best"""
+
+    duration_ms = duration * 1000
+
+    # Score and rank the results
+    scored_results = []
+    for track in results['tracks']['items']:
+        score = 0
+        # Title similarity (0-1)
+        title_similarity = SequenceMatcher(None, title.lower(), track['name'].lower()).ratio()
+        score += title_similarity * TITLE_WEIGHT
+
+        # Artist similarity (0-1)
+        artist_similarity = SequenceMatcher(None, artist.lower(), track['artists'][0]['name'].lower()).ratio()
+        score += artist_similarity * ARTIST_WEIGHT
+
+        # Duration similarity (0-1), nothing to compare against if the local duration is unknown (0)
+        duration_diff = abs(duration_ms - track['duration_ms'])
+        duration_similarity = max(0, 1 - (duration_diff / duration_ms)) if duration_ms > 0 else 0.0
+        score += duration_similarity * DURATION_WEIGHT
+
+        # Popularity (0-1)
+        popularity = track['popularity'] / 100
+        score += popularity * POPULARITY_WEIGHT
+
+        scored_results.append((score, track))
+
+    # Sort by score (highest first)
+    scored_results.sort(reverse=True, key=lambda x: x[0])
+
+    # Return the best match
+    best_match = scored_results[0][1]
+    return {"match_id": best_match['id'], "score": round(scored_results[0][0],1)}
+
+
+@lru_cache(maxsize=200000)
+def _ratio(a, b):
+    # the same local artist is compared with the same candidate artists over and over across an album
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def _indel_ratio(a, b):
+    return Indel.normalized_similarity(a, b)
+
+
+def score_batch(queries, similarity="ratio"):
+    """
+    Score many (title, artist, duration, results) queries at once, returning a
+    {"match_id", "score"} (or None if a query has no results) per query, in order.
+
+    Duration and popularity terms are computed as arrays over every candidate of every query.
+    similarity="ratio" gives the same scores as score_candidates, "indel" uses rapidfuzz's normalized
+    indel distance, which is much faster but can rank near ties differently.
+    """
+    if similarity == "indel":
+        if Indel is None:
+            raise ImportError("similarity='indel' needs the rapidfuzz package")
+        string_similarity = _indel_ratio
+    else:
+        string_similarity = _ratio
+
+    # flatten every candidate of every query, remembering where each query's candidates start
+    title_sims = []
+    artist_sims = []
+    local_ms = []
+    candidate_ms = []
+    popularity = []
+    ids = []
+    bounds = []
+    for title, artist, duration, results in queries:
+        items = results['tracks']['items']
+        start = len(ids)
+        title_lower = title.lower()
+        artist_lower = artist.lower()
+        for track in items:
+            title_sims.append(string_similarity(title_lower, track['name'].lower()))
+            artist_sims.append(string_similarity(artist_lower, track['artists'][0]['name'].lower()))
+            local_ms.append(duration * 1000)
+            candidate_ms.append(track['duration_ms'])
+            popularity.append(track['popularity'])
+            ids.append(track['id'])
+        bounds.append((start, len(ids)))
+
+    if not ids:
+        return [None] * len(bounds)
+
+    local_ms = np.array(local_ms, dtype=np.float64)
+    duration_diff = np.abs(local_ms - np.array(candidate_ms, dtype=np.float64))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        duration_sims = np.where(local_ms > 0, np.maximum(0, 1 - duration_diff / local_ms), 0.0)
+
+    # same order of operations as score_candidates, so the floats come out identical
+    scores = np.array(title_sims) * TITLE_WEIGHT
+    scores += np.array(artist_sims) * ARTIST_WEIGHT
+    scores += duration_sims * DURATION_WEIGHT
+    scores += (np.array(popularity, dtype=np.float64) / 100) * POPULARITY_WEIGHT
+
+    matches = []
+    for start, end in bounds:
+        if start == end:
+            matches.append(None)
+            continue
+        # argmax picks the first of equal scores, as the stable sort in score_candidates does
+        best = start + int(np.argmax(scores[start:end]))
+        matches.append({"match_id": ids[best], "score": round(float(scores[best]), 1)})
+    return matches
@@ -0,0 +1,177 @@
+""" Per-stage timers and counters for the hot paths (tag reads, searches, scoring, paging, playlist writes, db writes),
+    reported as a JSON summary or in the Prometheus text format
+    optionally expects env var PY_SPOTIFY_METRICS=<path to write the metrics to when the process exits, Prometheus text
+    format if it ends in .prom (e.g. for the node_exporter textfile collector), else JSON, - for JSON on stdout>
+    timings made inside process pool workers stay in those processes, only the parent's are reported
+"""
+
+import atexit
+from bisect import bisect_left
+from contextlib import contextmanager
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+# upper bounds (secs) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# prefix of every metric name in the Prometheus output
+PROMETHEUS_PREFIX = "py_spotify"
+
+METRICS_PATH = os.environ.get('PY_SPOTIFY_METRICS')
+
+
+class Metrics(object):
+    """thread safe stage latency histograms and event counters, stages and counters keyed by name and labels"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.started = time.time()
+
+        self._lock = threading.Lock()
+        # (stage, labels) -> [count, errors, total secs, max secs, per bucket counts (the last is +Inf)]
+        self._stages = {}
+        # (name, labels) -> count
+        self._counters = {}
+
+    def observe(self, stage, seconds, error=False, **labels):
+        """record one timing of stage"""
+        key = (stage, tuple(sorted(labels.items())))
+        with self._lock:
+            stats = self._stages.get(key)
+            if stats is None:
+                stats = self._stages[key] = [0, 0, 0.0, 0.0, [0] * (len(self.buckets) + 1)]
+            stats[0] += 1
+            stats[1] += error
+            stats[2] += seconds
+            stats[3] = max(stats[3], seconds)
+            stats[4][bisect_left(self.buckets, seconds)] += 1
+
+    def count(self, name, value=1, **labels):
+        """add value to the counter name"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """time the with block as one call of stage, counting it as an error if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(stage, time.perf_counter() - start, True, **labels)
+            raise
+        self.observe(stage, time.perf_counter() - start, **labels)
+
+    def timed(self, stage):
+        """decorator timing every call of a function as stage"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+            self.started = time.time()
+
+    def summary(self):
+        """dict of every stage (calls, errors, total/mean/max time and latency histogram) and counter"""
+        with self._lock:
+            stages = {key: (count, errors, total, worst, list(buckets))
+                      for key, (count, errors, total, worst, buckets) in self._stages.items()}
+            counters = dict(self._counters)
+
+        summary = {"elapsed_secs": round(time.time() - self.started, 3), "stages": {}, "counters": {}}
+        for (stage, labels), (count, errors, total, worst, buckets) in sorted(stages.items()):
+            bounds = [f"le_{bound:g}" for bound in self.buckets] + ["le_inf"]
+            summary["stages"][_key_name(stage, labels)] = {
+                "calls": count, "errors": errors, "total_secs": round(total, 6),
+                "mean_ms": round(total / count * 1000, 3), "max_ms": round(worst * 1000, 3),
+                "histogram": {bound: n for bound, n in zip(bounds, buckets) if n}}
+        for (name, labels), value in sorted(counters.items()):
+            summary["counters"][_key_name(name, labels)] = value
+        return summary
+
+    def prometheus(self, prefix=PROMETHEUS_PREFIX):
+        """the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            stages = {key: (count, errors, total, list(buckets))
+                      for key, (count, errors, total, _, buckets) in self._stages.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        if stages:
+            name = f"{prefix}_stage_seconds"
+            lines += [f"# HELP {name} Time spent per call of each stage.", f"# TYPE {name} histogram"]
+            for (stage, labels), (count, _, total, buckets) in sorted(stages.items()):
+                labels = (("stage", stage),) + labels
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float("inf"),), buckets):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+
+            name = f"{prefix}_stage_errors_total"
+            lines += [f"# HELP {name} Calls of each stage that raised.", f"# TYPE {name} counter"]
+            for (stage, labels), (_, errors, _, _) in sorted(stages.items()):
+                lines.append(f"{name}{_labels((('stage', stage),) + labels)} {errors}")
+
+        names = sorted({name for name, _ in counters})
+        for counter in names:
+            name = f"{prefix}_{counter}_total"
+            lines += [f"# TYPE {name} counter"]
+            for (key, labels), value in sorted(counters.items()):
+                if key == counter:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """write the metrics to path (Prometheus text format if it ends in .prom, else JSON), - for JSON on stdout"""
+        if path == "-":
+            print(json.dumps(self.summary(), indent=2))
+            return
+        text = self.prometheus() if path.endswith(".prom") else json.dumps(self.summary(), indent=2) + "\n"
+        # written under a temporary name first, so a scraper never reads a half written file
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+
+def _key_name(name, labels):
+    return name + _labels(labels) if labels else name
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+# the metrics used by default, so every module in the process reports into one summary
+default_metrics = Metrics()
+
+timer = default_metrics.timer
+timed = default_metrics.timed
+count = default_metrics.count
+
+
+def _write_at_exit():
+    try:
+        default_metrics.write(METRICS_PATH)
+    except OSError as e:
+        print(f"Error writing metrics to {METRICS_PATH}: {e}", file=sys.stderr)
+
+
+if METRICS_PATH:
+    atexit.register(_write_at_exit)
@@ -0,0 +1,314 @@
+""" Benchmarks for the mp3 scanning code, run against a generated tree of small mp3 files"""
+
+import datetime
+from io import BytesIO
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from mutagen.id3 import ID3, TALB, TCON, TIT2, TPE1, TRCK, TYER
+from mutagen.mp3 import MP3
+
+from utils import Utils
+import mp3_db
+from match_scoring import score_batch, score_candidates
+from mp3_utils import Mp3Utils, TrackRecord, read_mp3_headers
+
+# MPEG1 layer III, 128kbps, 44.1kHz, no padding -> 417 byte frames
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x00"
+MP3_FRAME_SIZE = 417
+
+
+class Mp3Benchmarks(Utils):
+    """    Benchmarks for mp3 utils    """
+    def __init__(self):
+        Utils.__init__(self)
+
+        self.mp3_utils = Mp3Utils()
+
+    def make_fixture_tree(self, directory, files=1000, files_per_dir=20, frames=200, xing=1):
+        """write a tree of tagged mp3 files (files_per_dir per album folder) for benchmarking, optionally with a Xing header"""
+
+        files = int(files)
+        files_per_dir = int(files_per_dir)
+        frames = int(frames)
+        frame = MP3_FRAME_HEADER + bytes(MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+        audio = frame * frames
+        if int(xing):
+            # Xing header sits after the 32 bytes of side info in an MPEG1 stereo frame, with the frame count flag set
+            xing_header = b"Xing" + (1).to_bytes(4, "big") + frames.to_bytes(4, "big")
+            first_frame = MP3_FRAME_HEADER + bytes(32) + xing_header
+            audio = first_frame + bytes(MP3_FRAME_SIZE - len(first_frame)) + frame * (frames - 1)
+
+        for i in range(files):
+            album_dir = os.path.join(directory, f"album_{i // files_per_dir:05d}")
+            os.makedirs(album_dir, exist_ok=True)
+            path = os.path.join(album_dir, f"track_{i:06d}.mp3")
+            with open(path, "wb") as f:
+                f.write(audio)
+
+            tags = ID3()
+            tags.add(TIT2(encoding=3, text=f"Title {i}"))
+            tags.add(TPE1(encoding=3, text=f"Artist {i // files_per_dir}"))
+            tags.add(TALB(encoding=3, text=f"Album {i // files_per_dir}"))
+            tags.add(TRCK(encoding=3, text=str(i % files_per_dir + 1)))
+            tags.add(TCON(encoding=3, text="Rock"))
+            tags.add(TYER(encoding=3, text="1999"))
+            tags.save(path)
+
+        return directory
+
+    def benchmark_scan(self, files=2000, workers=8, directory=None):
+        """compare serial, thread pool and process pool tag reading on a generated (or given) tree"""
+
+        workers = int(workers)
+        tmp_dir = None
+        if not directory:
+            tmp_dir = tempfile.mkdtemp(prefix="mp3_bench_")
+            directory = self.make_fixture_tree(tmp_dir, files)
+
+        try:
+            mp3_files = self.mp3_utils.list_mp3_files(directory, 1)
+            results = {}
+
+            start = time.perf_counter()
+            for mp3_file, mp3_dir in mp3_files:
+                self.mp3_utils.get_mp3_data(mp3_file, mp3_dir)
+            results["serial"] = time.perf_counter() - start
+
+            for mode, processes in (("threads", 0), ("processes", 1)):
+                start = time.perf_counter()
+                data, errors = self.mp3_utils.get_mp3_data_parallel(mp3_files, workers, processes)
+                results[f"{mode}({workers})"] = time.perf_counter() - start
+
+            for mode, elapsed in results.items():
+                print(f"{mode}: {len(mp3_files)} files in {elapsed:.2f}s, {len(mp3_files) / elapsed:.0f} files/s")
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir)
+
+    def benchmark_fast_read(self, files=2000, directory=None):
+        """compare bytes read per file and files/s of the full mutagen parse and the header only reader"""
+
+        tmp_dir = None
+        if not directory:
+            tmp_dir = tempfile.mkdtemp(prefix="mp3_bench_")
+            directory = self.make_fixture_tree(tmp_dir, files)
+
+        try:
+            paths = [os.path.join(mp3_dir, mp3_file) for mp3_file, mp3_dir in self.mp3_utils.iter_mp3_files(directory, 1)]
+
+            def full_read(f):
+                audio = MP3(f)
+                return audio.get("TIT2"), audio.info.length
+
+            def fast_read(f):
+                tag_bytes, length = read_mp3_headers(f)
+                return ID3(BytesIO(tag_bytes)).get("TIT2"), length
+
+            for mode, read_file in (("full", full_read), ("fast", fast_read)):
+                bytes_read = 0
+                start = time.perf_counter()
+                for path in paths:
+                    with open(path, "rb") as raw:
+                        f = _CountingFile(raw)
+                        read_file(f)
+                        bytes_read += f.bytes_read
+                elapsed = time.perf_counter() - start
+                print(f"{mode}: {len(paths)} files in {elapsed:.2f}s, {len(paths) / elapsed:.0f} files/s, "
+                      f"{bytes_read / len(paths):.0f} bytes/file")
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir)
+
+    def benchmark_record_memory(self, records=100000, files_per_dir=12):
+        """compare memory per track of the old per-file dicts and TrackRecord"""
+
+        records = int(records)
+        for mode, record_class in (("dict", dict), ("TrackRecord", TrackRecord)):
+            print(f"{mode}: {self._record_memory(record_class, records, int(files_per_dir)):.0f} bytes/track ({records} tracks)")
+
+    def _record_memory(self, record_class, records, files_per_dir=12):
+        """bytes per track held by records built with record_class (dict or TrackRecord) from fresh tag strings"""
+
+        tracemalloc.start()
+        data = []
+        for i in range(records):
+            album = i // files_per_dir
+            # build fresh strings per file, as a tag reader does
+            data.append(record_class(title=f"Title {i}", artist=f"Artist {album // 2}", album=f"Album {album}",
+                                     track=str(i % files_per_dir + 1), genre="".join(["Ro", "ck"]), year="1999",
+                                     duration=200 + i % 100, file=f"track_{i:06d}.mp3",
+                                     dir=f"/music/Artist {album // 2}/Album {album}"))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return current / records
+
+    def benchmark_scoring(self, queries=2000, candidates=10, seed=1):
+        """time score_candidates per query against score_batch on synthetic candidates and check they pick the same match"""
+
+        rng = random.Random(int(seed))
+        words = ["love", "night", "dance", "the", "blue", "heart", "fire", "road", "song", "rain", "live", "remix"]
+
+        def phrase(n):
+            return " ".join(rng.choice(words) for _ in range(n))
+
+        query_list = []
+        for i in range(int(queries)):
+            title, artist, duration = phrase(3), phrase(2), rng.randint(90, 420)
+            items = [{"id": f"id{i}_{c}",
+                      "name": title if rng.random() < 0.3 else phrase(3),
+                      "artists": [{"name": artist if rng.random() < 0.5 else phrase(2)}],
+                      "duration_ms": duration * 1000 + rng.randint(-30000, 30000),
+                      "popularity": rng.randint(0, 100)}
+                     for c in range(int(candidates))]
+            query_list.append((title, artist, duration, {"tracks": {"items": items}}))
+
+        start = time.perf_counter()
+        expected = [score_candidates(*query) for query in query_list]
+        serial = time.perf_counter() - start
+
+        for similarity in ("ratio", "indel"):
+            try:
+                start = time.perf_counter()
+                matches = score_batch(query_list, similarity)
+                elapsed = time.perf_counter() - start
+            except ImportError as e:
+                print(f"batch({similarity}): skipped, {e}")
+                continue
+            mismatches = sum(1 for a, b in zip(expected, matches) if a != b)
+            print(f"batch({similarity}): {elapsed:.2f}s, {mismatches} of {len(query_list)} differ from score_candidates")
+        print(f"score_candidates: {serial:.2f}s")
+
+    def benchmark_db_ingest(self, rows=1000000, chunk_size=mp3_db.INGEST_CHUNK_SIZE):
+        """time loading synthetic rows into the tracks table: the old INSERT OR REPLACE, upserts and a bulk load
+           with indexes rebuilt at the end, then a rescan over the loaded table that must keep its spotify ids"""
+
+        rows = int(rows)
+        chunk_size = int(chunk_size)
+
+        def synthetic_rows(spotify_ids=True):
+            return self._synthetic_track_rows(rows, spotify_ids)
+
+        def replace_load(conn, tracks_data):
+            # batch_insert_tracks as it was before upserts
+            conn.executemany("""
+            INSERT OR REPLACE INTO tracks
+            (file_path, title, artist, album, duration_ms, spotify_id, last_checked)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, tracks_data)
+            conn.commit()
+
+        def old_schema(conn):
+            mp3_db.create_optimized_schema(conn)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_file_path ON tracks(file_path)")
+
+        tmp_dir = tempfile.mkdtemp(prefix="mp3_db_bench_")
+        try:
+            upsert = lambda conn, data: mp3_db.batch_insert_tracks(conn, data, chunk_size)
+            db_paths = {}
+            for mode, schema, load in (("insert or replace (old)", old_schema, replace_load),
+                                       ("upsert", mp3_db.create_optimized_schema, upsert),
+                                       ("bulk load", mp3_db.create_optimized_schema,
+                                        lambda conn, data: mp3_db.bulk_load_tracks(conn, data, chunk_size))):
+                db_paths[mode] = os.path.join(tmp_dir, mode.split()[0] + ".sqlite")
+                conn = mp3_db.optimize_db_connection(db_paths[mode])
+                schema(conn)
+                start = time.perf_counter()
+                load(conn, synthetic_rows())
+                elapsed = time.perf_counter() - start
+                conn.close()
+                print(f"{mode}: {rows} rows in {elapsed:.2f}s, {rows / elapsed:.0f} rows/s")
+
+            # a rescan (rows without spotify ids) over the loaded tables
+            for mode, load in (("insert or replace (old)", replace_load), ("upsert", upsert)):
+                conn = mp3_db.optimize_db_connection(db_paths[mode])
+                start = time.perf_counter()
+                load(conn, synthetic_rows(spotify_ids=False))
+                elapsed = time.perf_counter() - start
+                kept = conn.execute("SELECT COUNT(spotify_id) FROM tracks").fetchone()[0]
+                conn.close()
+                print(f"rescan, {mode}: {rows} rows in {elapsed:.2f}s, {rows / elapsed:.0f} rows/s, {kept} spotify ids kept")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def benchmark_db_queries(self, rows=1000000, repeat=5):
+        """time the mp3_db reporting queries on a synthetic table (20% unmatched, 5% duplicated titles, 10% liked)"""
+
+        rows = int(rows)
+        tmp_dir = tempfile.mkdtemp(prefix="mp3_db_bench_")
+        try:
+            db_path = os.path.join(tmp_dir, "tracks.sqlite")
+            conn = mp3_db.optimize_db_connection(db_path)
+            mp3_db.create_optimized_schema(conn)
+            start = time.perf_counter()
+            mp3_db.bulk_load_tracks(conn, self._synthetic_track_rows(rows, unmatched=0.2, duplicates=0.05))
+            print(f"loaded {rows} rows in {time.perf_counter() - start:.2f}s")
+
+            liked_db_path = os.path.join(tmp_dir, "liked.sqlite")
+            liked = sqlite3.connect(liked_db_path)
+            liked.execute("CREATE TABLE liked_tracks (uri TEXT PRIMARY KEY, added_at TEXT, name TEXT, artists TEXT)")
+            liked.executemany("INSERT OR IGNORE INTO liked_tracks (uri) VALUES (?)",
+                              ((f"spotify:track:{spotify_id}",) for (spotify_id,) in conn.execute(
+                                  "SELECT spotify_id FROM tracks WHERE spotify_id IS NOT NULL AND id % 10 = 0")))
+            liked.commit()
+            liked.close()
+
+            start = time.perf_counter()
+            mp3_db.create_track_search(conn)
+            print(f"built full text index in {time.perf_counter() - start:.2f}s")
+
+            queries = (("unmatched", lambda limit: mp3_db.get_unmatched_tracks(conn, None, limit)),
+                       ("unmatched under dir", lambda limit: mp3_db.get_unmatched_tracks(conn, "/music/artist_0040", limit)),
+                       ("stale 180 days", lambda limit: mp3_db.get_stale_tracks(conn, 180, limit)),
+                       ("duplicates", lambda limit: mp3_db.get_duplicate_tracks(conn, limit)),
+                       ("unliked", lambda limit: mp3_db.get_unliked_tracks(conn, liked_db_path, limit)),
+                       ("search", lambda limit: mp3_db.search_tracks(conn, "artist 42", limit)))
+            for name, query in queries:
+                for limit in (100, -1):
+                    start = time.perf_counter()
+                    for _ in range(int(repeat)):
+                        found = query(limit)
+                    elapsed = (time.perf_counter() - start) / int(repeat)
+                    print(f"{name} (limit {limit}): {len(found)} rows in {elapsed * 1000:.1f}ms")
+            conn.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def _synthetic_track_rows(self, rows, spotify_ids=True, unmatched=0.0, duplicates=0.0):
+        """rows for mp3_db.batch_insert_tracks, every 1/unmatched without a spotify id and 1/duplicates
+           repeating an earlier artist/title, last_checked spread over the past year"""
+        unmatched_every = int(1 / unmatched) if unmatched else 0
+        duplicate_every = int(1 / duplicates) if duplicates else 0
+        today = datetime.date.today()
+        for i in range(rows):
+            title_i = i - 1 if duplicate_every and i % duplicate_every == 1 else i
+            matched = spotify_ids and not (unmatched_every and i % unmatched_every == 0)
+            yield (f"/music/artist_{i % 5000:04d}/album_{i % 50000:05d}/track_{i:07d}.mp3",
+                   f"Title {title_i}", f"Artist {title_i % 5000}", f"Album {i % 50000}", 180000 + i % 120000,
+                   f"{i * 2654435761 % 10 ** 22:022d}" if matched else None,
+                   (today - datetime.timedelta(days=i % 365)).isoformat() if matched else None)
+
+
+class _CountingFile(object):
+    """file wrapper counting the bytes read through it"""
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+if __name__ == '__main__':
+    utils = Mp3Benchmarks()._run(sys.argv)
@@ -1,8 +1,29 @@
 import sqlite3
+import datetime
 import os
+from itertools import islice
 
-def optimize_db_connection(db_path):
-    conn = sqlite3.connect(db_path)
+import metrics
+
+# rows per transaction when bulk loading tracks
+INGEST_CHUNK_SIZE = 50000
+
+# secondary indexes of the tracks table, dropped and rebuilt around first loads
+# (file_path needs no index of its own, its UNIQUE constraint already makes one)
+TRACK_INDEXES = {
+    "idx_spotify_id": "CREATE INDEX IF NOT EXISTS idx_spotify_id ON tracks(spotify_id)",
+    # the reporting queries below, each answered from its index alone
+    "idx_unmatched": "CREATE INDEX IF NOT EXISTS idx_unmatched ON tracks(file_path) WHERE spotify_id IS NULL",
+    "idx_last_checked": "CREATE INDEX IF NOT EXISTS idx_last_checked ON tracks(last_checked, file_path, spotify_id)",
+    "idx_artist_title": """CREATE INDEX IF NOT EXISTS idx_artist_title
+                           ON tracks(artist COLLATE NOCASE, title COLLATE NOCASE, file_path)""",
+}
+
+# separates the file paths of a duplicate group as returned by sqlite
+_PATH_SEPARATOR = chr(31)
+
+def optimize_db_connection(db_path, check_same_thread=True):
+    conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
     conn.execute("PRAGMA journal_mode=WAL")  # Use Write-Ahead Logging
     conn.execute("PRAGMA synchronous=NORMAL")  # Faster writes, still safe
     conn.execute("PRAGMA cache_size=-64000")  # 64MB cache
@@ -19,21 +40,402 @@ def create_optimized_schema(conn):
         album TEXT,
         duration_ms INTEGER,
         spotify_id TEXT,
-        last_checked TEXT
+        last_checked TEXT,
+        file_size INTEGER,
+        file_mtime REAL,
+        track TEXT,
+        genre TEXT,
+        year TEXT
+    );
+    DROP INDEX IF EXISTS idx_file_path;
+    """)
+    add_missing_columns(conn)
+    create_track_indexes(conn)
+    conn.commit()
+
+def create_track_indexes(conn):
+    for sql in TRACK_INDEXES.values():
+        conn.execute(sql)
+
+def drop_track_indexes(conn):
+    for name in TRACK_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+def add_missing_columns(conn):
+    # databases created before file_size/file_mtime and track/genre/year were added to the schema
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(tracks)")}
+    for column, col_type in (("file_size", "INTEGER"), ("file_mtime", "REAL"),
+                             ("track", "TEXT"), ("genre", "TEXT"), ("year", "TEXT")):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE tracks ADD COLUMN {column} {col_type}")
+
+def _path_range(directory):
+    # bounds covering every path under directory, so the file_path index can be used
+    prefix = os.path.join(directory, "")
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def get_file_stats(conn, directory):
+    """return {file_path: (file_size, file_mtime)} for all tracks under directory
+       None for tracks scanned before track/genre/year were stored, so a scan reads their tags again"""
+    return {row[0]: (row[1], row[2]) if row[3] is not None else None for row in conn.execute("""
+    SELECT file_path, file_size, file_mtime, track FROM tracks
+    WHERE file_path >= ? AND file_path < ?
+    """, _path_range(directory))}
+
+def upsert_scanned_tracks(conn, tracks_data):
+    """insert or update tag data from a scan, keeping spotify_id/last_checked of existing rows"""
+    conn.executemany("""
+    INSERT INTO tracks
+    (file_path, title, artist, album, duration_ms, file_size, file_mtime, track, genre, year)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(file_path) DO UPDATE SET
+        title=excluded.title,
+        artist=excluded.artist,
+        album=excluded.album,
+        duration_ms=excluded.duration_ms,
+        file_size=excluded.file_size,
+        file_mtime=excluded.file_mtime,
+        track=excluded.track,
+        genre=excluded.genre,
+        year=excluded.year
+    """, tracks_data)
+    conn.commit()
+
+def get_tracks(conn, directory):
+    """return (file_path, title, artist, album, track, genre, year, duration_ms) for all tracks under directory"""
+    return conn.execute("""
+    SELECT file_path, title, artist, album, track, genre, year, duration_ms FROM tracks
+    WHERE file_path >= ? AND file_path < ?
+    ORDER BY file_path
+    """, _path_range(directory)).fetchall()
+
+def get_last_checked(conn, directory):
+    """return (file_path, last_checked) for all tracks under directory"""
+    return conn.execute("""
+    SELECT file_path, last_checked FROM tracks
+    WHERE file_path >= ? AND file_path < ?
+    """, _path_range(directory)).fetchall()
+
+def get_unmatched_tracks(conn, directory=None, limit=-1):
+    """return file_path of tracks without a spotify_id, optionally only those under directory"""
+    # without table statistics the planner picks idx_spotify_id and sorts, the partial index is already in order
+    if directory:
+        return [row[0] for row in conn.execute("""
+        SELECT file_path FROM tracks INDEXED BY idx_unmatched
+        WHERE spotify_id IS NULL AND file_path >= ? AND file_path < ?
+        ORDER BY file_path LIMIT ?
+        """, _path_range(directory) + (limit,))]
+    return [row[0] for row in conn.execute(
+        "SELECT file_path FROM tracks INDEXED BY idx_unmatched WHERE spotify_id IS NULL ORDER BY file_path LIMIT ?",
+        (limit,))]
+
+def get_stale_tracks(conn, days, limit=-1):
+    """return (file_path, spotify_id, last_checked) of tracks last checked more than days ago, oldest first"""
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=float(days))).isoformat(timespec="seconds")
+    return conn.execute("""
+    SELECT file_path, spotify_id, last_checked FROM tracks
+    WHERE last_checked < ?
+    ORDER BY last_checked LIMIT ?
+    """, (cutoff, limit)).fetchall()
+
+def get_duplicate_tracks(conn, limit=-1):
+    """return (artist, title, [file_path, ...]) for each artist and title (ignoring case) held in more than one file"""
+    rows = conn.execute(f"""
+    SELECT artist, title, GROUP_CONCAT(file_path, char({ord(_PATH_SEPARATOR)})) FROM tracks
+    WHERE artist IS NOT NULL AND title IS NOT NULL
+    GROUP BY artist COLLATE NOCASE, title COLLATE NOCASE
+    HAVING COUNT(*) > 1
+    LIMIT ?
+    """, (limit,))
+    return [(artist, title, paths.split(_PATH_SEPARATOR)) for artist, title, paths in rows]
+
+def get_unliked_tracks(conn, liked_db_path, limit=-1):
+    """return (file_path, spotify_id) of matched tracks whose spotify_id isn't in the liked songs snapshot
+       kept by spotify_liked_sync (its sqlite db at liked_db_path)"""
+    conn.execute("ATTACH DATABASE ? AS liked", (liked_db_path,))
+    try:
+        # spotify_id is stored as a bare id or a spotify:track: uri, the snapshot has uris
+        return conn.execute("""
+        SELECT t.file_path, t.spotify_id FROM tracks t
+        WHERE t.spotify_id IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM liked.liked_tracks l
+            WHERE l.uri = CASE WHEN t.spotify_id LIKE 'spotify:track:%' THEN t.spotify_id
+                               ELSE 'spotify:track:' || t.spotify_id END)
+        ORDER BY t.spotify_id LIMIT ?
+        """, (limit,)).fetchall()
+    finally:
+        conn.execute("DETACH DATABASE liked")
+
+def create_track_search(conn):
+    """full text index of artist/title/album over the tracks table, built now and kept up to date by triggers"""
+    conn.executescript("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+        artist, title, album, content='tracks', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+    INSERT INTO tracks_fts(tracks_fts) VALUES ('rebuild');
+    CREATE TRIGGER IF NOT EXISTS tracks_fts_insert AFTER INSERT ON tracks BEGIN
+        INSERT INTO tracks_fts(rowid, artist, title, album) VALUES (new.id, new.artist, new.title, new.album);
+    END;
+    CREATE TRIGGER IF NOT EXISTS tracks_fts_delete AFTER DELETE ON tracks BEGIN
+        INSERT INTO tracks_fts(tracks_fts, rowid, artist, title, album)
+        VALUES ('delete', old.id, old.artist, old.title, old.album);
+    END;
+    CREATE TRIGGER IF NOT EXISTS tracks_fts_update AFTER UPDATE OF artist, title, album ON tracks BEGIN
+        INSERT INTO tracks_fts(tracks_fts, rowid, artist, title, album)
+        VALUES ('delete', old.id, old.artist, old.title, old.album);
+        INSERT INTO tracks_fts(rowid, artist, title, album) VALUES (new.id, new.artist, new.title, new.album);
+    END;
+    """)
+    conn.commit()
+
+def search_tracks(conn, query, limit=20):
+    """return (file_path, artist, title, album, spotify_id) of tracks matching an fts5 query, best first"""
+    return conn.execute("""
+    SELECT t.file_path, t.artist, t.title, t.album, t.spotify_id
+    FROM tracks_fts JOIN tracks t ON t.id = tracks_fts.rowid
+    WHERE tracks_fts MATCH ?
+    ORDER BY rank LIMIT ?
+    """, (query, limit)).fetchall()
+
+def delete_tracks(conn, file_paths):
+    conn.executemany("DELETE FROM tracks WHERE file_path = ?", ((path,) for path in file_paths))
+    conn.commit()
+
+def create_search_cache_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS search_cache (
+        query_key TEXT PRIMARY KEY,
+        result TEXT NOT NULL,
+        fetched_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_search_cache_fetched_at ON search_cache(fetched_at);
+    """)
+    conn.commit()
+
+def get_cached_search(conn, query_key, min_fetched_at):
+    row = conn.execute(
+        "SELECT result FROM search_cache WHERE query_key = ? AND fetched_at >= ?",
+        (query_key, min_fetched_at)).fetchone()
+    return row[0] if row else None
+
+def put_cached_search(conn, query_key, result, fetched_at):
+    conn.execute("""
+    INSERT INTO search_cache (query_key, result, fetched_at) VALUES (?, ?, ?)
+    ON CONFLICT(query_key) DO UPDATE SET result=excluded.result, fetched_at=excluded.fetched_at
+    """, (query_key, result, fetched_at))
+    conn.commit()
+
+def evict_search_cache(conn, max_entries):
+    # drop the oldest rows beyond max_entries
+    conn.execute("""
+    DELETE FROM search_cache WHERE query_key IN (
+        SELECT query_key FROM search_cache ORDER BY fetched_at DESC LIMIT -1 OFFSET ?
+    )""", (max_entries,))
+    conn.commit()
+
+def create_spotify_tracks_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS spotify_tracks (
+        id TEXT PRIMARY KEY,
+        uri TEXT NOT NULL,
+        name TEXT,
+        artist TEXT,
+        album TEXT,
+        album_artist TEXT,
+        duration_ms INTEGER,
+        popularity INTEGER
     );
-    CREATE INDEX IF NOT EXISTS idx_file_path ON tracks(file_path);
-    CREATE INDEX IF NOT EXISTS idx_spotify_id ON tracks(spotify_id);
     """)
     conn.commit()
 
-def batch_insert_tracks(conn, tracks_data):
+def upsert_spotify_tracks(conn, tracks_data):
     conn.executemany("""
-    INSERT OR REPLACE INTO tracks 
-    (file_path, title, artist, album, duration_ms, spotify_id, last_checked)
-    VALUES (?, ?, ?, ?, ?, ?, ?)
+    INSERT INTO spotify_tracks (id, uri, name, artist, album, album_artist, duration_ms, popularity)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        uri=excluded.uri, name=excluded.name, artist=excluded.artist, album=excluded.album,
+        album_artist=excluded.album_artist, duration_ms=excluded.duration_ms, popularity=excluded.popularity
     """, tracks_data)
     conn.commit()
 
+def get_spotify_tracks(conn):
+    return conn.execute(
+        "SELECT id, uri, name, artist, album, album_artist, duration_ms, popularity FROM spotify_tracks")
+
+def count_spotify_tracks(conn):
+    return conn.execute("SELECT COUNT(*) FROM spotify_tracks").fetchone()[0]
+
+def get_spotify_tracks_by_id(conn, ids, chunk_size=500):
+    """rows of spotify_tracks for the given ids (missing ids are left out)"""
+    ids = list(ids)
+    rows = []
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        rows.extend(conn.execute(f"""
+        SELECT id, uri, name, artist, album, album_artist, duration_ms, popularity FROM spotify_tracks
+        WHERE id IN ({",".join("?" * len(chunk))})
+        """, chunk))
+    return rows
+
+def get_matched_tracks(conn, directory=None):
+    """return (file_path, spotify_id) for tracks with a spotify_id, optionally only those under directory"""
+    if directory:
+        return conn.execute("""
+        SELECT file_path, spotify_id FROM tracks
+        WHERE spotify_id IS NOT NULL AND file_path >= ? AND file_path < ?
+        """, _path_range(directory)).fetchall()
+    return conn.execute("SELECT file_path, spotify_id FROM tracks WHERE spotify_id IS NOT NULL").fetchall()
+
+def set_last_checked(conn, file_paths, last_checked):
+    conn.executemany("UPDATE tracks SET last_checked = ? WHERE file_path = ?",
+                     ((last_checked, path) for path in file_paths))
+    conn.commit()
+
+def clear_spotify_ids(conn, file_paths, last_checked):
+    # matches that no longer resolve, so they get searched for again
+    conn.executemany("UPDATE tracks SET spotify_id = NULL, last_checked = ? WHERE file_path = ?",
+                     ((last_checked, path) for path in file_paths))
+    conn.commit()
+
+def create_progress_schema(conn):
+    # per file journal of mp3_to_spotify runs, so an interrupted run carries on where it stopped
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS search_progress (
+        file_path TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        result TEXT,
+        error TEXT,
+        updated_at REAL
+    );
+    """)
+    conn.commit()
+
+def get_progress(conn, directory):
+    """return {file_path: (status, result)} for all journaled files under directory"""
+    return {row[0]: (row[1], row[2]) for row in conn.execute("""
+    SELECT file_path, status, result FROM search_progress
+    WHERE file_path >= ? AND file_path < ?
+    """, _path_range(directory))}
+
+def get_progress_results(conn, directory):
+    """return the stored results of files under directory that have one, in file_path order"""
+    return [row[0] for row in conn.execute("""
+    SELECT result FROM search_progress
+    WHERE file_path >= ? AND file_path < ? AND result IS NOT NULL
+    ORDER BY file_path
+    """, _path_range(directory))]
+
+def put_progress(conn, progress_data):
+    """store (file_path, status, result, error, updated_at) rows"""
+    conn.executemany("""
+    INSERT INTO search_progress (file_path, status, result, error, updated_at) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(file_path) DO UPDATE SET
+        status=excluded.status, result=excluded.result, error=excluded.error, updated_at=excluded.updated_at
+    """, progress_data)
+    conn.commit()
+
+def delete_progress(conn, file_paths):
+    conn.executemany("DELETE FROM search_progress WHERE file_path = ?", ((path,) for path in file_paths))
+    conn.commit()
+
+def create_fingerprint_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS fingerprints (
+        file_path TEXT PRIMARY KEY,
+        file_size INTEGER,
+        file_mtime REAL,
+        duration REAL,
+        fingerprint TEXT,
+        acoustid TEXT,
+        recording_id TEXT,
+        title TEXT,
+        artist TEXT,
+        looked_up_at REAL
+    );
+    """)
+    conn.commit()
+
+def get_fingerprint_stats(conn, directory):
+    """return {file_path: (file_size, file_mtime)} for all fingerprinted files under directory"""
+    return {row[0]: (row[1], row[2]) for row in conn.execute("""
+    SELECT file_path, file_size, file_mtime FROM fingerprints
+    WHERE file_path >= ? AND file_path < ?
+    """, _path_range(directory))}
+
+def upsert_fingerprints(conn, fingerprint_data):
+    """store (file_path, file_size, file_mtime, duration, fingerprint), a new fingerprint drops any old lookup"""
+    conn.executemany("""
+    INSERT INTO fingerprints (file_path, file_size, file_mtime, duration, fingerprint)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(file_path) DO UPDATE SET
+        file_size=excluded.file_size, file_mtime=excluded.file_mtime,
+        duration=excluded.duration, fingerprint=excluded.fingerprint,
+        acoustid=NULL, recording_id=NULL, title=NULL, artist=NULL, looked_up_at=NULL
+    """, fingerprint_data)
+    conn.commit()
+
+def delete_fingerprints(conn, file_paths):
+    conn.executemany("DELETE FROM fingerprints WHERE file_path = ?", ((path,) for path in file_paths))
+    conn.commit()
+
+def get_fingerprints(conn, directory, unmatched_only=False):
+    """return (file_path, duration, fingerprint) for fingerprinted files under directory"""
+    return conn.execute(f"""
+    SELECT file_path, duration, fingerprint FROM fingerprints
+    WHERE file_path >= ? AND file_path < ? AND fingerprint IS NOT NULL
+    {"AND looked_up_at IS NULL" if unmatched_only else ""}
+    ORDER BY file_path
+    """, _path_range(directory)).fetchall()
+
+def set_fingerprint_matches(conn, match_data):
+    """store (acoustid, recording_id, title, artist, looked_up_at, file_path) lookup results"""
+    conn.executemany("""
+    UPDATE fingerprints SET acoustid = ?, recording_id = ?, title = ?, artist = ?, looked_up_at = ?
+    WHERE file_path = ?
+    """, match_data)
+    conn.commit()
+
+def batch_insert_tracks(conn, tracks_data, chunk_size=INGEST_CHUNK_SIZE):
+    """
+    insert or update tracks, chunk_size rows per transaction, returns the number of rows written
+    tracks_data can be any iterable (e.g. a generator) of row tuples or mp3_utils.TrackRecord objects
+    existing rows keep their id, file_size/file_mtime, and spotify_id/last_checked unless new ones are given
+    """
+    rows = (track.db_row() if hasattr(track, "db_row") else track for track in tracks_data)
+    total = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return total
+        # one transaction per chunk, executemany reuses the one prepared statement
+        with metrics.timer("batch_insert_tracks"), conn:
+            conn.executemany("""
+            INSERT INTO tracks
+            (file_path, title, artist, album, duration_ms, spotify_id, last_checked)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(file_path) DO UPDATE SET
+                title=excluded.title,
+                artist=excluded.artist,
+                album=excluded.album,
+                duration_ms=excluded.duration_ms,
+                spotify_id=COALESCE(excluded.spotify_id, tracks.spotify_id),
+                last_checked=COALESCE(excluded.last_checked, tracks.last_checked)
+            """, chunk)
+        metrics.count("tracks_written", len(chunk))
+        total += len(chunk)
+
+def bulk_load_tracks(conn, tracks_data, chunk_size=INGEST_CHUNK_SIZE):
+    """
+    batch_insert_tracks for first (or very large) loads: secondary indexes are dropped for the load and built
+    once at the end, which is much cheaper than updating them row by row
+    """
+    drop_track_indexes(conn)
+    conn.commit()
+    try:
+        return batch_insert_tracks(conn, tracks_data, chunk_size)
+    finally:
+        create_track_indexes(conn)
+        conn.commit()
+
 # Usage example:
 # db_path = os.path.expanduser("~/Dropbox/my_large_music_db.sqlite")
 # conn = optimize_db_connection(db_path)
@@ -46,5 +448,8 @@ def batch_insert_tracks(conn, tracks_data):
 #     # ... more tracks ...
 # ]
 # batch_insert_tracks(conn, tracks_data)
+#
+# # first load of a large library, from a generator, with indexes built once at the end
+# bulk_load_tracks(conn, (record.db_row() for record in records))
 # 
 # conn.close()
\ No newline at end of file
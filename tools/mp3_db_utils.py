@@ -0,0 +1,80 @@
+# Reports over the mp3_db tracks table
+# optionally expects env var SPOTIFY_SYNC_DB=<liked songs snapshot db of spotify_liked_sync.py> for unliked
+
+import os
+import sqlite3
+import sys
+
+from utils import Utils
+import mp3_db
+
+
+class Mp3DbUtils(Utils):
+    """    Queries over the mp3 tracks db    """
+    def __init__(self):
+        Utils.__init__(self)
+
+    def _connect(self, db_path):
+        conn = mp3_db.optimize_db_connection(db_path)
+        # creates any reporting indexes an older db is missing
+        mp3_db.create_optimized_schema(conn)
+        return conn
+
+    def unmatched(self, db_path, directory=None, limit=100):
+        """list tracks with no spotify_id (optionally only under directory), limit=-1 for all"""
+
+        conn = self._connect(db_path)
+        directory = os.path.abspath(directory) if directory else None
+        paths = mp3_db.get_unmatched_tracks(conn, directory, int(limit))
+        conn.close()
+        return paths
+
+    def stale(self, db_path, days=30, limit=100):
+        """list tracks last checked against spotify more than days ago, oldest first, limit=-1 for all"""
+
+        conn = self._connect(db_path)
+        rows = mp3_db.get_stale_tracks(conn, days, int(limit))
+        conn.close()
+        return [f"{last_checked}~{spotify_id}~{file_path}" for file_path, spotify_id, last_checked in rows]
+
+    def duplicates(self, db_path, limit=100):
+        """list artist/title pairs held in more than one file, limit=-1 for all"""
+
+        conn = self._connect(db_path)
+        rows = mp3_db.get_duplicate_tracks(conn, int(limit))
+        conn.close()
+        return [f"{artist}~{title}~{'~'.join(paths)}" for artist, title, paths in rows]
+
+    def unliked(self, db_path, liked_db_path=None, limit=100):
+        """list matched tracks whose spotify_id isn't a liked song (as of the last spotify_liked_sync run), limit=-1 for all"""
+
+        liked_db_path = liked_db_path or os.environ.get('SPOTIFY_SYNC_DB', 'spotify_liked_sync.sqlite')
+        if not os.path.exists(liked_db_path):
+            return f"No liked songs snapshot at {liked_db_path}, run spotify_liked_sync.py or set SPOTIFY_SYNC_DB"
+        conn = self._connect(db_path)
+        rows = mp3_db.get_unliked_tracks(conn, liked_db_path, int(limit))
+        conn.close()
+        return [f"{spotify_id}~{file_path}" for file_path, spotify_id in rows]
+
+    def search(self, db_path, query, limit=20, rebuild=0):
+        """full text search of artist/title/album (fts5 syntax, e.g. "artist: beatles"), the index is built on first use
+           a query that isn't valid fts5 (e.g. AC/DC or Guns N' Roses) is searched for as a phrase"""
+
+        conn = self._connect(db_path)
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'tracks_fts'").fetchone()
+        if not exists or int(rebuild):
+            mp3_db.create_track_search(conn)
+        try:
+            rows = mp3_db.search_tracks(conn, query, int(limit))
+        except sqlite3.OperationalError as e:
+            if "fts5: syntax error" not in str(e):
+                raise
+            # the tokenizer splits the phrase on the punctuation as it did the tags
+            rows = mp3_db.search_tracks(conn, '"' + query.replace('"', '""') + '"', int(limit))
+        finally:
+            conn.close()
+        return ["~".join(str(value) for value in row) for row in rows]
+
+
+if __name__ == '__main__':
+    utils = Mp3DbUtils()._run(sys.argv)
@@ -3,78 +3,488 @@
 # SPOTIPY_CLIENT_ID=<>
 # SPOTIPY_CLIENT_SECRET=<>
 # SPOTIPY_USERNAME=<>
-
-from difflib import SequenceMatcher
+# and optionally:
+# SPOTIPY_SEARCH_CACHE=<sqlite db path, e.g. the mp3_db database, to cache search results in>
+# SPOTIPY_TRACK_INDEX=<sqlite db path to keep a local index of known spotify tracks in, checked before searching
+#                      and used as the metadata cache of hydrate_tracks>
+# SPOTIPY_PROGRESS_DB=<sqlite db path to journal mp3_to_spotify/library_to_spotify progress in when no db_path is
+#                      given, default ~/.cache/py_spotify/spotify_progress.sqlite>
+# PY_SPOTIFY_METRICS=<path to write per stage timings and counters to at exit, see metrics.py>
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import datetime
 import glob
 import json
 import os
 import sys
+import threading
 import time
 import traceback
 
 from utils import Utils
-from mp3_utils import Mp3Utils
+import audio_duplicates
+from match_scoring import score_batch, score_candidates
+import metrics
+from mp3_utils import Mp3Utils, TrackRecord
+from rate_limiter import LimitedSpotify
+from search_cache import SearchCache
+from spotify_index import TrackIndex
+from spotify_client import get_spotify
+import mp3_db
+import output_sinks
+from spotify_paging import fetch_all_pages, fetch_by_ids
+
+# journal of mp3_to_spotify progress when no tracks db is given, one for every folder searched so nothing is
+# written into the music folders (SPOTIPY_PROGRESS_DB overrides it)
+PROGRESS_DB_PATH = os.path.join("~", ".cache", "py_spotify", "spotify_progress.sqlite")
+
+# journal kept in each searched folder by earlier versions, still used where there is one
+PROGRESS_DB_NAME = "spotify_progress.sqlite"
+
+# searches failing one after another before a run gives up (to be resumed later)
+MAX_FAILURES_IN_A_ROW = 10
 
-from spotipy.oauth2 import SpotifyClientCredentials
-from spotipy.oauth2 import SpotifyOAuth
-import spotipy
+# scopes these tools authorize (the same as before the shared client, so a token already cached for them covers it)
+SCOPE = 'user-library-read playlist-modify-public'
 
 
 class MP3SpotifyUtils(Utils):
     """    Various MP3 utils    """
-    def __init__(self):
+    def __init__(self, sp=None, search_cache=None, track_index=None):
         Utils.__init__(self)
 
         self.username = os.environ['SPOTIPY_USERNAME']
         
-        scope = ['user-library-read', 'playlist-modify-public', 'playlist-modify-public']
-        self.sp = spotipy.Spotify(auth_manager=SpotifyOAuth(client_id=os.environ['SPOTIPY_CLIENT_ID'],
-                                               client_secret=os.environ['SPOTIPY_CLIENT_SECRET'],
-                                               redirect_uri=os.environ.get('SPOTIPY_REDIRECT_URI', 'http://127.0.0.1:8888/callback'),
-                                               scope=scope,
-                                               open_browser=False))
+        # sp can be passed in, e.g. a spotipy.Spotify pointed at a local stand-in server by setting its prefix
+        # otherwise the process wide client, sharing its connection pool and token with other callers
+        sp = sp or get_spotify(SCOPE)
+        # all calls go through the shared rate limiter
+        self.sp = sp if isinstance(sp, LimitedSpotify) else LimitedSpotify(sp)
                                                
         self.mp3_utils = Mp3Utils()
 
+        self.search_cache = search_cache
+        if self.search_cache is None and os.environ.get('SPOTIPY_SEARCH_CACHE'):
+            self.search_cache = SearchCache(os.environ['SPOTIPY_SEARCH_CACHE'])
+
+        self.track_index = track_index
+        if self.track_index is None and os.environ.get('SPOTIPY_TRACK_INDEX'):
+            self.track_index = TrackIndex(os.environ['SPOTIPY_TRACK_INDEX'])
+
+        # duplicate audio of one run: file path -> cluster, and the one search made per cluster
+        self._clusters = {}
+        self._cluster_searches = {}
+        self._cluster_reps = {}
+        self._cluster_lock = threading.Lock()
+
 
-    def mp3_to_spotify(self, mp3_path, duration_tolerance=50):
-        """pass path containing mp3 files to find spotify ids for, and optional duration tolerance as % (default 5)"""
+    def mp3_to_spotify(self, mp3_path, duration_tolerance=50, db_path=None, workers=0, fingerprint_db=None,
+                       outputs="txt", resume=1, batch_size=output_sinks.DEFAULT_BATCH_SIZE, retry=0):
+        """pass path containing mp3 files to find spotify ids for, and optional duration tolerance as % (default 5), tracks db and number of concurrent searches
+           with fingerprint_db (see AcoustidUtils.fingerprint_dir) files with the same audio share one search
+           outputs is a comma separated list of txt (spotify.txt), csv (spotify.csv), parquet (spotify.parquet) and db (tracks table of db_path),
+           written every batch_size rows
+           progress is journaled per file (in db_path, else SPOTIPY_PROGRESS_DB, by default
+           ~/.cache/py_spotify/spotify_progress.sqlite) and a re-run only searches files not done yet,
+           retry=1 also searches again files that failed or weren't found, resume=0 starts over"""
 
         duration_tolerance = int(duration_tolerance) if duration_tolerance else 5
+        workers = int(workers)
+        resume = bool(int(resume))
+        retry = bool(int(retry))
+        directory = os.path.abspath(mp3_path)
+
+        self._load_clusters(fingerprint_db, directory)
+        journal = mp3_db.optimize_db_connection(db_path or self._progress_db_path(directory))
+        # sub folders may share a journal in db_path (see library_to_spotify), only this folder's files count here
+        progress, done = self._open_journal(journal, directory, resume, retry, recurse=False)
+
+        sinks = output_sinks.open_sinks(outputs, mp3_path, db_path, resume, batch_size)
+        counts = {"ok": 0, "unk": 0, "failed": 0}
+        try:
+            # outputs are rebuilt from the journal at the end if they miss journaled results (a run killed
+            # before a flush) or if earlier results get replaced by retries
+            rewrite = self._outputs_missing(sinks, progress)
+            if resume and not progress:
+                # outputs of a run made before there was a journal
+                progress, rewrite = self._seed_journal(journal, sinks, directory)
+                done = set(progress)
+            if done:
+                print(f"Resuming, {len(done)} files already done")
+
+            # stream straight from the directory so searches start on the first file
+            if db_path:
+                all_data = self.mp3_utils.get_mp3_data_per_dir(mp3_path, db_path=db_path)
+            else:
+                all_data = self.mp3_utils.iter_mp3_data(mp3_path)
+            if done:
+                all_data = (data for data in all_data if os.path.abspath(os.path.join(data['dir'], data['file'])) not in done)
 
-        output_file = os.path.join(mp3_path, "spotify.txt")
-        with open(output_file, "w") as f:
-            f.write("artist~title~mp3_duration~spotify_duration~sp_id~sp_id2~score~file~dir\n")
-            all_data = self.mp3_utils.get_mp3_data_per_dir(mp3_path)
-            for data in all_data:
-                # remove words with ' in them
-                title = " ".join([m for m in data["title"].split() if "'" not in m])
-
-                # search in spotify
-                # need highest popularity track with specified duration tolerance
-                print(f"processing {data['file']}")
-                result = self.spotify_search(data["artist"], title, 
-                                              True, duration_tolerance, data["duration"])
-                if result:
-                    duration = result['duration']
-                    sp_id = result['id']
-                    sp_id2 = result['id2']
-                    score = result['score']
-                else:
-                    duration = sp_id = sp_id2 = score = "UNK"
-
-                f.write(f"{data['artist']}~{data['title']}~{data['duration']}~{duration}~{sp_id}~{sp_id2}~{score}~{data['file']}~{data['dir']}\n")
-        print(f"Data written to {output_file}")
+            if workers > 0:
+                rows = self._search_rows_concurrent(all_data, duration_tolerance, workers)
+            else:
+                rows = (self._safe_search_row(data, duration_tolerance) for data in all_data)
+
+            for file_path, status, row in self._journal_rows(rows, journal):
+                counts[status] += 1
+                if row is None:
+                    continue
+                if progress.get(file_path, (None, None))[1] is not None:
+                    rewrite = True
+                for sink in sinks:
+                    sink.write(row)
+        finally:
+            # whatever was found before an error is still written
+            for sink in sinks:
+                sink.close()
+
+        if rewrite:
+            self._rewrite_outputs(journal, directory, outputs, mp3_path, db_path, batch_size, recurse=False)
+        journal.close()
+        # files that couldn't be read are skipped (and tried again on the next run)
+        for path, error in self.mp3_utils.scan_errors:
+            print(f"Error reading {path}: {error}")
+        print(f"Data written to {outputs} for {mp3_path}: {counts['ok']} found, {counts['unk']} not found, "
+              f"{counts['failed']} failed, {len(self.mp3_utils.scan_errors)} unreadable")
+        self._print_stats()
+
+    def library_to_spotify(self, library_path, duration_tolerance=50, db_path=None, workers=8, read_workers=4,
+                           processes=0, fingerprint_db=None, outputs="txt", per_folder=1, resume=1,
+                           batch_size=output_sinks.DEFAULT_BATCH_SIZE, retry=0):
+        """mp3_to_spotify for every folder under library_path in one run, the tree is walked once and every file goes
+           through one pool of read_workers tag readers (processes=1 for a process pool) and one of workers searches,
+           so the pools stay busy across folder boundaries instead of draining at the end of each folder
+           per_folder=1 writes outputs into each folder as mp3_to_spotify does, per_folder=0 one set into library_path
+           (db output always goes to db_path), progress is printed as each folder finishes and journaled for the whole
+           library (in db_path, else as for mp3_to_spotify), resume/retry as for mp3_to_spotify"""
 
+        duration_tolerance = int(duration_tolerance) if duration_tolerance else 5
+        workers = max(int(workers), 1)
+        read_workers = int(read_workers)
+        per_folder = bool(int(per_folder))
+        resume = bool(int(resume))
+        retry = bool(int(retry))
+        library = os.path.abspath(library_path)
+
+        self._load_clusters(fingerprint_db, library)
+        journal = mp3_db.optimize_db_connection(db_path or self._progress_db_path(library))
+        progress, done = self._open_journal(journal, library, resume, retry)
+        if done:
+            print(f"Resuming, {len(done)} files already done")
+
+        # with per folder outputs only the db (which holds the whole library anyway) is opened once
+        names = [name.strip() for name in outputs.split(",")]
+        folder_outputs = ",".join(name for name in names if name != "db") if per_folder else ""
+        library_outputs = ("db" if "db" in names else "") if per_folder else outputs
+
+        read_errors = []
+        if db_path:
+            # tags come from the tracks db, brought up to date first, grouped by folder as the walk would be
+            all_data = sorted(self.mp3_utils.get_mp3_data_from_db(library, db_path, 1, read_workers, processes),
+                              key=lambda data: (data['dir'], data['file']))
+            read_errors.extend(self.mp3_utils.scan_errors)
+        else:
+            # the walk yields all of a folder's files before going into its sub folders, so each folder's files
+            # arrive together and its outputs can be closed as soon as the next folder starts
+            mp3_files = self.mp3_utils.iter_mp3_files(library, 1)
+            if done:
+                mp3_files = (file_info for file_info in mp3_files
+                             if os.path.join(file_info[1], file_info[0]) not in done)
+            if read_workers > 0:
+                all_data = self.mp3_utils._iter_mp3_data_parallel(mp3_files, read_workers, processes, read_errors)
+            else:
+                all_data = self.mp3_utils._iter_mp3_data_serial(mp3_files, read_errors)
+        if done:
+            all_data = (data for data in all_data if os.path.abspath(os.path.join(data['dir'], data['file'])) not in done)
+        rows = self._search_rows_concurrent(all_data, duration_tolerance, workers)
+
+        # outputs are only appended to when the journal says what they hold, outputs written before there was a
+        # journal are started again (each folder's on its own), as their files are all searched again
+        library_sinks = (output_sinks.open_sinks(library_outputs, library, db_path, resume and bool(progress), batch_size)
+                         if library_outputs else [])
+        rewrite = self._outputs_missing(library_sinks, progress)
+        folder_progress = {}
+        if folder_outputs:
+            for path, value in progress.items():
+                folder_progress.setdefault(os.path.dirname(path), {})[path] = value
+        totals = {"ok": 0, "unk": 0, "failed": 0}
+        folder = None
+        folders = 0
+        try:
+            for file_path, status, row in self._journal_rows(rows, journal):
+                folder_path = os.path.dirname(file_path)
+                if folder is None or folder.path != folder_path:
+                    if folder:
+                        folders += 1
+                        folder.finish(journal, f"[{folders} folders, {sum(totals.values())} files]")
+                    folder = _FolderRun(self, folder_path, folder_outputs, resume, batch_size,
+                                        folder_progress.get(folder_path, {}))
+
+                totals[status] += 1
+                folder.counts[status] += 1
+                if row is None:
+                    continue
+                if progress.get(file_path, (None, None))[1] is not None:
+                    rewrite = folder.rewrite = True
+                for sink in folder.sinks + library_sinks:
+                    sink.write(row)
+            if folder:
+                folders += 1
+                folder.finish(journal, f"[{folders} folders, {sum(totals.values())} files]")
+                folder = None
+        finally:
+            if folder:
+                folder.close()
+            for sink in library_sinks:
+                sink.close()
+
+        if rewrite and library_outputs:
+            self._rewrite_outputs(journal, library, library_outputs, library, db_path, batch_size)
+        journal.close()
+        for path, error in read_errors:
+            print(f"Error reading {path}: {error}")
+        print(f"Data written to {outputs} for {library}: {folders} folders, {totals['ok']} found, "
+              f"{totals['unk']} not found, {totals['failed']} failed, {len(read_errors)} unreadable")
+        self._print_stats()
+
+    def _load_clusters(self, fingerprint_db, directory):
+        """cluster duplicate audio under directory (with fingerprint_db) so each cluster is searched once this run"""
+
+        self._clusters = {}
+        self._cluster_searches = {}
+        self._cluster_reps = {}
+        if fingerprint_db:
+            for cluster in audio_duplicates.duplicate_clusters(fingerprint_db, directory):
+                self._clusters.update((path, cluster[0]) for path in cluster)
+
+    def _progress_db_path(self, directory):
+        """journal for a run over directory without a tracks db, see PROGRESS_DB_PATH"""
+
+        legacy = os.path.join(directory, PROGRESS_DB_NAME)
+        if os.path.exists(legacy):
+            return legacy
+        path = os.path.expanduser(os.environ.get('SPOTIPY_PROGRESS_DB', PROGRESS_DB_PATH))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        return path
+
+    def _open_journal(self, journal, directory, resume, retry, recurse=True):
+        """set up the progress journal for a run over directory, returns ({file_path: (status, result)}, files done)"""
+
+        mp3_db.create_progress_schema(journal)
+        progress = mp3_db.get_progress(journal, directory)
+        if not recurse:
+            # the journal is shared, sub folders' progress isn't this run's
+            progress = {path: value for path, value in progress.items() if os.path.dirname(path) == directory}
+        if not resume:
+            mp3_db.delete_progress(journal, list(progress))
+            progress = {}
+        retry_statuses = ("failed", "unk") if retry else ()
+        done = {path for path, (status, _) in progress.items() if status not in retry_statuses}
+        return progress, done
+
+    def _seed_journal(self, journal, sinks, directory):
+        """
+        Journal the files directory's outputs already hold (every one of them), from a run made before there was
+        a journal, so they are neither searched again nor appended a second time.
+        Returns the new progress of directory and whether the outputs need rebuilding from the journal at the end
+        (some hold files the others don't, which get searched again).
+        """
+        held = [{path for path in sink.written_files() if os.path.dirname(path) == directory} for sink in sinks]
+        written = set.intersection(*held) if held else set()
+        if not written:
+            return {}, any(held)
+
+        # spotify.txt has no album, so it is the last choice to read rows back from
+        readers = sorted(sinks, key=lambda sink: isinstance(sink, output_sinks.TxtSink))
+        rows = next((rows for rows in (sink.written_rows() for sink in readers) if rows is not None), [])
+        now = time.time()
+        progress_data = []
+        for row in rows:
+            path = os.path.abspath(os.path.join(row["dir"], row["file"]))
+            if path in written:
+                written.discard(path)
+                status = "ok" if output_sinks.best_spotify_id(row) else "unk"
+                progress_data.append((path, status, json.dumps(row), None, now))
+        # only outputs whose rows can't be read back (the db, which keeps them on a rewrite anyway)
+        progress_data += [(path, "ok", None, None, now) for path in written]
+        mp3_db.put_progress(journal, progress_data)
+        print(f"Journaled {len(progress_data)} files already in the outputs")
+
+        progress = {path: (status, result) for path, status, result, _, _ in progress_data}
+        return progress, len(set.union(*held)) > len(progress)
+
+    def _outputs_missing(self, sinks, progress):
+        """whether any file with a journaled result isn't in every one of sinks yet"""
+
+        results = {path for path, (_, result) in progress.items() if result is not None}
+        if not sinks or not results:
+            return False
+        return not results <= set.intersection(*(sink.written_files() for sink in sinks))
+
+    def _journal_rows(self, rows, journal):
+        """
+        Journal each (data, result row, error) and yield (file path, status, row), row None for failed searches.
+        Failures are only journaled once a later search works, so a run that stops on a string of them (most likely
+        rate limited or offline) leaves those files to be searched again on the next run.
+        """
+        failures = []
+        for data, row, error in rows:
+            file_path = os.path.abspath(os.path.join(data['dir'], data['file']))
+            if error:
+                print(f"Error searching for {file_path}: {error}")
+                failures.append((file_path, "failed", None, error, time.time()))
+                # duplicates share one search, so their failures only count once
+                searches = len({self._clusters.get(failure[0], failure[0]) for failure in failures})
+                if searches >= MAX_FAILURES_IN_A_ROW:
+                    raise RuntimeError(f"{searches} searches failed in a row, stopping (re-run to resume)")
+                continue
 
+            mp3_db.put_progress(journal, failures)
+            for failure in failures:
+                yield failure[0], "failed", None
+            failures = []
+
+            status = "ok" if output_sinks.best_spotify_id(row) else "unk"
+            mp3_db.put_progress(journal, [(file_path, status, json.dumps(row), None, time.time())])
+            yield file_path, status, row
+
+        mp3_db.put_progress(journal, failures)
+        for failure in failures:
+            yield failure[0], "failed", None
+
+    def _print_stats(self):
+        if self.search_cache:
+            stats = self.search_cache.stats()
+            print(f"Search cache hits: {stats['hits']}, misses: {stats['misses']}")
+        if self.track_index:
+            stats = self.track_index.stats()
+            print(f"Track index hits: {stats['hits']}, misses: {stats['misses']}")
+        if self._clusters:
+            print(f"Duplicate audio: {len(self._clusters)} files in {len(set(self._clusters.values()))} clusters, "
+                  f"{len(self._clusters) - len(self._cluster_searches)} searches saved")
+
+    def _rewrite_outputs(self, journal, directory, outputs, mp3_path, db_path, batch_size, recurse=True):
+        """write every journaled result under directory (only its own files if not recurse) to the outputs again,
+           replacing what they held"""
+
+        sinks = output_sinks.open_sinks(outputs, mp3_path, db_path, False, batch_size)
+        try:
+            for result in mp3_db.get_progress_results(journal, directory):
+                row = json.loads(result)
+                if recurse or os.path.abspath(row["dir"]) == directory:
+                    for sink in sinks:
+                        sink.write(row)
+        finally:
+            for sink in sinks:
+                sink.close()
+
+    def _search_rows_concurrent(self, all_data, duration_tolerance, workers):
+        """yield (data, result row, error) in input order, with at most workers searches in flight"""
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            in_flight = deque()
+            for data in all_data:
+                in_flight.append(pool.submit(self._safe_search_row, data, duration_tolerance))
+                if len(in_flight) >= workers:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+
+    def _safe_search_row(self, data, duration_tolerance):
+        """(data, result row, None), or (data, None, error) if the search failed"""
+
+        try:
+            return data, self._search_row(data, duration_tolerance), None
+        except Exception as e:
+            return data, None, f"{type(e).__name__}: {e}"
+
+    def _search_row(self, data, duration_tolerance):
+        """search spotify for one mp3's data and return its result row (see output_sinks.ROW_FIELDS)"""
+
+        # search in spotify
+        # need highest popularity track with specified duration tolerance
+        print(f"processing {data['file']}")
+        cluster = self._clusters.get(os.path.abspath(os.path.join(data['dir'], data['file'])))
+        if cluster:
+            # duplicates of audio share one search, made with the tags of the cluster's representative (the
+            # largest file, see audio_duplicates.duplicate_clusters) whichever member gets here first
+            result = self._search_once(cluster, lambda: self._search_tags(self._cluster_tags(cluster, data),
+                                                                          duration_tolerance))
+            if not result and not self._same_tags(self._cluster_tags(cluster, data), data):
+                # nothing found with the representative's tags, this member's own may do better
+                result = self._search_tags(data, duration_tolerance)
+        else:
+            result = self._search_tags(data, duration_tolerance)
+        if result:
+            duration = result['duration']
+            sp_id = result['id']
+            sp_id2 = result['id2']
+            score = result['score']
+        else:
+            duration = sp_id = sp_id2 = score = "UNK"
+
+        return {"artist": data['artist'], "title": data['title'], "album": data['album'], "mp3_duration": data['duration'],
+                "spotify_duration": duration, "sp_id": sp_id, "sp_id2": sp_id2, "score": score,
+                "file": data['file'], "dir": data['dir']}
+
+
+    def _search_tags(self, data, duration_tolerance):
+        """spotify_search for an mp3's tags"""
+
+        # remove words with ' in them
+        title = " ".join([m for m in data["title"].split() if "'" not in m])
+        return self.spotify_search(data["artist"], title, 
+                                   True, duration_tolerance, data["duration"])
+
+    def _cluster_tags(self, cluster, data):
+        """tags of a duplicate cluster's representative (its path is the cluster key), data's own if it is the
+           representative or the representative can't be read"""
+
+        if cluster == os.path.abspath(os.path.join(data['dir'], data['file'])):
+            return data
+        with self._cluster_lock:
+            tags = self._cluster_reps.get(cluster)
+        if tags is None:
+            try:
+                tags = self.mp3_utils.get_mp3_data(os.path.basename(cluster), os.path.dirname(cluster))
+            except Exception as e:
+                print(f"Error reading {cluster}, searching with the tags of {data['file']}: {e}")
+                tags = data
+            with self._cluster_lock:
+                self._cluster_reps[cluster] = tags
+        return tags
+
+    @staticmethod
+    def _same_tags(a, b):
+        return (a["artist"], a["title"], a["duration"]) == (b["artist"], b["title"], b["duration"])
+
+    def _search_once(self, key, search):
+        """run search once per key, other callers with the key (in any thread) get the same result"""
+
+        with self._cluster_lock:
+            future = self._cluster_searches.get(key)
+            first = future is None
+            if first:
+                future = self._cluster_searches[key] = Future()
+        if first:
+            try:
+                future.set_result(search())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    @metrics.timed("spotify_search")
     def spotify_search(self, artist, title, most_popular=True, duration_tolerance=0, duration=0):
         """return most popular or all match(es) from spotify for artist and title and optionaly check duration_tolerance (as %) given duration"""
 
         most_popular = False if most_popular in (False, 0, "0") else True
         duration_tolerance = int(duration_tolerance)/100 if duration_tolerance else 0
         duration = int(duration) if duration else 0
-        search_str = "artist:{0} track:{1}".format(artist, title)
-        result = self.sp.search(q=search_str, type='track', market='GB')
+        result = self._index_search(artist, title)
+        if result is None:
+            search_str = "artist:{0} track:{1}".format(artist, title)
+            result = self._search_tracks(search_str, 'GB')
         max_popularity = 0
 
         return_result = {}
@@ -104,77 +514,83 @@ class MP3SpotifyUtils(Utils):
         
         return return_result
         
-    def matching(self, title, artist, duration, results):
+    def _search_tracks(self, search_str, market):
+        """sp.search for tracks, going through the search cache if there is one"""
+
+        if self.search_cache:
+            result = self.search_cache.get(search_str, market)
+            if result is not None:
+                return result
+
+        result = self.sp.search(q=search_str, type='track', market=market)
+        if self.search_cache:
+            result = self.search_cache.put(search_str, market, result)
+        if self.track_index:
+            self.track_index.add_items(result['tracks']['items'])
+        return result
+
+    def _index_search(self, artist, title):
+        """search result shaped dict of local index matches for artist/title, or None if no index or no match"""
+
+        if not self.track_index:
+            return None
+        items = self.track_index.search(artist, title)
+        return {"tracks": {"items": items}} if items else None
+
+    @metrics.timed("matching")
+    def matching(self, title, artist, duration=None, results=None):
         """from claude"""
         
-        duration_ms = duration * 1000
-        
-        # Score and rank the results
-        scored_results = []
-        for track in results['tracks']['items']:
-            score = 0
-            # Title similarity (0-1)
-            title_similarity = SequenceMatcher(None, title.lower(), track['name'].lower()).ratio()
-            score += title_similarity * 0.4  # 40% weight
+        # also called as matching(track_record, results)
+        if isinstance(title, TrackRecord):
+            results = artist
+            title, artist, duration = title.title, title.artist, title.duration
 
-            # Artist similarity (0-1)
-            artist_similarity = SequenceMatcher(None, artist.lower(), track['artists'][0]['name'].lower()).ratio()
-            score += artist_similarity * 0.3  # 30% weight
+        # without results, score what the local index knows about
+        if results is None:
+            results = self._index_search(artist, title)
+            if results is None:
+                return None
 
-            # Duration similarity (0-1)
-            duration_diff = abs(duration_ms - track['duration_ms'])
-            duration_similarity = max(0, 1 - (duration_diff / duration_ms))
-            score += duration_similarity * 0.2  # 20% weight
+        return score_candidates(title, artist, duration, results)
 
-            # Popularity (0-1)
-            popularity = track['popularity'] / 100
-            score += popularity * 0.1  # 10% weight
+    @metrics.timed("matching_batch")
+    def matching_batch(self, queries, similarity="ratio"):
+        """score many (title or track record, artist, duration, results) at once, returns matching() output per query"""
 
-            scored_results.append((score, track))
+        queries = [(q[0].title, q[0].artist, q[0].duration, q[-1]) if isinstance(q[0], TrackRecord) else q
+                   for q in queries]
+        return score_batch(queries, similarity)
 
-        # Sort by score (highest first)
-        scored_results.sort(reverse=True, key=lambda x: x[0])
 
-        # Return the best match
-        best_match = scored_results[0][1]
-        return {"match_id": best_match['id'], "score": round(scored_results[0][0],1)}
-
-
-    def get_playlists(self):
+    def get_playlists(self, workers=4):
         """return ids of all user playlists"""
 
-        playlists = self.sp.user_playlists(self.username)
+        playlists = fetch_all_pages(lambda limit, offset: self.sp.user_playlists(self.username, limit=limit, offset=offset),
+                                    50, workers)
 
-        for playlist in playlists['items']:
+        for playlist in playlists:
             print("{0}~{1}".format(playlist['name'], playlist['uri']))
             
-    def get_playlist_tracks(self, playlist_id): 
+    def get_playlist_tracks(self, playlist_id, workers=4): 
         """ get all tracks in a playlist"""
         
         print("artist~track~duration(s)~uri")
-        results = self.sp.playlist(playlist_id)
-        for track in results['tracks']['items']:
+        items = fetch_all_pages(lambda limit, offset: self.sp.playlist_items(playlist_id, limit=limit, offset=offset),
+                                100, workers)
+        for track in items:
+            if not track['track']:
+                continue
             artist = track['track']['artists'][0]['name']
             track_name = track['track']['name'] 
             duration = int(track['track']['duration_ms']/1000)
             uri = track['track']['uri']
             print(f"{artist}~{track_name}~{duration}~{uri}")
             
-    def get_liked_tracks(self, filepath=None, limit=50):
+    def get_liked_tracks(self, filepath=None, limit=50, workers=4):
         """ get all liked tracks"""
 
-        offset = 0
-
-        all_tracks = []
-        while True:
-            results = self.sp.current_user_saved_tracks(limit=limit, offset=offset)
-
-            if not results['items']:
-                break  # No more tracks
-
-            all_tracks.extend(results['items'])
-            offset += limit
-            time.sleep(0.1)
+        all_tracks = fetch_all_pages(self.sp.current_user_saved_tracks, limit, workers)
 
         output_lines = ["artist~track~duration(s)~uri"]
         for item in all_tracks:
@@ -194,10 +610,116 @@ class MP3SpotifyUtils(Utils):
                 print(line)
         
 
+    def index_liked_tracks(self, workers=4):
+        """add all liked tracks to the local track index (SPOTIPY_TRACK_INDEX)"""
+
+        if not self.track_index:
+            return "No track index, set SPOTIPY_TRACK_INDEX"
+
+        items = fetch_all_pages(self.sp.current_user_saved_tracks, 50, workers)
+        return f"Indexed {self.track_index.add_items(items)} tracks, {len(self.track_index)} in index"
+
+    def index_playlist_tracks(self, playlist_id, workers=4):
+        """add all tracks in a playlist to the local track index (SPOTIPY_TRACK_INDEX)"""
+
+        if not self.track_index:
+            return "No track index, set SPOTIPY_TRACK_INDEX"
+
+        items = fetch_all_pages(lambda limit, offset: self.sp.playlist_items(playlist_id, limit=limit, offset=offset),
+                                100, workers)
+        return f"Indexed {self.track_index.add_items(items)} tracks, {len(self.track_index)} in index"
+
+    def hydrate_tracks(self, track_ids, refresh=0, workers=4):
+        """
+        Full track objects for a list (or comma separated string) of spotify ids/uris/urls, 50 per request, each
+        distinct id requested once.
+        Ids already in the track index are served from it unless refresh, fetched tracks are added to it.
+        Returns {id: track or None if Spotify doesn't know it}
+        """
+        if isinstance(track_ids, str):
+            track_ids = [track_id for track_id in track_ids.split(",") if track_id.strip()]
+        refresh = bool(int(refresh))
+        ids = [_track_id(track_id) for track_id in track_ids]
+
+        tracks = {}
+        if self.track_index and not refresh:
+            tracks = self.track_index.get(set(ids))
+        missing = [track_id for track_id in ids if track_id not in tracks]
+        if missing:
+            fetched = fetch_by_ids(lambda batch: self.sp.tracks(batch, market='GB'), missing, workers=int(workers))
+            if self.track_index:
+                self.track_index.add_items(track for track in fetched.values() if track)
+            tracks.update(fetched)
+        return tracks
+
+    def revalidate_db(self, db_path, directory=None, workers=4, clear=0):
+        """check the spotify_id of every matched track in the db (optionally under directory) still resolves to a
+           playable track, 50 per request. Sets last_checked on the valid ones, clear=1 also removes the invalid ids"""
+
+        conn = mp3_db.optimize_db_connection(db_path)
+        matched = mp3_db.get_matched_tracks(conn, directory)
+        tracks = self.hydrate_tracks((spotify_id for _, spotify_id in matched), refresh=True, workers=workers)
+
+        valid = []
+        invalid = []
+        relinked = 0
+        for file_path, spotify_id in matched:
+            track = tracks[_track_id(spotify_id)]
+            # with a market, tracks not available there come back unplayable (or relinked to another id)
+            if track and track.get('is_playable', True):
+                valid.append(file_path)
+                relinked += 'linked_from' in track
+            else:
+                invalid.append(file_path)
+                print(f"no longer available: {spotify_id}~{file_path}")
+
+        checked = datetime.datetime.now().isoformat(timespec='seconds')
+        mp3_db.set_last_checked(conn, valid, checked)
+        if int(clear):
+            mp3_db.clear_spotify_ids(conn, invalid, checked)
+        conn.close()
+        return {"tracks": len(matched), "ids": len(tracks), "valid": len(valid), "invalid": len(invalid),
+                "relinked": relinked, "requests": -(-len(tracks) // 50)}
+
     def add_to_playlist(self, playlist_id, track_id):
         """ add track to playlist"""
         
-        self.sp.playlist_add_items(playlist_id, [track_id])
+        with metrics.timer("playlist_mutation", method="playlist_add_items"):
+            self.sp.playlist_add_items(playlist_id, [track_id])
+
+
+class _FolderRun(object):
+    """one folder's outputs and counts during library_to_spotify"""
+    def __init__(self, utils, path, outputs, resume, batch_size, progress):
+        self.utils = utils
+        self.path = path
+        self.outputs = outputs
+        self.batch_size = batch_size
+        self.counts = {"ok": 0, "unk": 0, "failed": 0}
+        self.sinks = output_sinks.open_sinks(outputs, path, None, resume and bool(progress), batch_size) if outputs else []
+        # progress is the journal of this folder's own files
+        self.rewrite = utils._outputs_missing(self.sinks, progress)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def finish(self, journal, prefix):
+        self.close()
+        if self.rewrite and self.outputs:
+            self.utils._rewrite_outputs(journal, self.path, self.outputs, self.path, None, self.batch_size, recurse=False)
+        print(f"{prefix} {self.path}: {self.counts['ok']} found, {self.counts['unk']} not found, "
+              f"{self.counts['failed']} failed", flush=True)
+
+
+def _track_id(value):
+    """bare track id from an id, spotify:track: uri or open.spotify.com url"""
+    value = value.strip()
+    if value.startswith('spotify:track:'):
+        return value[len('spotify:track:'):]
+    if '/track/' in value:
+        return value.split('/track/', 1)[1].split('?', 1)[0]
+    return value
 
 
 if __name__ == '__main__':
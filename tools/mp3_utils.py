@@ -1,14 +1,34 @@
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
 import os
 import sys
+from mutagen.id3 import ID3, ID3NoHeaderError
 from mutagen.mp3 import MP3
 from utils import Utils
+import metrics
+import mp3_db
+
+# bytes read after the ID3 tag for the first frame's header, side info and Xing/VBRI frame count, widened to
+# FRAME_SEARCH_BYTES if no frame sync is found in the first read (e.g. padding after the tag)
+# the rest of the Xing header (toc, LAME tag) is only read if its flags say it is there
+FRAME_READ_BYTES = 64
+FRAME_SEARCH_BYTES = 4096
+
+# sample rates by MPEG version bits (3 = MPEG1, 2 = MPEG2, 0 = MPEG2.5) and rate index
+MPEG_SAMPLE_RATES = {3: (44100, 48000, 32000),
+                     2: (22050, 24000, 16000),
+                     0: (11025, 12000, 8000)}
 
 class Mp3Utils(Utils):
     """    Various MP3 utils    """
-    def __init__(self):
+    def __init__(self, fast_read=False):
         Utils.__init__(self)
 
+        # only read the ID3 tag and Xing/VBRI header, see get_mp3_data_fast
+        self.fast_read = fast_read
+
         self.mp3_tags = {
                          "TIT2": "title",
                          "TPE1": "artist",
@@ -17,48 +37,247 @@ class Mp3Utils(Utils):
                          "TCON": "genre"
                         }
 
-    def get_mp3_data_per_dir(self, directory, recurse=0):
-        """return all mp3 data for a given directory"""
+        # (file path, error) for files that failed during the last parallel scan
+        self.scan_errors = []
+
+    def get_mp3_data_per_dir(self, directory, recurse=0, workers=0, processes=0, db_path=None):
+        """return all mp3 data for a given directory, optionally reading tags on a pool of workers or via the tracks db"""
         
-        mp3_data = []
-        for files in self.list_mp3_files(directory, recurse):
-            mp3_data.append(self.get_mp3_data(files[0], files[1]))
-            
-        return mp3_data
+        workers = int(workers)
+        if db_path:
+            return self.get_mp3_data_from_db(directory, db_path, recurse, workers, processes)
+
+        return list(self.iter_mp3_data(directory, recurse, workers, processes))
+
+    def iter_mp3_data(self, directory, recurse=0, workers=0, processes=0):
+        """yield mp3 data for each file in a directory as it is read, optionally on a pool of workers"""
+
+        self.scan_errors = []
+        mp3_files = self.iter_mp3_files(directory, recurse)
+        if int(workers) > 0:
+            yield from self._iter_mp3_data_parallel(mp3_files, workers, processes, self.scan_errors)
+        else:
+            yield from self._iter_mp3_data_serial(mp3_files, self.scan_errors)
+
+    def _iter_mp3_data_serial(self, mp3_files, errors):
+        """yield mp3 data in input order, appending failures to errors as the parallel read does"""
+
+        for file_info in mp3_files:
+            data, error = self._safe_get_mp3_data(file_info)
+            if error:
+                errors.append(error)
+            else:
+                yield data
 
-    def print_mp3_data_per_dir(self, directory, recurse=0):
+    def get_mp3_data_parallel(self, mp3_files, workers=4, processes=0):
+        """read tags for a list of (filename,directory) on a thread (or process) pool, returns (mp3_data, errors) in input order"""
+
+        errors = []
+        mp3_data = list(self._iter_mp3_data_parallel(mp3_files, workers, processes, errors))
+        return mp3_data, errors
+
+    def _iter_mp3_data_parallel(self, mp3_files, workers, processes, errors):
+        """yield mp3 data in input order from a pool, with a bounded number of chunks in flight, appending failures to errors"""
+
+        workers = int(workers)
+        processes = int(processes)
+        pool_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        # larger chunks cut the pickling round trips when using processes
+        chunksize = 64 if processes else 1
+
+        with pool_class(max_workers=workers) as pool:
+            in_flight = deque()
+            chunk = []
+            for file_info in mp3_files:
+                chunk.append(file_info)
+                if len(chunk) == chunksize:
+                    in_flight.append(pool.submit(self._safe_get_mp3_data_chunk, chunk))
+                    chunk = []
+                    # keep a few chunks per worker queued, then yield before reading further
+                    if len(in_flight) >= workers * 4:
+                        yield from self._collect_chunk(in_flight.popleft(), errors)
+            if chunk:
+                in_flight.append(pool.submit(self._safe_get_mp3_data_chunk, chunk))
+            while in_flight:
+                yield from self._collect_chunk(in_flight.popleft(), errors)
+
+    def _collect_chunk(self, future, errors):
+        for data, error in future.result():
+            if error:
+                errors.append(error)
+            else:
+                yield data
+
+    def _safe_get_mp3_data_chunk(self, chunk):
+        return [self._safe_get_mp3_data(file_info) for file_info in chunk]
+
+    def _safe_get_mp3_data(self, file_info):
+        """get_mp3_data for pool workers, returns (data, None) or (None, (path, error)) so one bad file doesn't stop the scan"""
+
+        try:
+            return self.get_mp3_data(file_info[0], file_info[1]), None
+        except Exception as e:
+            return None, (os.path.join(file_info[1], file_info[0]), str(e))
+
+    def print_mp3_data_per_dir(self, directory, recurse=0, workers=0, processes=0):
         """print all mp3 data for a given directory"""
         
-        mp3_data = self.get_mp3_data_per_dir(directory, recurse)
-        for record in mp3_data:
-            print(f"{record['file']},{record['duration']}")
+        for record in self.iter_mp3_data(directory, recurse, workers, processes):
+            print(f"{record['file']},{record['duration']}", flush=True)
+        for path, error in self.scan_errors:
+            print(f"ERROR {path}: {error}")
 
 
 
     def list_mp3_files(self, directory, recurse=0):
         """return all mp3 files, as list of tuples of (filename,directory)"""
-        mp3_files = []
+
+        return list(self.iter_mp3_files(directory, recurse))
+
+    def iter_mp3_files(self, directory, recurse=0):
+        """yield all mp3 files as tuples of (filename,directory), as they are found"""
 
         # allow for command line string passed
         recurse = int(recurse)
 
-        if recurse:
-            for root, dirs, files in os.walk(directory):
-                for file in files:
-                    if file.lower().endswith('.mp3'):
-                        mp3_files.append((file, root))
-        else:
-            for file in os.listdir(directory):
-                if file.lower().endswith('.mp3'):
-                    mp3_files.append((file, directory))
+        for entry in self._scan_mp3_entries(directory, recurse):
+            yield entry.name, os.path.dirname(entry.path)
 
-        return mp3_files
 
+    def scan_library(self, directory, db_path, workers=0, processes=0, batch_size=1000, recurse=1):
+        """incrementally scan a directory (tree if recurse) into the tracks table, only reading tags of new or changed files"""
 
+        directory = os.path.abspath(directory)
+        workers = int(workers)
+        batch_size = int(batch_size)
+        recurse = int(recurse)
+
+        conn = mp3_db.optimize_db_connection(db_path)
+        try:
+            mp3_db.create_optimized_schema(conn)
+            known = mp3_db.get_file_stats(conn, directory)
+            if not recurse:
+                # tracks in sub directories aren't scanned, so they mustn't be taken as removed
+                known = {path: stat for path, stat in known.items() if os.path.dirname(path) == directory}
+
+            changed = []
+            stats = {}
+            seen = 0
+            for entry in self._scan_mp3_entries(directory, recurse):
+                seen += 1
+                st = entry.stat()
+                path = entry.path
+                if known.pop(path, None) != (st.st_size, st.st_mtime):
+                    changed.append((entry.name, os.path.dirname(path)))
+                    stats[path] = (st.st_size, st.st_mtime)
+
+            # anything left in known was not found on disk
+            removed = list(known)
+            if removed:
+                mp3_db.delete_tracks(conn, removed)
+
+            errors = []
+            for start in range(0, len(changed), batch_size):
+                batch = changed[start:start + batch_size]
+                if workers > 0:
+                    mp3_data, batch_errors = self.get_mp3_data_parallel(batch, workers, processes)
+                else:
+                    mp3_data = []
+                    batch_errors = []
+                    for file_info in batch:
+                        data, error = self._safe_get_mp3_data(file_info)
+                        if error:
+                            batch_errors.append(error)
+                        else:
+                            mp3_data.append(data)
+                errors.extend(batch_errors)
+
+                rows = []
+                for data in mp3_data:
+                    path = os.path.join(data["dir"], data["file"])
+                    rows.append((path, data["title"], data["artist"], data["album"],
+                                 data["duration"] * 1000, *stats[path], data["track"], data["genre"], data["year"]))
+                mp3_db.upsert_scanned_tracks(conn, rows)
+        finally:
+            conn.close()
+
+        self.scan_errors = errors
+        return {"files": seen,
+                "updated": len(changed) - len(errors),
+                "unchanged": seen - len(changed),
+                "removed": len(removed),
+                "errors": len(errors)}
+
+    def get_mp3_data_from_db(self, directory, db_path, recurse=0, workers=0, processes=0):
+        """bring the tracks db up to date for directory (and sub directories if recurse) then return mp3 data from it"""
+
+        directory = os.path.abspath(directory)
+        recurse = int(recurse)
+        self.scan_library(directory, db_path, workers, processes, recurse=recurse)
+
+        conn = mp3_db.optimize_db_connection(db_path)
+        try:
+            rows = mp3_db.get_tracks(conn, directory)
+        finally:
+            conn.close()
+
+        mp3_data = []
+        for file_path, title, artist, album, track, genre, year, duration_ms in rows:
+            file_dir, mp3_file = os.path.split(file_path)
+            if not recurse and file_dir != directory:
+                continue
+            mp3_data.append(TrackRecord(title, artist, album, track, genre, year,
+                                        round(duration_ms / 1000), mp3_file, file_dir))
+
+        return mp3_data
+
+    def _scan_mp3_entries(self, directory, recurse=0):
+        """yield os.DirEntry for each mp3 file in directory (and sub directories if recurse)
+           symlinked directories aren't followed (as with os.walk), so a link loop can't recurse forever
+           and a link to another folder of the library doesn't get its files scanned twice"""
+
+        with os.scandir(directory) as entries:
+            sub_dirs = []
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith('.mp3'):
+                    yield entry
+                elif recurse and entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.path)
+
+        for sub_dir in sub_dirs:
+            yield from self._scan_mp3_entries(sub_dir, recurse)
+
+    @metrics.timed("get_mp3_data")
     def get_mp3_data(self, mp3_file, directory):
         """return data for an mp3 file (artist, track, duration in secs) """
     
+        if self.fast_read:
+            return self.get_mp3_data_fast(mp3_file, directory)
+
         audio = MP3(os.path.join(directory, mp3_file))
+        return self._build_mp3_data(audio, audio.info.length, mp3_file, directory)
+
+    def get_mp3_data_fast(self, mp3_file, directory):
+        """as get_mp3_data but only reads the ID3v2 tag and the Xing/VBRI frame, falls back to get_mp3_data without them"""
+
+        with open(os.path.join(directory, mp3_file), "rb") as f:
+            tag_bytes, length = read_mp3_headers(f)
+
+            if length is None:
+                # e.g. CBR files, which have no Xing/VBRI header, mutagen works the length out from the same handle
+                f.seek(0)
+                audio = MP3(f)
+                return self._build_mp3_data(audio, audio.info.length, mp3_file, directory)
+
+        tags = {}
+        if tag_bytes:
+            try:
+                tags = ID3(BytesIO(tag_bytes))
+            except ID3NoHeaderError:
+                pass
+        return self._build_mp3_data(tags, length, mp3_file, directory)
+
+    def _build_mp3_data(self, audio, length, mp3_file, directory):
         mp3_data = {}
         for tag in self.mp3_tags:
             mp3_data[self.mp3_tags[tag]] = audio.get(tag, ["UNK"])[0]
@@ -67,13 +286,212 @@ class Mp3Utils(Utils):
         mp3_data["year"] = str(audio.get("TDRC", audio.get("TYER", ["UNK"]))[0]).split("-")[0]
 
 
-        mp3_data["duration"] = round(audio.info.length)
+        mp3_data["duration"] = round(length)
         mp3_data["file"] = mp3_file
         mp3_data["dir"] = directory
 
-        return mp3_data
+        return TrackRecord(**mp3_data)
+
+
+class TrackRecord(object):
+    """compact record of one mp3 file's data, with dict style access so code written for the old per-file dicts still works
+       repeated strings (artist, album, genre, dir) are interned so a library's worth of records share them
+    """
+    __slots__ = ("title", "artist", "album", "track", "genre", "year", "duration", "file", "dir")
+
+    def __init__(self, title, artist, album, track, genre, year, duration, file, dir):
+        self.title = title
+        self.artist = sys.intern(str(artist))
+        self.album = sys.intern(str(album))
+        self.track = track
+        self.genre = sys.intern(str(genre))
+        self.year = year
+        self.duration = duration
+        self.file = file
+        self.dir = sys.intern(dir)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        if isinstance(other, (TrackRecord, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return f"TrackRecord({self.to_dict()!r})"
+
+    def __reduce__(self):
+        # rebuild through __init__ so strings are interned again in the receiving process
+        return (TrackRecord, tuple(self.values()))
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, key) for key in self.__slots__]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def file_path(self):
+        return os.path.join(self.dir, self.file)
+
+    def db_row(self, spotify_id=None, last_checked=None):
+        """row for mp3_db.batch_insert_tracks"""
+        return (self.file_path(), self.title, self.artist, self.album,
+                self.duration * 1000, spotify_id, last_checked)
+
+
+def read_mp3_headers(f):
+    """read the ID3v2 tag and first audio frame of an open mp3 file, returns (tag bytes, length in secs or None)
+       length is only known if the first frame has a Xing/Info or VBRI header
+    """
+
+    tag_bytes = f.read(10)
+    if len(tag_bytes) == 10 and tag_bytes[:3] == b"ID3":
+        # syncsafe size excludes the 10 byte header and the optional 10 byte footer
+        size = (tag_bytes[6] << 21) | (tag_bytes[7] << 14) | (tag_bytes[8] << 7) | tag_bytes[9]
+        if tag_bytes[5] & 0x10:
+            size += 10
+        tag_bytes += f.read(size)
+        frame_bytes = f.read(FRAME_READ_BYTES)
+    else:
+        frame_bytes = tag_bytes + f.read(FRAME_READ_BYTES - len(tag_bytes))
+        tag_bytes = b""
+
+    pos = _find_frame_sync(frame_bytes)
+    if pos is None and len(frame_bytes) == FRAME_READ_BYTES:
+        frame_bytes += f.read(FRAME_SEARCH_BYTES - FRAME_READ_BYTES)
+        pos = _find_frame_sync(frame_bytes)
+
+    # read on while the first frame's Xing/VBRI header runs past what has been read
+    if pos is not None:
+        end = _vbr_header_end(frame_bytes, pos)
+        while end > len(frame_bytes):
+            more = f.read(end - len(frame_bytes))
+            if not more:
+                break
+            frame_bytes += more
+            end = _vbr_header_end(frame_bytes, pos)
+
+    return tag_bytes, _vbr_header_length(frame_bytes)
+
+
+def _find_frame_sync(data):
+    """position of the first mpeg frame sync (11 set bits) with a full, valid header in data, or None
+       headers with reserved version, layer, bitrate or sample rate bits are taken as garbage (e.g. in padding
+       after the tag) that happens to hold the sync bits, and the search goes on past them"""
+
+    pos = data.find(b"\xff")
+    while pos != -1 and pos + 4 <= len(data):
+        if (data[pos + 1] & 0xE0 == 0xE0
+                and (data[pos + 1] >> 3) & 3 != 1       # reserved version
+                and (data[pos + 1] >> 1) & 3 != 0       # reserved layer
+                and data[pos + 2] >> 4 != 0xF           # bad bitrate index
+                and (data[pos + 2] >> 2) & 3 != 3):     # reserved sample rate
+            return pos
+        pos = data.find(b"\xff", pos + 1)
+    return None
+
+
+def _frame_xing_pos(data, pos):
+    """(sample rate, samples per frame, Xing header position) of the layer III frame at pos, or None"""
+
+    version = (data[pos + 1] >> 3) & 3       # 3 = MPEG1, 2 = MPEG2, 0 = MPEG2.5
+    layer = (data[pos + 1] >> 1) & 3         # 1 = layer III
+    rate_index = (data[pos + 2] >> 2) & 3
+    mono = (data[pos + 3] >> 6) & 3 == 3
+    if version == 1 or layer != 1 or rate_index == 3:
+        return None
+
+    sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+    samples_per_frame = 1152 if version == 3 else 576
+
+    if version == 3:
+        xing_pos = pos + 4 + (17 if mono else 32)
+    else:
+        xing_pos = pos + 4 + (9 if mono else 17)
+    return sample_rate, samples_per_frame, xing_pos
+
+
+def _xing_lame_pos(data, xing_pos):
+    """position of the LAME tag after the Xing header at xing_pos, it follows the optional bytes, toc and quality fields"""
+
+    flags = int.from_bytes(data[xing_pos + 4:xing_pos + 8], "big")
+    return xing_pos + 12 + (4 if flags & 2 else 0) + (100 if flags & 4 else 0) + (4 if flags & 8 else 0)
+
+
+def _vbr_header_end(data, pos):
+    """bytes of data needed to read the Xing/Info (with any LAME tag) or VBRI header of the frame at pos"""
+
+    frame = _frame_xing_pos(data, pos)
+    if frame is None:
+        return pos + 4
+    xing_pos = frame[2]
+
+    # up to the Xing frame count and the VBRI frame count
+    end = max(xing_pos + 12, pos + 36 + 18)
+    if len(data) < end or data[xing_pos:xing_pos + 4] not in (b"Xing", b"Info"):
+        return end
+    return _xing_lame_pos(data, xing_pos) + 24
+
+
+def _vbr_header_length(data):
+    """length in secs from the Xing/Info or VBRI header of the first mpeg frame in data, or None"""
+
+    # skip any padding between the tag and the first frame
+    pos = _find_frame_sync(data)
+    if pos is None:
+        return None
+
+    frame = _frame_xing_pos(data, pos)
+    if frame is None:
+        return None
+    sample_rate, samples_per_frame, xing_pos = frame
+
+    if data[xing_pos:xing_pos + 4] in (b"Xing", b"Info"):
+        flags = int.from_bytes(data[xing_pos + 4:xing_pos + 8], "big")
+        if not flags & 1:
+            return None
+        frames = int.from_bytes(data[xing_pos + 8:xing_pos + 12], "big")
+
+        # the LAME tag holds the encoder delay/padding
+        lame_pos = _xing_lame_pos(data, xing_pos)
+        gap = 0
+        if data[lame_pos:lame_pos + 4] == b"LAME" and len(data) >= lame_pos + 24:
+            delay_padding = int.from_bytes(data[lame_pos + 21:lame_pos + 24], "big")
+            gap = (delay_padding >> 12) + (delay_padding & 0xFFF)
+        return max(0, frames * samples_per_frame - gap) / sample_rate
 
+    vbri_pos = pos + 36
+    if data[vbri_pos:vbri_pos + 4] == b"VBRI":
+        frames = int.from_bytes(data[vbri_pos + 14:vbri_pos + 18], "big")
+        return frames * samples_per_frame / sample_rate
 
+    return None
 
 if __name__ == '__main__':
     utils = Mp3Utils()._run(sys.argv)
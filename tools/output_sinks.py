@@ -0,0 +1,243 @@
+""" Output sinks for mp3_to_spotify results: the original ~ delimited spotify.txt, quoted CSV, the mp3_db tracks table
+    and Parquet. Rows are buffered and flushed in batches, and each sink can say which files it already holds so an
+    interrupted run can carry on where it stopped.
+"""
+
+import csv
+import datetime
+import glob
+import os
+
+import mp3_db
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# fields of a result row, as built by MP3SpotifyUtils._search_row
+ROW_FIELDS = ("artist", "title", "album", "mp3_duration", "spotify_duration", "sp_id", "sp_id2", "score", "file", "dir")
+
+# columns of spotify.txt, kept as they were for the tools that read it
+TXT_FIELDS = ("artist", "title", "mp3_duration", "spotify_duration", "sp_id", "sp_id2", "score", "file", "dir")
+
+# rows buffered before a flush
+DEFAULT_BATCH_SIZE = 200
+
+# file names of each kind of output in the mp3 directory
+OUTPUT_NAMES = {"txt": "spotify.txt", "csv": "spotify.csv", "parquet": "spotify.parquet"}
+
+
+def _typed_row(row):
+    """a row read back from an output, with its numbers as numbers again and missing values as UNK"""
+    row = {name: row.get(name, "") for name in ROW_FIELDS}
+    for name, convert in (("mp3_duration", int), ("spotify_duration", int), ("score", float)):
+        try:
+            row[name] = convert(row[name])
+        except (TypeError, ValueError):
+            row[name] = "UNK"
+    for name in ("sp_id", "sp_id2"):
+        if row[name] in (None, ""):
+            row[name] = "UNK"
+    return row
+
+
+def best_spotify_id(row):
+    """the scored match (sp_id2) if there is one, else the most popular (sp_id), None if neither was found"""
+    for key in ("sp_id2", "sp_id"):
+        if row[key] not in (None, "", "UNK"):
+            return row[key]
+    return None
+
+
+class OutputSink(object):
+    """buffers rows and hands them to _write_batch batch_size at a time"""
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+        self.batch_size = int(batch_size)
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self._write_batch(self.rows)
+            self.rows = []
+
+    def close(self):
+        self.flush()
+
+    def written_files(self):
+        """paths of the files already written by an earlier run, absolute so every sink's paths compare equal"""
+        return set()
+
+    def written_rows(self):
+        """the rows already written by an earlier run, None if they can't be read back"""
+        return None
+
+    def _write_batch(self, rows):
+        raise NotImplementedError
+
+
+class TxtSink(OutputSink):
+    """the original spotify.txt, one ~ delimited line per track"""
+    def __init__(self, path, resume=False, batch_size=DEFAULT_BATCH_SIZE):
+        OutputSink.__init__(self, batch_size)
+        self.path = path
+        append = resume and os.path.exists(path)
+        self.f = open(path, "a" if append else "w", encoding="utf-8")
+        if not append:
+            self.f.write("~".join(TXT_FIELDS) + "\n")
+            self.f.flush()
+
+    def written_files(self):
+        files = set()
+        with open(self.path, encoding="utf-8") as f:
+            next(f, None)
+            for line in f:
+                fields = line.rstrip("\n").split("~")
+                if len(fields) == len(TXT_FIELDS):
+                    files.add(os.path.abspath(os.path.join(fields[-1], fields[-2])))
+        return files
+
+    def written_rows(self):
+        # spotify.txt has no album
+        with open(self.path, encoding="utf-8") as f:
+            next(f, None)
+            return [_typed_row(dict(zip(TXT_FIELDS, fields))) for fields in (line.rstrip("\n").split("~") for line in f)
+                    if len(fields) == len(TXT_FIELDS)]
+
+    def _write_batch(self, rows):
+        self.f.write("".join("~".join(str(row[key]) for key in TXT_FIELDS) + "\n" for row in rows))
+        self.f.flush()
+
+    def close(self):
+        OutputSink.close(self)
+        self.f.close()
+
+
+class CsvSink(OutputSink):
+    """CSV with quoting, so titles containing commas, quotes or ~ survive"""
+    def __init__(self, path, resume=False, batch_size=DEFAULT_BATCH_SIZE):
+        OutputSink.__init__(self, batch_size)
+        self.path = path
+        append = resume and os.path.exists(path)
+        self.f = open(path, "a" if append else "w", encoding="utf-8", newline="")
+        self.writer = csv.DictWriter(self.f, fieldnames=ROW_FIELDS, extrasaction="ignore")
+        if not append:
+            self.writer.writeheader()
+            self.f.flush()
+
+    def written_files(self):
+        with open(self.path, encoding="utf-8", newline="") as f:
+            return {os.path.abspath(os.path.join(row["dir"], row["file"])) for row in csv.DictReader(f) if row.get("file")}
+
+    def written_rows(self):
+        with open(self.path, encoding="utf-8", newline="") as f:
+            return [_typed_row(row) for row in csv.DictReader(f) if row.get("file")]
+
+    def _write_batch(self, rows):
+        self.writer.writerows(rows)
+        self.f.flush()
+
+    def close(self):
+        OutputSink.close(self)
+        self.f.close()
+
+
+class DbSink(OutputSink):
+    """the mp3_db tracks table, spotify_id set to the best match and last_checked to now"""
+    def __init__(self, db_path, directory, resume=False, batch_size=DEFAULT_BATCH_SIZE):
+        OutputSink.__init__(self, batch_size)
+        # the tracks table holds absolute paths, as scan_library stores them
+        self.directory = os.path.abspath(directory)
+        self.conn = mp3_db.optimize_db_connection(db_path)
+        mp3_db.create_optimized_schema(self.conn)
+
+    def written_files(self):
+        return {file_path for file_path, last_checked in mp3_db.get_last_checked(self.conn, self.directory)
+                if last_checked}
+
+    def _write_batch(self, rows):
+        checked = datetime.datetime.now().isoformat(timespec="seconds")
+        mp3_db.batch_insert_tracks(self.conn, [
+            (os.path.abspath(os.path.join(row["dir"], row["file"])), row["title"], row["artist"], row["album"],
+             row["mp3_duration"] * 1000, best_spotify_id(row), checked)
+            for row in rows])
+
+    def close(self):
+        OutputSink.close(self)
+        self.conn.close()
+
+
+class ParquetSink(OutputSink):
+    """a directory of Parquet files, one per flushed batch, so nothing written is lost if a run stops part way"""
+    def __init__(self, path, resume=False, batch_size=DEFAULT_BATCH_SIZE):
+        if pa is None:
+            raise ImportError("parquet output needs the pyarrow package")
+        OutputSink.__init__(self, batch_size)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        # a run that stopped mid write leaves a partial .tmp part, which would break reading the directory
+        for stale in glob.glob(os.path.join(path, "part-*.parquet.tmp")):
+            os.remove(stale)
+        parts = sorted(glob.glob(os.path.join(path, "part-*.parquet")))
+        if not resume:
+            for part in parts:
+                os.remove(part)
+            parts = []
+        self.parts = len(parts)
+        self.schema = pa.schema([("artist", pa.string()), ("title", pa.string()), ("album", pa.string()),
+                                 ("mp3_duration", pa.int64()), ("spotify_duration", pa.int64()),
+                                 ("sp_id", pa.string()), ("sp_id2", pa.string()), ("score", pa.float64()),
+                                 ("file", pa.string()), ("dir", pa.string())])
+
+    def written_files(self):
+        if not self.parts:
+            return set()
+        table = pq.read_table(self.path, columns=["file", "dir"])
+        return {os.path.abspath(os.path.join(d, f)) for f, d in zip(table.column("file").to_pylist(), table.column("dir").to_pylist())}
+
+    def written_rows(self):
+        if not self.parts:
+            return []
+        return [_typed_row(row) for row in pq.read_table(self.path).to_pylist()]
+
+    def _write_batch(self, rows):
+        # not found is stored as null rather than "UNK" so the columns can be typed
+        columns = {name: [None if row[name] == "UNK" else row[name] for row in rows] for name in ROW_FIELDS}
+        for name in ("mp3_duration", "spotify_duration"):
+            columns[name] = [None if value is None else int(value) for value in columns[name]]
+        columns["score"] = [None if value is None else float(value) for value in columns["score"]]
+        table = pa.Table.from_pydict(columns, schema=self.schema)
+        # written under a temporary name first, so a part file is either complete or not there
+        part = os.path.join(self.path, f"part-{self.parts:05d}.parquet")
+        pq.write_table(table, part + ".tmp")
+        os.replace(part + ".tmp", part)
+        self.parts += 1
+
+
+def open_sinks(outputs, mp3_path, db_path=None, resume=False, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Sinks for a comma separated list of outputs (txt, csv, parquet, db) of results for the mp3s in mp3_path.
+    txt/csv/parquet are written to mp3_path, db to the tracks table of db_path.
+    """
+    sinks = []
+    for output in outputs.split(","):
+        output = output.strip()
+        if output == "db":
+            if not db_path:
+                raise ValueError("db output needs a db_path")
+            sinks.append(DbSink(db_path, mp3_path, resume, batch_size))
+        elif output == "txt":
+            sinks.append(TxtSink(os.path.join(mp3_path, OUTPUT_NAMES[output]), resume, batch_size))
+        elif output == "csv":
+            sinks.append(CsvSink(os.path.join(mp3_path, OUTPUT_NAMES[output]), resume, batch_size))
+        elif output == "parquet":
+            sinks.append(ParquetSink(os.path.join(mp3_path, OUTPUT_NAMES[output]), resume, batch_size))
+        else:
+            raise ValueError(f"Unknown output: {output}")
+    return sinks
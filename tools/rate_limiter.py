@@ -0,0 +1,142 @@
+""" Shared rate limiting for Spotify API calls: a token bucket that slows down on 429s and honours Retry-After"""
+
+import logging
+import random
+import threading
+import time
+
+import spotipy
+
+import metrics
+
+# starting and maximum request rate (requests/sec) and bucket size
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 10
+MIN_RATE = 0.5
+
+# rate added back per successful call after being throttled
+RATE_INCREASE = 0.05
+
+# statuses worth retrying, 429 (rate limited) and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# calls that may have been applied even though they failed with a server error, these only retry 429s
+# (which Spotify rejects before doing anything) and leave the rest to the caller, see spotify_liked_sync.write_chunk
+NON_IDEMPOTENT_METHODS = ("playlist_add_items",)
+
+
+class RateLimiter(object):
+    """token bucket shared by all Spotify callers in a process
+       on a 429 the rate is halved and every caller waits out the Retry-After (or an exponential backoff with jitter),
+       then the rate creeps back up with each successful call
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_retries=6, base_backoff=1.0, max_backoff=60.0):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = int(burst)
+        self.max_retries = int(max_retries)
+        self.base_backoff = float(base_backoff)
+        self.max_backoff = float(max_backoff)
+
+        self.requests = 0
+        self.throttled = 0
+
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+
+    def acquire(self):
+        """block until a request may be made"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    self.requests += 1
+                    return
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def call(self, func, *args, **kwargs):
+        """call func through the limiter, retrying rate limited and transient failures"""
+        attempt = 0
+        method = getattr(func, "__name__", "call")
+        retry_statuses = (429,) if method in NON_IDEMPOTENT_METHODS else RETRY_STATUSES
+        while True:
+            # time spent waiting on the bucket (and any backoff), kept apart from the request latency
+            with metrics.timer("rate_limit_wait"):
+                self.acquire()
+            try:
+                with metrics.timer("spotify_request", method=method):
+                    result = func(*args, **kwargs)
+            except spotipy.SpotifyException as e:
+                metrics.count("api_errors", status=e.http_status)
+                if e.http_status not in retry_statuses or attempt >= self.max_retries:
+                    raise
+                self._backoff(attempt, e)
+                attempt += 1
+                continue
+
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+            return result
+
+    def _backoff(self, attempt, error):
+        wait = min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                wait = float(retry_after) + random.uniform(0, 1)
+            except ValueError:
+                pass
+
+        with self._lock:
+            if error.http_status == 429:
+                self.throttled += 1
+                self.rate = max(MIN_RATE, self.rate / 2)
+            # everyone waits, not just the caller that hit the limit
+            self._blocked_until = max(self._blocked_until, time.monotonic() + wait)
+            self._tokens = 0
+        logging.warning(f"Spotify returned {error.http_status}, backing off {wait:.1f}s (rate now {self.rate:.1f}/s)")
+
+    def stats(self):
+        return {"requests": self.requests, "throttled": self.throttled, "rate": round(self.rate, 2)}
+
+
+# the limiter used by default, so every Spotify client in the process shares one budget
+default_limiter = RateLimiter()
+
+
+def disable_status_retries(sp):
+    """
+    Turn off the status retries of a spotipy client's own HTTP session. spotipy's default session retries 429s
+    and 5xx inside urllib3, each thread sleeping out Retry-After on its own, so the limiter would never see them.
+    Connection retries are kept. Sessions from spotify_client.build_session already leave statuses alone.
+    """
+    session = getattr(sp, "_session", None)
+    for adapter in getattr(session, "adapters", {}).values():
+        retry = getattr(adapter, "max_retries", None)
+        if retry is not None and (retry.status_forcelist or retry.respect_retry_after_header):
+            adapter.max_retries = retry.new(status=0, status_forcelist=(), respect_retry_after_header=False)
+
+
+class LimitedSpotify(object):
+    """wraps a spotipy.Spotify so every method call goes through a RateLimiter"""
+    def __init__(self, sp, limiter=None):
+        self.sp = sp
+        self.limiter = limiter or default_limiter
+        disable_status_retries(sp)
+
+    def __getattr__(self, name):
+        attr = getattr(self.sp, name)
+        if not callable(attr):
+            return attr
+
+        def limited(*args, **kwargs):
+            return self.limiter.call(attr, *args, **kwargs)
+        limited.__name__ = name
+        return limited
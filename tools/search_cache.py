@@ -0,0 +1,84 @@
+""" Persistent cache of Spotify search results, kept in a table alongside the mp3_db tracks table"""
+
+import json
+import threading
+import time
+
+import metrics
+import mp3_db
+
+# cached searches older than this are fetched again
+DEFAULT_TTL_DAYS = 30
+
+# oldest entries are evicted beyond this many rows
+DEFAULT_MAX_ENTRIES = 200000
+
+# how many new entries between eviction passes
+EVICT_EVERY = 1000
+
+
+def normalize_query(query, market):
+    """cache key for a search: lower case, single spaced query plus market"""
+    return f"{market}|{' '.join(query.lower().split())}"
+
+
+def trim_search_result(result):
+    """keep only the track fields used for matching, so cached rows stay small"""
+    items = []
+    for item in result['tracks']['items']:
+        items.append({"id": item['id'],
+                      "uri": item['uri'],
+                      "name": item['name'],
+                      "popularity": item['popularity'],
+                      "duration_ms": item['duration_ms'],
+                      "artists": [{"name": artist['name']} for artist in item['artists'][:1]],
+                      "album": {"name": item['album']['name'],
+                                "artists": [{"name": artist['name']} for artist in item['album']['artists'][:1]]}
+                     })
+    return {"tracks": {"items": items}}
+
+
+class SearchCache(object):
+    """sqlite backed search cache with a TTL and size based eviction, safe to share between search threads"""
+    def __init__(self, db_path, ttl_days=DEFAULT_TTL_DAYS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = float(ttl_days) * 86400
+        self.max_entries = int(max_entries)
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.conn = mp3_db.optimize_db_connection(db_path, check_same_thread=False)
+        mp3_db.create_search_cache_schema(self.conn)
+
+    def get(self, query, market):
+        """return the cached result for query/market, or None if missing or expired"""
+        key = normalize_query(query, market)
+        with self._lock:
+            row = mp3_db.get_cached_search(self.conn, key, time.time() - self.ttl)
+            if row is None:
+                self.misses += 1
+                metrics.count("search_cache", result="miss")
+                return None
+            self.hits += 1
+            metrics.count("search_cache", result="hit")
+        return json.loads(row)
+
+    def put(self, query, market, result):
+        """store a search result, returns the trimmed result that was cached"""
+        result = trim_search_result(result)
+        key = normalize_query(query, market)
+        with self._lock:
+            mp3_db.put_cached_search(self.conn, key, json.dumps(result, separators=(",", ":")), time.time())
+            self._puts += 1
+            if self._puts % EVICT_EVERY == 0:
+                mp3_db.evict_search_cache(self.conn, self.max_entries)
+        return result
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            mp3_db.evict_search_cache(self.conn, self.max_entries)
+            self.conn.close()
@@ -0,0 +1,183 @@
+""" One place to build Spotify clients: a pooled keep-alive HTTP session, a token cache shared between
+    processes, and the shared rate limiter
+    Env vars: SPOTIPY_CLIENT_ID, SPOTIPY_CLIENT_SECRET, SPOTIPY_REDIRECT_URI, SPOTIPY_USERNAME,
+              SPOTIPY_TOKEN_CACHE - token cache file (default ~/.cache-spotipy-<username>, so cron jobs
+              run from different directories share one token)
+    Until it has a token, one from spotipy's own cache (.cache-<username> or .cache in the working directory, where
+    the tools kept it before) is used and copied over, so existing installs aren't asked to authorize again
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from spotipy.cache_handler import CacheFileHandler
+from spotipy.oauth2 import SpotifyOAuth
+import spotipy
+
+from rate_limiter import LimitedSpotify
+
+# keep-alive connections kept per host, enough for the paging/mutation/search worker pools
+POOL_SIZE = 16
+
+# (connect, read) timeouts in seconds
+REQUEST_TIMEOUT = (5, 30)
+
+# transport level retries of connections that failed before a request was sent (and read errors on idempotent
+# requests), statuses are left to the RateLimiter, which honours Retry-After for every thread at once,
+# so a failing call isn't retried at both levels
+TRANSPORT_RETRIES = 3
+
+# refresh tokens this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 60
+
+REDIRECT_URI = 'http://127.0.0.1:8888/callback'
+
+# default scope, every scope the tools need
+# (a token is only reused for a scope it covers, otherwise spotipy asks to authorize again, so each tool still
+# asks for its own scope and a token cached for a wider one covers it)
+SCOPE = 'playlist-modify-private playlist-modify-public user-library-read'
+
+
+def build_session(pool_size=POOL_SIZE, retries=TRANSPORT_RETRIES):
+    """requests session with a keep-alive connection pool and transport retries (not of error statuses)"""
+    retry = Retry(total=retries,
+                  connect=retries,
+                  read=retries,
+                  status=0,
+                  backoff_factor=0.3,
+                  respect_retry_after_header=False,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class SharedTokenCache(CacheFileHandler):
+    """token cache file shared by every process
+       written atomically so another process never reads half a token, and kept in memory
+       so the file is only re-read once the token is due for refresh (spotipy reads it on every call)
+       if it has no token covering scope, the first of legacy_paths that has one is used (and copied over if the
+       file has no token at all)
+    """
+    def __init__(self, cache_path, legacy_paths=(), scope=None):
+        CacheFileHandler.__init__(self, cache_path=cache_path)
+        self.legacy_paths = list(legacy_paths)
+        self.scope = scope
+        self._lock = threading.Lock()
+        self._token = None
+
+    def get_cached_token(self):
+        with self._lock:
+            if self._token and self._token.get('expires_at', 0) - TOKEN_EXPIRY_MARGIN > time.time():
+                return self._token
+            # expired (or first use), another process may have refreshed it already
+            self._token = CacheFileHandler.get_cached_token(self)
+            if not self._covers_scope(self._token):
+                self._token = self._legacy_token() or self._token
+            return self._token
+
+    def save_token_to_cache(self, token_info):
+        with self._lock:
+            self._token = token_info
+            self._write(token_info)
+
+    def _covers_scope(self, token_info):
+        if not token_info:
+            return False
+        return set((self.scope or '').split()) <= set(token_info.get('scope', '').split())
+
+    def _legacy_token(self):
+        for path in self.legacy_paths:
+            token_info = CacheFileHandler(cache_path=path).get_cached_token()
+            if self._covers_scope(token_info):
+                if not os.path.exists(self.cache_path):
+                    logging.info(f"Copying the Spotify token cached in {path} to {self.cache_path}")
+                    self._write(token_info)
+                return token_info
+        return None
+
+    def _write(self, token_info):
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.spotipy-token-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(token_info, f)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def token_cache_path(username=None):
+    username = username or os.environ.get('SPOTIPY_USERNAME')
+    default = os.path.expanduser(f"~/.cache-spotipy-{username}" if username else "~/.cache-spotipy")
+    return os.environ.get('SPOTIPY_TOKEN_CACHE', default)
+
+
+def legacy_token_cache_paths(username=None):
+    """spotipy's default cache files in the working directory, where the tools cached their token before"""
+    paths = []
+    for name in (username, os.environ.get('SPOTIPY_CLIENT_USERNAME'), None):
+        path = os.path.abspath(f".cache-{name}" if name else ".cache")
+        if path not in paths:
+            paths.append(path)
+    return paths
+
+
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_session():
+    """the process wide HTTP session, shared by API calls and token refreshes"""
+    global _session
+    with _clients_lock:
+        if _session is None:
+            _session = build_session()
+        return _session
+
+
+def get_spotify(scope=SCOPE, username=None, open_browser=False):
+    """
+    Rate limited Spotify client, built once per process (and scope/username) so chained calls
+    reuse its connections and token.
+
+    scope - space separated string or list of scopes
+    """
+    if not isinstance(scope, str):
+        scope = ' '.join(scope)
+    scope = ' '.join(sorted(set(scope.split())))
+    session = get_session()
+
+    with _clients_lock:
+        sp = _clients.get((scope, username))
+        if sp is None:
+            auth_manager = SpotifyOAuth(client_id=os.environ.get('SPOTIPY_CLIENT_ID'),
+                                        client_secret=os.environ.get('SPOTIPY_CLIENT_SECRET'),
+                                        redirect_uri=os.environ.get('SPOTIPY_REDIRECT_URI', REDIRECT_URI),
+                                        scope=scope,
+                                        username=username,
+                                        open_browser=open_browser, # False for non-interactive/scheduled runs
+                                        requests_session=session,
+                                        requests_timeout=REQUEST_TIMEOUT,
+                                        cache_handler=SharedTokenCache(token_cache_path(username),
+                                                                       legacy_token_cache_paths(username), scope))
+            # every call goes through the shared rate limiter, which handles 429s and Retry-After
+            sp = LimitedSpotify(spotipy.Spotify(auth_manager=auth_manager,
+                                                requests_session=session,
+                                                requests_timeout=REQUEST_TIMEOUT))
+            _clients[(scope, username)] = sp
+        return sp
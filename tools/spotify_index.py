@@ -0,0 +1,184 @@
+""" Local fuzzy index of known Spotify tracks, so mp3s can be matched without a search call
+    Tracks are kept in a sqlite table (alongside the mp3_db tracks table) and indexed in memory by
+    character trigrams over the normalized "artist|title" on the first search. That first search pays for
+    building the index, a few seconds per 100k tracks, later ones don't (len() counts the table instead).
+"""
+
+from array import array
+import threading
+import unicodedata
+
+import numpy as np
+
+import metrics
+import mp3_db
+
+# how many of the query's rarest trigrams are used to gather candidates
+QUERY_GRAMS = 8
+
+# candidates checked against the full trigram set of the query
+VERIFY_CANDIDATES = 10
+
+# minimum trigram jaccard similarity of "artist|title" to count as a hit
+DEFAULT_MIN_SIMILARITY = 0.7
+
+
+def normalize(text):
+    """lower case, accents stripped, punctuation to spaces, single spaced"""
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    text = "".join(c if c.isalnum() else " " for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+
+def index_key(artist, title):
+    return f"{normalize(artist)}|{normalize(title)}"
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrackIndex(object):
+    """trigram index over Spotify tracks stored in a sqlite db, safe to share between search threads"""
+    def __init__(self, db_path, min_similarity=DEFAULT_MIN_SIMILARITY):
+        self.min_similarity = float(min_similarity)
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self.conn = mp3_db.optimize_db_connection(db_path, check_same_thread=False)
+        mp3_db.create_spotify_tracks_schema(self.conn)
+
+        self._loaded = False
+        self._rows = []        # (id, uri, name, artist, album, album_artist, duration_ms, popularity)
+        self._keys = []        # normalized "artist|title" per row
+        self._ids = {}         # spotify id -> row number
+        self._exact = {}       # key -> [row numbers]
+        self._postings = {}    # trigram -> array of row numbers
+
+    def _load(self):
+        for row in mp3_db.get_spotify_tracks(self.conn):
+            self._index_row(row)
+        self._loaded = True
+
+    def _index_row(self, row):
+        i = self._ids.get(row[0])
+        if i is not None:
+            # already indexed, just refresh the stored data (key changes are rare enough to ignore)
+            self._rows[i] = row
+            return
+
+        i = len(self._rows)
+        key = index_key(row[3], row[2])
+        self._rows.append(row)
+        self._keys.append(key)
+        self._ids[row[0]] = i
+        self._exact.setdefault(key, []).append(i)
+        for gram in trigrams(key):
+            postings = self._postings.get(gram)
+            if postings is None:
+                postings = self._postings[gram] = array("I")
+            postings.append(i)
+
+    def __len__(self):
+        with self._lock:
+            if not self._loaded:
+                # no need to build the index just to count
+                return mp3_db.count_spotify_tracks(self.conn)
+            return len(self._rows)
+
+    def add_items(self, items):
+        """add track objects (as returned by search, saved tracks or playlist items) to the index"""
+        rows = []
+        for item in items:
+            # saved tracks and playlist items wrap the track object
+            track = item['track'] if isinstance(item.get('track'), dict) else item
+            if not track.get('id') or track.get('type', 'track') != 'track':
+                # local files and podcast episodes
+                continue
+            album = track.get('album') or {}
+            album_artists = album.get('artists') or [{}]
+            rows.append((track['id'], track['uri'], track['name'], track['artists'][0]['name'],
+                         album.get('name'), album_artists[0].get('name'),
+                         track['duration_ms'], track.get('popularity', 0)))
+        if not rows:
+            return 0
+
+        with self._lock:
+            mp3_db.upsert_spotify_tracks(self.conn, rows)
+            if self._loaded:
+                for row in rows:
+                    self._index_row(row)
+        return len(rows)
+
+    def get(self, ids):
+        """{id: track item} of the given spotify ids that are stored in the index"""
+        with self._lock:
+            return {row[0]: self._row_item(row) for row in mp3_db.get_spotify_tracks_by_id(self.conn, ids)}
+
+    def search(self, artist, title, limit=10):
+        """return indexed tracks matching artist/title, best first, as search result items (empty list on a miss)"""
+        key = index_key(artist, title)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+
+            matches = self._exact.get(key)
+            if matches:
+                matches = matches[:limit]
+            else:
+                matches = self._fuzzy(key, limit)
+
+            if matches:
+                self.hits += 1
+            else:
+                self.misses += 1
+            metrics.count("track_index", result="hit" if matches else "miss")
+            return [self._item(i) for i in matches]
+
+    def _fuzzy(self, key, limit):
+        grams = trigrams(key)
+        postings = sorted((self._postings[gram] for gram in grams if gram in self._postings), key=len)
+        if not postings:
+            return []
+
+        # rare trigrams narrow things down quickly, a true match shares most of them
+        rare = postings[:QUERY_GRAMS]
+        rows = np.concatenate([np.frombuffer(posting, dtype=np.uint32) for posting in rare])
+        rows, counts = np.unique(rows, return_counts=True)
+        # anything similar enough shares at least half of them
+        keep = counts * 2 >= len(rare)
+        rows, counts = rows[keep], counts[keep]
+        if len(rows) > VERIFY_CANDIDATES:
+            rows = rows[np.argpartition(-counts, VERIFY_CANDIDATES)[:VERIFY_CANDIDATES]]
+
+        scored = []
+        for i in rows.tolist():
+            candidate = trigrams(self._keys[i])
+            similarity = len(grams & candidate) / len(grams | candidate)
+            if similarity >= self.min_similarity:
+                scored.append((similarity, i))
+        scored.sort(key=lambda x: -x[0])
+        return [i for _, i in scored[:limit]]
+
+    def _item(self, i):
+        return self._row_item(self._rows[i])
+
+    @staticmethod
+    def _row_item(row):
+        track_id, uri, name, artist, album, album_artist, duration_ms, popularity = row
+        return {"id": track_id,
+                "uri": uri,
+                "name": name,
+                "popularity": popularity,
+                "duration_ms": duration_ms,
+                "artists": [{"name": artist}],
+                "album": {"name": album, "artists": [{"name": album_artist or artist}]}}
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -1,15 +1,24 @@
-""" Sync from liked tracks to a playlist of liked tracks (which can be shared, unlike liked tracks"""
+""" Sync from liked tracks to a playlist of liked tracks (which can be shared, unlike liked tracks
+    Also syncs other sources (playlists, mp3_to_spotify output) to more target playlists, see load_sync_jobs"""
 
+import requests
 import spotipy
-from spotipy.oauth2 import SpotifyOAuth
 import os
+import sys
 import logging
-from math import ceil
+from concurrent.futures import ThreadPoolExecutor
+import json
 
 import smtplib
 from email.message import EmailMessage
 import datetime # To add timestamp to email subject
 
+import metrics
+from rate_limiter import default_limiter
+from spotify_client import get_spotify
+from spotify_paging import fetch_all_pages
+from sync_state import SyncState
+
 
 # --- Configuration ---
 # Make sure SPOTIPY_CLIENT_ID, SPOTIPY_CLIENT_SECRET, and SPOTIPY_REDIRECT_URI
@@ -28,6 +37,27 @@ SCOPE = 'user-library-read playlist-modify-public playlist-modify-private'
 # Max items per API call for adding/removing tracks
 API_LIMIT = 100
 
+# Pages fetched concurrently when reading liked songs / playlists
+PAGE_WORKERS = 4
+
+# Concurrent remove chunks (failed calls are retried by the rate limiter, see write_chunk)
+MUTATION_WORKERS = 4
+
+# Optional JSON config of source -> target sync jobs (see load_sync_jobs), also given with --config <path>
+SYNC_CONFIG_PATH = os.environ.get('SPOTIFY_SYNC_CONFIG')
+
+# Targets synced concurrently
+JOB_WORKERS = 4
+
+# Per stage timings and counters of a run are written with --metrics <path> (Prometheus text format if it ends in .prom,
+# else JSON), or at exit to PY_SPOTIFY_METRICS, see metrics.py
+
+# Local snapshot of liked songs, so normal runs only fetch songs liked since the last run
+SYNC_DB_PATH = os.environ.get('SPOTIFY_SYNC_DB', 'spotify_liked_sync.sqlite')
+
+# Days between full downloads and diffs of liked songs and the playlist (also forced with --full)
+FULL_RECONCILE_DAYS = float(os.environ.get('SPOTIFY_FULL_RECONCILE_DAYS', 7))
+
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -35,35 +65,31 @@ logging.basicConfig(level=logging.INFO,
 
 # --- Helper Functions ---
 
-def get_all_items(spotify_call):
+@metrics.timed("get_all_items")
+def get_all_items(spotify_call, limit=50, workers=PAGE_WORKERS):
     """
     Generic function to retrieve all items from a paginated Spotify API endpoint.
 
     Args:
-        spotify_call: A function that returns a page of results
-                      (e.g., sp.current_user_saved_tracks or sp.playlist_items).
+        spotify_call: A function taking limit and offset that returns a page of results
+                      (e.g., sp.current_user_saved_tracks or a lambda around sp.playlist_items).
+        limit: Page size, 50 is the max allowed for most endpoints like saved_tracks.
+        workers: Pages fetched concurrently once the first page has given the total.
 
     Returns:
-        A list of all items retrieved.
+        A list of all items retrieved, in order.
+
+    Raises:
+        Whatever stopped the fetch, rather than returning the items read so far, so a partial (or empty)
+        list is never mistaken for the whole playlist and stored against its snapshot_id.
     """
-    all_items = []
     try:
-        # Request fewer items initially if memory/performance becomes an issue,
-        # but 50 is the max allowed for most endpoints like saved_tracks.
-        results = spotify_call(limit=50)
-        if results:
-            all_items.extend(results['items'])
-            while results['next']:
-                # Use sp.next to handle pagination easily
-                results = sp.next(results)
-                if results and results['items']:
-                    all_items.extend(results['items'])
-        else:
-             logging.warning(f"Initial call to {getattr(spotify_call, '__name__', 'spotify_call')} returned no results.")
+        all_items = fetch_all_pages(spotify_call, limit, workers)
     except Exception as e:
         logging.error(f"Error fetching items with {getattr(spotify_call, '__name__', 'spotify_call')}: {e}")
-        # Optionally re-raise or handle more gracefully depending on needs
-        # raise e
+        raise
+    if not all_items:
+         logging.warning(f"Initial call to {getattr(spotify_call, '__name__', 'spotify_call')} returned no results.")
     return all_items
 
 def get_track_details(track_object):
@@ -94,6 +120,7 @@ def get_liked_track_details(sp):
         if item and 'track' in item:
             uri, details = get_track_details(item['track'])
             if uri and details:
+                details['added_at'] = item.get('added_at')
                 liked_details[uri] = details
             else:
                  skipped_count += 1
@@ -107,12 +134,111 @@ def get_liked_track_details(sp):
     logging.info(f"Found details for {len(liked_details)} liked songs.")
     return liked_details
 
-def get_playlist_track_details(sp, playlist_id):
-    """Gets details (URI, name, artists) for all tracks in a playlist."""
+def get_new_liked_track_details(sp, known_added_at):
+    """
+    Gets details of songs liked since the local snapshot was taken.
+
+    Saved tracks come back newest first, so pages are read until an item at or before the
+    watermark (newest added_at in the snapshot) is reached - a single request when nothing is new.
+
+    Returns:
+        ({uri: details} of new (or re-liked) songs, total number of liked songs reported by Spotify)
+    """
+    watermark = max((added_at for added_at in known_added_at.values() if added_at), default='')
+    new_details = {}
+    offset = 0
+    while True:
+        results = sp.current_user_saved_tracks(limit=50, offset=offset)
+        total = results['total']
+        reached_known = False
+        for item in results['items']:
+            added_at = item.get('added_at') or ''
+            uri, details = get_track_details(item.get('track'))
+            if added_at < watermark or (added_at == watermark and known_added_at.get(uri) == added_at):
+                reached_known = True
+                break
+            if uri and details:
+                details['added_at'] = added_at
+                new_details[uri] = details
+        if reached_known or not results['next']:
+            break
+        offset += 50
+
+    logging.info(f"Found {len(new_details)} songs liked since the last sync ({total} liked in total).")
+    return new_details, total
+
+def get_liked_source(sp, state, full=False):
+    """
+    Gets the full set of liked songs, normally without downloading them all.
+
+    Only songs liked since the last run are fetched and merged into the local snapshot. All liked songs are
+    downloaded when asked for, when the snapshot is empty, when FULL_RECONCILE_DAYS have passed, or when
+    Spotify's liked count doesn't match the snapshot (songs un-liked since).
+
+    Returns a source dict, see get_source.
+    """
+    known_added_at = state.liked_added_at()
+    full = full or not known_added_at or state.full_reconcile_due(FULL_RECONCILE_DAYS)
+
+    if not full:
+        new_details, total = get_new_liked_track_details(sp, known_added_at)
+        if len(known_added_at.keys() | new_details.keys()) == total:
+            liked_details = state.liked_details()
+            liked_details.update(new_details)
+            return {'details': liked_details, 'full': False, 'new': new_details}
+        logging.info("Liked songs count doesn't match the local snapshot (songs un-liked?), doing a full reconcile.")
+
+    logging.info("Full fetch of liked songs...")
+    liked_details = get_liked_track_details(sp)
+    return {'details': liked_details or None, 'full': True, 'new': liked_details}
+
+def save_liked_source(state, source):
+    """Stores the liked songs seen by get_liked_source, once its target playlists have been updated."""
+    if source['full']:
+        state.replace_liked(source['new'])
+        state.mark_full_reconcile()
+    elif source['new']:
+        state.add_liked(source['new'])
+
+def read_spotify_txt(path):
+    """Gets details of the matched tracks in a mp3_to_spotify output file (best match sp_id2, else sp_id)."""
+    details = {}
+    with open(path, encoding='utf-8') as f:
+        header = f.readline().rstrip('\n').split('~')
+        for line in f:
+            fields = line.rstrip('\n').split('~')
+            if len(fields) != len(header):
+                logging.warning(f"Skipping malformed line in {path}: {line.strip()}")
+                continue
+            row = dict(zip(header, fields))
+            track_id = row['sp_id2'] if row['sp_id2'] != 'UNK' else row['sp_id']
+            if track_id and track_id != 'UNK':
+                details[f"spotify:track:{track_id}"] = {'name': row['title'], 'artists': row['artist']}
+    logging.info(f"Found {len(details)} matched tracks in {path}.")
+    return details
+
+def get_playlist_track_details(sp, playlist_id, state=None, use_stored=True):
+    """
+    Gets details (URI, name, artists) for all tracks in a playlist.
+
+    With a SyncState, the playlist's snapshot_id is checked first (one small request) and the stored
+    copy returned if it hasn't changed; otherwise the fetched tracks are stored with the snapshot_id.
+    use_stored=False always fetches (and stores) the tracks, e.g. for a full reconcile.
+    A failed fetch raises (see get_all_items) and nothing is stored.
+    """
+    snapshot_id = None
+    if state:
+        snapshot_id = sp.playlist(playlist_id, fields='snapshot_id')['snapshot_id']
+        stored_snapshot_id, stored_details = state.get_playlist(playlist_id)
+        if use_stored and snapshot_id == stored_snapshot_id:
+            logging.info(f"Playlist {playlist_id} unchanged since last sync, using stored copy of {len(stored_details)} tracks.")
+            return stored_details
+
     logging.info(f"Fetching track details from playlist ID: {playlist_id}...")
     # Specify fields needed to ensure name and artists are included
-    fields = 'items(track(uri,name,artists(name))),next'
-    playlist_items = get_all_items(lambda limit=50, offset=0: sp.playlist_items(playlist_id, limit=limit, offset=offset, fields=fields))
+    fields = 'items(track(uri,name,artists(name))),next,total'
+    playlist_items = get_all_items(lambda limit=100, offset=0: sp.playlist_items(playlist_id, limit=limit, offset=offset, fields=fields),
+                                   limit=100)
 
     playlist_details = {}
     skipped_count = 0
@@ -137,70 +263,287 @@ def get_playlist_track_details(sp, playlist_id):
     if skipped_count > 0:
          logging.warning(f"Skipped {skipped_count} items in playlist {playlist_id} (may include non-tracks or tracks with missing data).")
     logging.info(f"Found details for {len(playlist_details)} tracks in playlist {playlist_id}.")
+    if state:
+        state.save_playlist(playlist_id, snapshot_id, playlist_details)
     return playlist_details
 
 
-def add_tracks_to_playlist(sp, playlist_id, track_uris_to_add, track_details_lookup):
-    """Adds tracks to the specified playlist, logging names and artists."""
+def write_chunk(sp, func, playlist_id, chunk, reconcile=True):
+    """
+    Sends one add/remove chunk. 429s and (for removes) server errors are already retried by the rate limiter,
+    so whatever still fails is dealt with once here:
+    - a 400 (usually one bad URI, e.g. a track no longer available) splits the chunk in half and each half is
+      sent again, so one bad URI doesn't take 99 good ones down with it
+    - an add that failed without a clear answer (5xx, timeout) may still have gone through, and adding again
+      would duplicate tracks, so the playlist is read first and only the tracks still missing are sent again
+    - auth errors and other 4xx are raised straight away, every other chunk would fail the same way
+
+    Returns:
+        A list of (sub chunk, api result or None, error or None), in chunk order.
+    """
+    method = getattr(func, '__name__', 'call')
+    try:
+        with metrics.timer("playlist_mutation", method=method):
+            result = func(playlist_id, chunk)
+    except spotipy.SpotifyException as e:
+        if e.http_status == 400:
+            if len(chunk) == 1:
+                return [(chunk, None, str(e))]
+            mid = len(chunk) // 2
+            return (write_chunk(sp, func, playlist_id, chunk[:mid], reconcile) +
+                    write_chunk(sp, func, playlist_id, chunk[mid:], reconcile))
+        if 400 <= (e.http_status or 0) < 500:
+            raise
+        error = e
+    except requests.exceptions.RequestException as e:
+        error = e
+    else:
+        metrics.count("playlist_tracks", len(chunk), method=method)
+        return [(chunk, result, None)]
+
+    if reconcile and method == 'playlist_add_items':
+        return add_missing(sp, func, playlist_id, chunk, error)
+    return [(chunk, None, str(error))]
+
+def add_missing(sp, func, playlist_id, chunk, error):
+    """
+    After an add of chunk failed without a clear answer, re-reads the playlist and sends the tracks that
+    didn't make it once more. Tracks found in the playlist are reported as added under the snapshot_id read.
+    """
+    logging.warning(f"Adding {len(chunk)} tracks to playlist {playlist_id} failed ({error}), checking what was added...")
+    try:
+        snapshot_id = sp.playlist(playlist_id, fields='snapshot_id')['snapshot_id']
+        items = get_all_items(lambda limit=100, offset=0: sp.playlist_items(playlist_id, limit=limit, offset=offset,
+                                                                            fields='items(track(uri)),total'),
+                              limit=100)
+    except Exception as e:
+        logging.error(f"Couldn't re-read playlist {playlist_id}: {e}")
+        return [(chunk, None, str(error))]
+
+    present = {item['track']['uri'] for item in items if item and item.get('track')}
+    added = [uri for uri in chunk if uri in present]
+    missing = [uri for uri in chunk if uri not in present]
+    results = [(added, {'snapshot_id': snapshot_id}, None)] if added else []
+    if missing:
+        results += write_chunk(sp, func, playlist_id, missing, reconcile=False)
+    return results
+
+def chunk_uris(uris):
+    return [uris[i:i + API_LIMIT] for i in range(0, len(uris), API_LIMIT)]
+
+def log_chunk_result(action, i, num_chunks, playlist_id, chunk, error, track_details_lookup):
+    """Logs a chunk's tracks with details, or its failure."""
+    if error is None:
+        logging.info(f"{action.capitalize()} chunk {i+1}/{num_chunks} ({len(chunk)} tracks), playlist {playlist_id}.")
+        # Log individual tracks in this chunk with details
+        for uri in chunk:
+            details = track_details_lookup.get(uri, {'name': 'N/A', 'artists': 'N/A'})
+            logging.info(f"  {action.upper()}: {details['name']} by {details['artists']} ({uri})")
+    else:
+        logging.error(f"Error in {action} chunk {i+1}, playlist {playlist_id} (gave up after retries): {error}")
+        # Log failed URIs for debugging
+        failed_details_log = []
+        for uri in chunk:
+             details = track_details_lookup.get(uri, {'name': 'N/A', 'artists': 'N/A'})
+             failed_details_log.append(f"{details['name']} by {details['artists']} ({uri})")
+        logging.error(f"  Failed chunk details:\n  " + "\n  ".join(failed_details_log))
+
+def add_tracks_to_playlist(sp, playlist_id, track_uris_to_add, track_details_lookup, state=None):
+    """
+    Adds tracks to the specified playlist, logging names and artists, and keeping any SyncState copy current.
+
+    Tracks are added oldest liked first (by added_at where known), one chunk after another so the playlist
+    keeps that order. Failed chunks are handled as described in write_chunk before being reported.
+
+    Returns:
+        {uri: None if added, else the error} for every track.
+    """
     if not track_uris_to_add:
         logging.info("No new tracks to add.")
-        return
+        return {}
 
-    uris_list = list(track_uris_to_add)
-    num_chunks = ceil(len(uris_list) / API_LIMIT)
-    logging.info(f"Adding {len(uris_list)} tracks in {num_chunks} chunk(s)...")
+    uris_list = sorted(track_uris_to_add, key=lambda uri: (track_details_lookup.get(uri, {}).get('added_at') or '', uri))
+    chunks = chunk_uris(uris_list)
+    logging.info(f"Adding {len(uris_list)} tracks in {len(chunks)} chunk(s)...")
 
-    for i in range(num_chunks):
-        start_index = i * API_LIMIT
-        end_index = start_index + API_LIMIT
-        chunk = uris_list[start_index:end_index]
-        try:
-            sp.playlist_add_items(playlist_id, chunk)
-            logging.info(f"Added chunk {i+1}/{num_chunks} ({len(chunk)} tracks) to playlist {playlist_id}.")
-            # Log individual tracks added in this chunk with details
-            for uri in chunk:
-                details = track_details_lookup.get(uri, {'name': 'N/A', 'artists': 'N/A'})
-                logging.info(f"  ADDED: {details['name']} by {details['artists']} ({uri})")
-        except Exception as e:
-            logging.error(f"Error adding chunk {i+1} to playlist {playlist_id}: {e}")
-            # Log failed URIs for debugging
-            failed_details_log = []
-            for uri in chunk:
-                 details = track_details_lookup.get(uri, {'name': 'N/A', 'artists': 'N/A'})
-                 failed_details_log.append(f"{details['name']} by {details['artists']} ({uri})")
-            logging.error(f"  Failed chunk details:\n  " + "\n  ".join(failed_details_log))
+    report = {}
+    for i, chunk in enumerate(chunks):
+        for sub_chunk, result, error in write_chunk(sp, sp.playlist_add_items, playlist_id, chunk):
+            if state and error is None:
+                added = {uri: track_details_lookup.get(uri, {'name': 'N/A', 'artists': 'N/A'}) for uri in sub_chunk}
+                state.apply_playlist_write(playlist_id, result['snapshot_id'], added=added)
+            log_chunk_result("added", i, len(chunks), playlist_id, sub_chunk, error, track_details_lookup)
+            report.update((uri, error) for uri in sub_chunk)
 
+    if state and any(error is not None for error in report.values()):
+        # the stored copy can't be trusted now, re-fetch next run
+        state.invalidate_playlist(playlist_id)
+    return report
+
+
+def remove_tracks_from_playlist(sp, playlist_id, track_uris_to_remove, track_details_lookup, state=None, workers=MUTATION_WORKERS):
+    """
+    Removes tracks from the specified playlist, logging names and artists, and keeping any SyncState copy current.
 
-def remove_tracks_from_playlist(sp, playlist_id, track_uris_to_remove, track_details_lookup):
-    """Removes tracks from the specified playlist, logging names and artists."""
+    Removal order doesn't matter, so chunks are sent concurrently on a pool of workers, all but the last,
+    which is sent once the others are done so the snapshot_id it returns covers all of them.
+    Failed chunks are handled as described in write_chunk before being reported.
+
+    Returns:
+        {uri: None if removed, else the error} for every track.
+    """
     if not track_uris_to_remove:
         logging.info("No tracks to remove.")
-        return
+        return {}
 
     uris_list = list(track_uris_to_remove)
-    num_chunks = ceil(len(uris_list) / API_LIMIT)
-    logging.info(f"Removing {len(uris_list)} tracks in {num_chunks} chunk(s)...")
+    chunks = chunk_uris(uris_list)
+    logging.info(f"Removing {len(uris_list)} tracks in {len(chunks)} chunk(s)...")
+
+    def remove_chunk(chunk):
+        # Spotipy's remove function expects a list of URIs
+        return write_chunk(sp, sp.playlist_remove_all_occurrences_of_items, playlist_id, chunk)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        chunk_results = list(pool.map(remove_chunk, chunks[:-1]))
+    chunk_results.append(remove_chunk(chunks[-1]))
+
+    report = {}
+    for i, results in enumerate(chunk_results):
+        for sub_chunk, result, error in results:
+            log_chunk_result("removed", i, len(chunks), playlist_id, sub_chunk, error, track_details_lookup)
+            report.update((uri, error) for uri in sub_chunk)
+
+    if state:
+        if failed_uris(report):
+            state.invalidate_playlist(playlist_id)
+        else:
+            # from the last write rather than read afterwards, which could take in someone else's edit as ours
+            snapshot_id = chunk_results[-1][-1][1]['snapshot_id']
+            state.apply_playlist_write(playlist_id, snapshot_id, removed=list(report))
+    return report
+
+def failed_uris(report):
+    return [uri for uri, error in report.items() if error is not None]
+
+
+# --- Sync Jobs ---
+
+def load_sync_jobs(config_path=None):
+    """
+    Loads the source -> target sync jobs from a JSON config, e.g.
+      {"jobs": [{"source": "liked", "target": "<playlist id>"},
+                {"source": "playlist:<playlist id>", "target": "<playlist id>"},
+                {"source": "file:/music/album/spotify.txt", "target": "<playlist id>", "remove": false}]}
+    "remove": false only adds, leaving tracks not in the source alone.
+    Without a config, liked songs are synced to TARGET_PLAYLIST_ID.
+    """
+    if not config_path:
+        return [{'source': 'liked', 'target': TARGET_PLAYLIST_ID}]
+
+    with open(config_path, encoding='utf-8') as f:
+        jobs = json.load(f)['jobs']
+
+    valid_jobs = []
+    targets = set()
+    for job in jobs:
+        if job['target'] in targets:
+            logging.error(f"Playlist {job['target']} is the target of more than one job, skipping {job['source']} -> {job['target']}.")
+            continue
+        targets.add(job['target'])
+        valid_jobs.append(job)
+    return valid_jobs
+
+def get_source(sp, source, state, full=False):
+    """
+    Gets the tracks of a sync source: "liked", "playlist:<id>" or "file:<mp3_to_spotify output>".
+
+    Returns:
+        {'details': {uri: details} (None if the source couldn't be read), 'full': True if fetched in full,
+         'new': liked songs to store once synced (liked source only)}
+    """
+    if source == 'liked':
+        return get_liked_source(sp, state, full)
+    if source.startswith('playlist:'):
+        details = get_playlist_track_details(sp, source.split(':', 1)[1], state, use_stored=not full)
+        return {'details': details, 'full': full, 'new': {}}
+    if source.startswith('file:'):
+        return {'details': read_spotify_txt(source.split(':', 1)[1]), 'full': full, 'new': {}}
+    raise ValueError(f"Unknown sync source: {source}")
+
+def sync_target(sp, job, source, state):
+    """
+    Brings a job's target playlist in line with its source.
 
-    for i in range(num_chunks):
-        start_index = i * API_LIMIT
-        end_index = start_index + API_LIMIT
-        chunk = uris_list[start_index:end_index]
+    Returns:
+        dict of the job, added/removed URIs, failed adds/removes, details lookup, and error (or None).
+    """
+    target = job['target']
+    result = {'job': job, 'added': set(), 'removed': set(), 'failed_adds': [], 'failed_removes': [],
+              'details': {}, 'error': None}
+    try:
+        # a full fetch of the source also re-reads the target rather than trusting its snapshot
+        playlist_details = get_playlist_track_details(sp, target, state, use_stored=not source['full'])
+        source_details = source['details']
+
+        tracks_to_add_uris = set(source_details) - set(playlist_details)
+        tracks_to_remove_uris = set(playlist_details) - set(source_details) if job.get('remove', True) else set()
+        # Create a combined lookup for logging track details
+        result['details'] = {**playlist_details, **source_details}
+
+        logging.info(f"{job['source']} -> {target}: tracks to add: {len(tracks_to_add_uris)}, to remove: {len(tracks_to_remove_uris)}")
+
+        # Check if there are actual changes before calling API modify functions
+        add_report = add_tracks_to_playlist(sp, target, tracks_to_add_uris, result['details'], state)
+        remove_report = remove_tracks_from_playlist(sp, target, tracks_to_remove_uris, result['details'], state)
+
+        # don't count failed tracks as done, the target is re-fetched next run so they will be retried
+        result['failed_adds'] = failed_uris(add_report)
+        result['failed_removes'] = failed_uris(remove_report)
+        result['added'] = tracks_to_add_uris - set(result['failed_adds'])
+        result['removed'] = tracks_to_remove_uris - set(result['failed_removes'])
+        if result['failed_adds'] or result['failed_removes']:
+            logging.error(f"{job['source']} -> {target}: failed to add {len(result['failed_adds'])} and remove {len(result['failed_removes'])} tracks.")
+    except Exception as e:
+        logging.exception(f"Error syncing {job['source']} -> {target}: {e}")
+        result['error'] = str(e)
+        state.invalidate_playlist(target)
+    return result
+
+def run_sync_jobs(sp, jobs, state, full=False, workers=JOB_WORKERS):
+    """
+    Runs all sync jobs in one process: each distinct source is fetched once, then the targets are
+    updated concurrently (all sharing the one rate limiter).
+
+    Returns:
+        A result dict per job (see sync_target), in job order.
+    """
+    source_names = list(dict.fromkeys(job['source'] for job in jobs))
+
+    def safe_get_source(name):
         try:
-            # Spotipy's remove function expects a list of URIs
-            sp.playlist_remove_all_occurrences_of_items(playlist_id, chunk)
-            logging.info(f"Removed chunk {i+1}/{num_chunks} ({len(chunk)} tracks) from playlist {playlist_id}.")
-            # Log individual tracks removed in this chunk with details
-            for uri in chunk:
-                details = track_details_lookup.get(uri, {'name': 'N/A', 'artists': 'N/A'})
-                logging.info(f"  REMOVED: {details['name']} by {details['artists']} ({uri})")
+            return get_source(sp, name, state, full)
         except Exception as e:
-            logging.error(f"Error removing chunk {i+1} from playlist {playlist_id}: {e}")
-            # Log failed URIs for debugging
-            failed_details_log = []
-            for uri in chunk:
-                 details = track_details_lookup.get(uri, {'name': 'N/A', 'artists': 'N/A'})
-                 failed_details_log.append(f"{details['name']} by {details['artists']} ({uri})")
-            logging.error(f"  Failed chunk details:\n  " + "\n  ".join(failed_details_log))
+            logging.exception(f"Error reading sync source {name}: {e}")
+            return {'details': None, 'full': full, 'new': {}}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        sources = dict(zip(source_names, pool.map(safe_get_source, source_names)))
+
+        def run_job(job):
+            source = sources[job['source']]
+            if not source['details']:
+                return {'job': job, 'added': set(), 'removed': set(), 'failed_adds': [], 'failed_removes': [],
+                        'details': {}, 'error': f"No tracks found in source {job['source']}"}
+            return sync_target(sp, job, source, state)
+
+        results = list(pool.map(run_job, jobs))
+
+    # liked songs are only recorded as seen once every target using them has been through
+    liked = sources.get('liked')
+    if liked and liked['details']:
+        save_liked_source(state, liked)
+    return results
 
             
 def format_email_body(added_uris, removed_uris, details_lookup):
@@ -271,74 +614,55 @@ if __name__ == "__main__":
          logging.warning("Email environment variables (GMAIL_SENDER_EMAIL, GMAIL_SENDER_APP_PASSWORD, GMAIL_RECIPIENT_EMAIL) not fully set. Email notifications will be disabled.")
 
     try:
-        # Authenticate
-        auth_manager = SpotifyOAuth(
-            scope=SCOPE,
-            username=USERNAME,
-            open_browser=False # Set to False for non-interactive/scheduled runs
-        )
-        sp = spotipy.Spotify(auth_manager=auth_manager)
+        # Authenticate, the client shares its token cache with the other tools and goes through the shared rate limiter
+        sp = get_spotify(SCOPE, username=USERNAME)
         logging.info("Authentication successful.")
 
-        # Get current state with details
-        liked_details = get_liked_track_details(sp)
-        if liked_details:
-            playlist_details = get_playlist_track_details(sp, TARGET_PLAYLIST_ID)
+        config_path = sys.argv[sys.argv.index('--config') + 1] if '--config' in sys.argv else SYNC_CONFIG_PATH
+        jobs = load_sync_jobs(config_path)
+        logging.info(f"Running {len(jobs)} sync job(s).")
 
-            # Create sets of URIs for comparison
-            liked_uris = set(liked_details.keys())
-            playlist_uris = set(playlist_details.keys())
+        # Work out and apply changes, normally from just the songs liked since the last run
+        state = SyncState(SYNC_DB_PATH)
+        results = run_sync_jobs(sp, jobs, state, full='--full' in sys.argv)
 
-            # Calculate differences
-            tracks_to_add_uris = liked_uris - playlist_uris
-            tracks_to_remove_uris = playlist_uris - liked_uris
+        # --- Send Email Notification (if configured) ---
+        if email_configured:
+            errors = [result for result in results if result['error']]
+            changed = any(result['added'] or result['removed'] for result in results)
 
-            # Create a combined lookup for logging track details
-            all_track_details = {**playlist_details, **liked_details}
-
-            logging.info(f"Tracks to add: {len(tracks_to_add_uris)}")
-            logging.info(f"Tracks to remove: {len(tracks_to_remove_uris)}")
-
-            # --- Perform updates ---
-            # Check if there are actual changes before calling API modify functions
-            if tracks_to_add_uris:
-                add_tracks_to_playlist(sp, TARGET_PLAYLIST_ID, tracks_to_add_uris, all_track_details)
+            # Prepare email content regardless of changes
+            if errors:
+                email_subject = f"Spotify Sync Status - ERROR! - {datetime.date.today()}"
             else:
-                 logging.info("No tracks to add.")
+                email_subject = f"Spotify Sync Status - {datetime.date.today()}" # Changed subject slightly
 
-            if tracks_to_remove_uris:
-                 remove_tracks_from_playlist(sp, TARGET_PLAYLIST_ID, tracks_to_remove_uris, all_track_details)
+            email_body = ""
+            for result in results:
+                job = result['job']
+                if len(results) > 1:
+                    email_body += f"=== {job['source']} -> {job['target']} ===\n"
+                if result['error']:
+                    email_body += f"ERROR - {result['error']} - check logs!\n\n"
+                    continue
+                email_body += format_email_body(result['added'], result['removed'], result['details'])
+                if result['failed_adds'] or result['failed_removes']:
+                    email_body += f"--- FAILED: {len(result['failed_adds'])} adds, {len(result['failed_removes'])} removes (see log) ---\n\n"
+
+            # Add a top line indicating status explicitly
+            if not changed:
+                 email_body = "Spotify Sync Ran: No changes detected.\n\n" + email_body
+                 logging.info("No changes detected. Preparing confirmation email.")
             else:
-                 logging.info("No tracks to remove.")
-            # --- End Perform updates ---
-
-
-            # --- Send Email Notification (if configured) ---
-            if email_configured:
-                # Prepare email content regardless of changes
-                email_subject = f"Spotify Sync Status - {datetime.date.today()}" # Changed subject slightly
-                email_body = format_email_body(tracks_to_add_uris, tracks_to_remove_uris, all_track_details)
-
-                # Add a top line indicating status explicitly
-                if not tracks_to_add_uris and not tracks_to_remove_uris:
-                     email_body = "Spotify Sync Ran: No changes detected.\n\n" + email_body
-                     logging.info("No changes detected. Preparing confirmation email.")
-                else:
-                     email_body = "Spotify Sync Ran: Changes detected.\n\n" + email_body
-                     logging.info("Changes detected, preparing results email.")
-
-                # Send the email
-                send_gmail(email_subject, email_body, sender_email, sender_password, recipient_email)
-        
-        else:
-            if email_configured:
-                # Prepare email content regardless of changes
-                email_subject = f"Spotify Sync Status - ERROR! - {datetime.date.today()}" # Changed subject slightly
-                email_body = "No tracks found to sync - ERROR - check logs!"
-                # Send the email
-                send_gmail(email_subject, email_body, sender_email, sender_password, recipient_email)
+                 email_body = "Spotify Sync Ran: Changes detected.\n\n" + email_body
+                 logging.info("Changes detected, preparing results email.")
 
+            # Send the email
+            send_gmail(email_subject, email_body, sender_email, sender_password, recipient_email)
 
+        logging.info(f"Rate limiter: {default_limiter.stats()}")
+        if '--metrics' in sys.argv:
+            metrics.default_metrics.write(sys.argv[sys.argv.index('--metrics') + 1])
         logging.info("Sync process completed.")
 
     except spotipy.SpotifyException as e:
@@ -0,0 +1,84 @@
+""" Offset based pagination for Spotify endpoints, fetching the remaining pages concurrently once the total is known,
+    and batched lookups of many ids through the several-items endpoints"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# pages fetched at once after the first, the rate limiter still governs the request rate
+DEFAULT_WORKERS = 4
+
+# most ids the several-tracks endpoint takes per call
+MAX_IDS_PER_CALL = 50
+
+
+@metrics.timed("fetch_all_pages")
+def fetch_all_pages(page_call, limit=50, workers=DEFAULT_WORKERS):
+    """
+    Retrieve all items from a paginated endpoint that takes limit and offset keyword args
+    (e.g. sp.current_user_saved_tracks, or a lambda around sp.playlist_items / sp.user_playlists).
+
+    The first page gives the total, the remaining offsets are then fetched on a pool of workers
+    and the items returned in order. Falls back to walking offsets one at a time if no total is returned.
+    """
+    limit = int(limit)
+    workers = int(workers)
+
+    first = page_call(limit=limit, offset=0)
+    if not first:
+        return []
+
+    items = list(first['items'])
+    total = first.get('total')
+    if total is None:
+        if len(items) < limit:
+            return items
+        return items + _fetch_sequential(page_call, limit, limit)
+
+    offsets = range(limit, total, limit)
+    if not offsets:
+        return items
+
+    def fetch(offset):
+        page = page_call(limit=limit, offset=offset)
+        return page['items'] if page else []
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for page_items in pool.map(fetch, offsets):
+            items.extend(page_items)
+    return items
+
+
+def _fetch_sequential(page_call, limit, offset):
+    items = []
+    while True:
+        page = page_call(limit=limit, offset=offset)
+        if not page or not page['items']:
+            return items
+        items.extend(page['items'])
+        offset += limit
+
+
+@metrics.timed("fetch_by_ids")
+def fetch_by_ids(batch_call, ids, key='tracks', batch_size=MAX_IDS_PER_CALL, workers=DEFAULT_WORKERS):
+    """
+    Look up many ids through a several-items endpoint (e.g. sp.tracks), batch_size ids per call,
+    with the batches fetched on a pool of workers.
+
+    Duplicate ids are only requested once. Returns {id: item} for every requested id, item is None
+    for ids Spotify doesn't know. Items are matched to ids by position, so relinked tracks (whose
+    item carries a different id) still map back to the id asked for.
+    """
+    ids = list(dict.fromkeys(ids))
+    batch_size = int(batch_size)
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+
+    def fetch(batch):
+        result = batch_call(batch)
+        return result[key] if result else [None] * len(batch)
+
+    items = {}
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+        for batch, batch_items in zip(batches, pool.map(fetch, batches)):
+            items.update(zip(batch, batch_items))
+    return items
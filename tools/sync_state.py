@@ -0,0 +1,135 @@
+""" Local sqlite snapshot of what the liked songs sync has seen, so runs only fetch what changed"""
+
+import sqlite3
+import threading
+import time
+
+
+class SyncState(object):
+    """liked songs snapshot (uri, added_at, name, artists), target playlist contents by snapshot_id,
+       plus key/value metadata such as the last full reconcile
+       safe to share between the threads syncing different targets
+    """
+    def __init__(self, db_path):
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+        CREATE TABLE IF NOT EXISTS liked_tracks (
+            uri TEXT PRIMARY KEY,
+            added_at TEXT,
+            name TEXT,
+            artists TEXT
+        );
+        CREATE TABLE IF NOT EXISTS sync_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS playlist_state (
+            playlist_id TEXT PRIMARY KEY,
+            snapshot_id TEXT
+        );
+        CREATE TABLE IF NOT EXISTS playlist_tracks (
+            playlist_id TEXT NOT NULL,
+            uri TEXT NOT NULL,
+            name TEXT,
+            artists TEXT,
+            PRIMARY KEY (playlist_id, uri)
+        );
+        """)
+        self.conn.commit()
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM sync_meta WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO sync_meta (key, value) VALUES (?, ?)", (key, str(value)))
+            self.conn.commit()
+
+    def liked_added_at(self):
+        """{uri: added_at} of the liked songs snapshot"""
+        with self._lock:
+            return dict(self.conn.execute("SELECT uri, added_at FROM liked_tracks"))
+
+    def liked_details(self):
+        """{uri: {'name', 'artists', 'added_at'}} of the liked songs snapshot"""
+        with self._lock:
+            return {uri: {'name': name, 'artists': artists, 'added_at': added_at}
+                    for uri, added_at, name, artists in self.conn.execute("SELECT uri, added_at, name, artists FROM liked_tracks")}
+
+    def add_liked(self, details):
+        """add/update liked songs from {uri: {'name', 'artists', 'added_at'}}"""
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO liked_tracks (uri, added_at, name, artists) VALUES (?, ?, ?, ?)",
+                                  ((uri, d.get('added_at'), d['name'], d['artists']) for uri, d in details.items()))
+            self.conn.commit()
+
+    def replace_liked(self, details):
+        """replace the whole liked songs snapshot, after a full fetch"""
+        with self._lock:
+            self.conn.execute("DELETE FROM liked_tracks")
+            self.add_liked(details)
+
+    def full_reconcile_due(self, every_days):
+        """True if there has been no full reconcile within every_days (or ever)"""
+        with self._lock:
+            last = self.get_meta('last_full_reconcile')
+            return last is None or time.time() - float(last) >= float(every_days) * 86400
+
+    def mark_full_reconcile(self):
+        with self._lock:
+            self.set_meta('last_full_reconcile', time.time())
+
+    def get_playlist(self, playlist_id):
+        """(snapshot_id, {uri: {'name', 'artists'}}) stored for a playlist, snapshot_id is None if unknown"""
+        with self._lock:
+            row = self.conn.execute("SELECT snapshot_id FROM playlist_state WHERE playlist_id = ?", (playlist_id,)).fetchone()
+            if not row or not row[0]:
+                return None, {}
+            details = {uri: {'name': name, 'artists': artists}
+                       for uri, name, artists in self.conn.execute(
+                           "SELECT uri, name, artists FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,))}
+            return row[0], details
+
+    def save_playlist(self, playlist_id, snapshot_id, details):
+        """replace the stored contents of a playlist, as fetched at snapshot_id"""
+        with self._lock:
+            self.conn.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,))
+            self._add_playlist_tracks(playlist_id, details)
+            self._set_snapshot(playlist_id, snapshot_id)
+            self.conn.commit()
+
+    def apply_playlist_write(self, playlist_id, snapshot_id, added=None, removed=()):
+        """record our own add ({uri: details}) or remove (uris) and the snapshot_id it returned
+           only applied if the stored copy is current, otherwise the next run re-fetches the playlist anyway
+        """
+        with self._lock:
+            if self.get_playlist(playlist_id)[0] is None:
+                return
+            if added:
+                self._add_playlist_tracks(playlist_id, added)
+            self.conn.executemany("DELETE FROM playlist_tracks WHERE playlist_id = ? AND uri = ?",
+                                  ((playlist_id, uri) for uri in removed))
+            self._set_snapshot(playlist_id, snapshot_id)
+            self.conn.commit()
+
+    def invalidate_playlist(self, playlist_id):
+        """forget the stored snapshot, e.g. after a failed write, so the playlist is fetched in full next time"""
+        with self._lock:
+            self._set_snapshot(playlist_id, None)
+            self.conn.commit()
+
+    def _add_playlist_tracks(self, playlist_id, details):
+        self.conn.executemany("INSERT OR REPLACE INTO playlist_tracks (playlist_id, uri, name, artists) VALUES (?, ?, ?, ?)",
+                              ((playlist_id, uri, d['name'], d['artists']) for uri, d in details.items()))
+
+    def _set_snapshot(self, playlist_id, snapshot_id):
+        self.conn.execute("INSERT OR REPLACE INTO playlist_state (playlist_id, snapshot_id) VALUES (?, ?)",
+                          (playlist_id, snapshot_id))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()